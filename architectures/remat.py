@@ -0,0 +1,171 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Activation rematerialization (gradient checkpointing) of layer groups.
+
+With a remat policy, consecutive layers (e.g. transformer layers or ResNet
+block groups) are grouped, and activations inside each group are recomputed
+in the backward pass instead of being kept from the forward pass:
+
+  'none': no recomputation.
+  'per_layer': each layer is a group.
+  'every_k@<k>': each k consecutive layers are a group.
+
+Random ops of layers in groups must use `random_uniform` (e.g. `Dropout`
+below), so that recomputation replays the same random values. Batch norm layers
+in groups must be `BatchNormalization` or `SyncBatchNormalization` below, which
+do not update their moving statistics again in recomputation.
+"""
+
+import contextlib
+import threading
+
+import tensorflow as tf
+
+_state = threading.local()
+
+
+def get_group_sizes(num_layers, remat_policy):
+  """Returns sizes of consecutive groups of layers, or None without remat."""
+  if remat_policy == 'none':
+    return None
+  if remat_policy == 'per_layer':
+    k = 1
+  elif remat_policy.startswith('every_k@'):
+    k = int(remat_policy.split('@')[1])
+  else:
+    raise ValueError('Unknown remat_policy {}'.format(remat_policy))
+  return [min(k, num_layers - i) for i in range(0, num_layers, k)]
+
+
+@contextlib.contextmanager
+def _random_scope(seed, recomputing):
+  _state.seed, _state.count, _state.recomputing = seed, 0, recomputing
+  try:
+    yield
+  finally:
+    _state.seed, _state.recomputing = None, False
+
+
+def is_recomputing():
+  """Whether layers are called in recomputation (in backward)."""
+  return getattr(_state, 'recomputing', False)
+
+
+def random_uniform(shape, dtype=tf.float32):
+  """`tf.random.uniform` in [0, 1), which is replayed in recomputation."""
+  seed = getattr(_state, 'seed', None)
+  if seed is None:
+    return tf.random.uniform(shape, dtype=dtype)
+  _state.count += 1
+  return tf.random.stateless_uniform(
+      shape, tf.random.experimental.stateless_fold_in(seed, _state.count),
+      dtype=dtype)
+
+
+def recompute(fn):
+  """Returns fn(*tensors) that recomputes its activations in backward.
+
+  Args:
+    fn: a function of tensors, which returns a (nested) structure of tensors.
+      Variables used by fn must have been created, i.e. layers built.
+  """
+  num_calls = [0]  # Called in forward, and then in backward to recompute.
+
+  @tf.recompute_grad
+  def recomputed_fn(seed, *args):
+    num_calls[0] += 1
+    with _random_scope(seed, recomputing=num_calls[0] > 1):
+      return fn(*args)
+
+  def wrapped_fn(*args):
+    seed = tf.random.uniform([2], maxval=tf.int32.max, dtype=tf.int32)
+    return recomputed_fn(seed, *args)
+  return wrapped_fn
+
+
+def call_layers(layer_fn, num_layers, group_sizes, x, *args):
+  """Calls layers in sequence, recomputing each group of layers in backward.
+
+  Args:
+    layer_fn: a function (i, x, *args) -> (x, output) of the i-th layer.
+    num_layers: `int` number of layers.
+    group_sizes: `list` of group sizes from `get_group_sizes`, or None to not
+      recompute.
+    x: `float` inputs of the first layer.
+    *args: other tensors taken by every layer (e.g. encoded images), which are
+      passed explicitly for gradients to flow to them.
+
+  Returns:
+    x: outputs of the last layer.
+    outputs: `list` of output of each layer.
+  """
+  def group_fn(start, size):
+    def fn(x, *args):
+      group_outputs = []
+      for i in range(start, start + size):
+        x, output = layer_fn(i, x, *args)
+        group_outputs.append(output)
+      return x, group_outputs
+    return fn
+
+  outputs = []
+  start = 0
+  for size in group_sizes or [num_layers]:
+    fn = group_fn(start, size)
+    if group_sizes:
+      fn = recompute(fn)
+    x, group_outputs = fn(x, *args)
+    outputs.extend(group_outputs)
+    start += size
+  return x, outputs
+
+
+class Dropout(tf.keras.layers.Dropout):
+  """Dropout whose masks are replayed in recomputation."""
+
+  def call(self, inputs, training=None):
+    if not training or self.rate == 0.:
+      return inputs
+    keep = random_uniform(tf.shape(inputs), inputs.dtype) >= self.rate
+    return tf.where(keep, inputs / (1. - self.rate), tf.zeros_like(inputs))
+
+
+def _skip_in_recomputation(assign_fn):
+  def wrapped_fn(self, variable, *args):
+    if is_recomputing():
+      return variable
+    return assign_fn(self, variable, *args)
+  return wrapped_fn
+
+
+class BatchNormalization(tf.keras.layers.BatchNormalization):
+  """Batch norm whose moving statistics are not updated in recomputation."""
+
+  _assign_moving_average = _skip_in_recomputation(
+      tf.keras.layers.BatchNormalization._assign_moving_average)
+  _assign_new_value = _skip_in_recomputation(
+      tf.keras.layers.BatchNormalization._assign_new_value)
+
+
+class SyncBatchNormalization(
+    tf.keras.layers.experimental.SyncBatchNormalization):
+  """Synchronized batch norm, which is not updated in recomputation."""
+
+  _assign_moving_average = _skip_in_recomputation(
+      tf.keras.layers.experimental.SyncBatchNormalization
+      ._assign_moving_average)
+  _assign_new_value = _skip_in_recomputation(
+      tf.keras.layers.experimental.SyncBatchNormalization._assign_new_value)
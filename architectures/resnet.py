@@ -20,6 +20,7 @@ Residual networks (ResNets) were proposed in:
     Deep Residual Learning for Image Recognition. arXiv:1512.03385
 """
 
+from architectures import remat
 import tensorflow as tf
 import tensorflow_addons.layers as tfa_layers
 
@@ -61,7 +62,7 @@ class BatchNormRelu(tf.keras.layers.Layer):  # pylint: disable=missing-docstring
           name='gn')
     else:
       if global_bn:
-        self.bn = tf.keras.layers.experimental.SyncBatchNormalization(
+        self.bn = remat.SyncBatchNormalization(
             axis=axis,
             momentum=batch_norm_decay,
             epsilon=BATCH_NORM_EPSILON,
@@ -71,7 +72,7 @@ class BatchNormRelu(tf.keras.layers.Layer):  # pylint: disable=missing-docstring
             gamma_initializer=gamma_initializer,
             name='global_bn')
       else:
-        self.bn = tf.keras.layers.BatchNormalization(
+        self.bn = remat.BatchNormalization(
             axis=axis,
             momentum=batch_norm_decay,
             epsilon=BATCH_NORM_EPSILON,
@@ -614,10 +615,13 @@ class Resnet(tf.keras.layers.Layer):  # pylint: disable=missing-docstring
                sk_ratio=0.,
                variant='standard',
                groups=0,
+               remat_policy='none',
                **kwargs):
     super(Resnet, self).__init__(**kwargs)
     self.data_format = data_format
     self.variant = variant
+    # Block groups are recomputed in backward with remat, see `remat`.
+    self.remat_policy = remat_policy
     if dropblock_keep_probs is None:
       dropblock_keep_probs = [None] * 4
     if not isinstance(dropblock_keep_probs,
@@ -748,10 +752,16 @@ class Resnet(tf.keras.layers.Layer):  # pylint: disable=missing-docstring
     for layer in self.initial_conv_relu_max_pool:
       inputs = layer(inputs, training=training)
 
-    hidden_stack = []
-    for _, layer in enumerate(self.block_groups):
-      inputs = layer(inputs, training=training)
-      hidden_stack.append(inputs)
+    def layer_fn(i, inputs):
+      inputs = self.block_groups[i](inputs, training=training)
+      return inputs, inputs
+
+    remat_groups = None
+    if training and all(l.built for l in self.block_groups):
+      remat_groups = remat.get_group_sizes(
+          len(self.block_groups), self.remat_policy)
+    inputs, hidden_stack = remat.call_layers(
+        layer_fn, len(self.block_groups), remat_groups, inputs)
     if self.data_format == 'channels_last':
       inputs = tf.reduce_mean(inputs, [1, 2])
     else:
@@ -768,7 +778,8 @@ def resnet(resnet_depth,
            dropblock_size=None,
            sk_ratio=0.,
            variant='standard',
-           groups=0):
+           groups=0,
+           remat_policy='none'):
   """Returns the ResNet model for a given size and number of output classes."""
   model_params = {
       18: {
@@ -812,4 +823,5 @@ def resnet(resnet_depth,
       sk_ratio=sk_ratio,
       variant=variant,
       groups=groups,
+      remat_policy=remat_policy,
       name='resnet')
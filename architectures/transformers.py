@@ -15,10 +15,14 @@
 # ==============================================================================
 """Transformer."""
 
+import functools
 import math
+from typing import Optional
 
+from architectures import remat
 from architectures import resnet
 import tensorflow as tf
+from tensorflow.compiler.tf2xla.python import xla as tf2xla
 
 
 def suffix_id(i):
@@ -26,6 +30,15 @@ def suffix_id(i):
   return '' if i == 0 else '_%d' % i
 
 
+def get_remat_groups(num_layers, remat_policy, drop_att=0.):
+  """Returns remat group sizes of layers (see `remat.get_group_sizes`)."""
+  group_sizes = remat.get_group_sizes(num_layers, remat_policy)
+  if group_sizes and drop_att > 0:
+    # Attention dropout of `MultiHeadAttention` is not replayed.
+    raise ValueError('remat_policy does not support drop_att > 0.')
+  return group_sizes
+
+
 def get_shape(x):
   static = x.shape.as_list()
   dynamic = tf.shape(x)
@@ -163,6 +176,32 @@ def add_vis_pos_emb(self,
   return vis_pos_emb
 
 
+def interpolate_vis_pos_emb(vis_pos_emb, n_rows, n_cols, grid_rows, grid_cols):
+  """Resizes vis_pos_emb of a (n_rows, n_cols) grid to (grid_rows, grid_cols).
+
+  Args:
+    vis_pos_emb: `float` tensor of (n_rows * n_cols, dim).
+    n_rows: `int` number of rows of the grid of vis_pos_emb.
+    n_cols: `int` number of columns of the grid of vis_pos_emb.
+    grid_rows: `int` or scalar `int` tensor of rows of the output grid, e.g. of
+      images of another size than the model image size.
+    grid_cols: `int` or scalar `int` tensor of columns of the output grid.
+
+  Returns:
+    `float` tensor of (grid_rows * grid_cols, dim), which is vis_pos_emb
+    for the same grid.
+  """
+  if isinstance(grid_rows, int) and isinstance(grid_cols, int) and (
+      grid_rows, grid_cols) == (n_rows, n_cols):
+    return vis_pos_emb
+  dim = vis_pos_emb.shape[-1]
+  emb = tf.reshape(vis_pos_emb, [1, n_rows, n_cols, dim])
+  emb = tf.image.resize(emb, [grid_rows, grid_cols],
+                        method=tf.image.ResizeMethod.BICUBIC)
+  return tf.cast(tf.reshape(emb, [grid_rows * grid_cols, dim]),
+                 vis_pos_emb.dtype)
+
+
 def add_cls_token_emb(self, dim, name_prefix=None, initializer=None):
   """Add cls_token_emb variable to model instance referenced by `self`."""
   if name_prefix is None:
@@ -202,6 +241,16 @@ def add_vocab_token_emb(self, vocab_size, dim, shared_embedding, output_bias,
         name='%s/outp_bias' % name_prefix)
 
 
+def read_weight(weight, dtype):
+  """Returns a weight variable, or quantized weights, as a tensor of dtype.
+
+  Quantized weights (see `models/quantization.py`) are dequantized.
+  """
+  if hasattr(weight, 'dequantize'):
+    return weight.dequantize(dtype)
+  return tf.cast(weight, dtype)
+
+
 def kronecker_product(mat1, mat2):
   """Computes the Kronecker product two matrices."""
   # m1, n1 = mat1.get_shape().as_list()
@@ -254,6 +303,33 @@ def get_local_ar_mask(seq_len, window_size, dtype=tf.float32):
   return 1.0 - valid_locs
 
 
+def get_sliding_ar_mask(seq_len, window_size, period=1, dtype=tf.float32):
+  """Get causal mask of a sliding window aligned to periods.
+
+  Position i can attend to positions j in [i // period * period - window_size,
+  i], i.e. to the previous positions of its period (e.g. the tokens of the same
+  object) and to window_size positions before the period.
+
+  Args:
+    seq_len: a `int` or `int` tensor specifying the sequence length.
+    window_size: a `int` or `int` tensor specifying the window size.
+    period: a `int` or `int` tensor specifying the alignment of windows.
+    dtype: tf data type for the return tensor.
+
+  Returns:
+    tensor of shape [1, 1, seq_len, seq_len] with ones for
+    locations to be masked out.
+  """
+  rows = tf.range(seq_len)[:, tf.newaxis]
+  cols = tf.range(seq_len)[tf.newaxis, :]
+  valid_locs = tf.logical_and(
+      tf.less_equal(cols, rows),
+      tf.greater_equal(cols, rows // period * period - window_size))
+  valid_locs = tf.reshape(
+      tf.cast(valid_locs, dtype), [1, 1, seq_len, seq_len])
+  return 1.0 - valid_locs
+
+
 def merge_masks(mask1, mask2):
   """Merge ar and local ar masks, each of shape (1, 1, src, dst)."""
   sh1 = tf.shape(mask1)
@@ -265,14 +341,50 @@ def merge_masks(mask1, mask2):
       tf.concat([bottom_left, mask2], 3)], 2)
 
 
+def update_slice(tensor, update, start, axis, xla=False):
+  """Returns tensor with tensor[..., start:start+n, ...] replaced by update.
+
+  This is an in-place (buffer forwarding) update equivalent to XLA's
+  DynamicUpdateSlice, which works with dynamic `start` on CPU/GPU/TPU.
+
+  Args:
+    tensor: a tensor of rank r.
+    update: a tensor of rank r with the same shape as `tensor` except on `axis`.
+    start: a `int` or `int` scalar tensor for the start location on `axis`.
+    axis: a python `int` specifying the axis to update.
+    xla: `bool` whether to use XLA's DynamicUpdateSlice, which supports dynamic
+      `start` under XLA compilation (only).
+
+  Returns:
+    a tensor of the same shape as `tensor`.
+  """
+  rank = tensor.shape.rank
+  axis = axis % rank
+  update_shape = tf.shape(update, out_type=tf.int32)
+  begin = tf.one_hot(axis, rank, dtype=tf.int32) * tf.cast(start, tf.int32)
+  if xla:
+    return tf2xla.dynamic_update_slice(tensor, update, begin)
+  return tf.raw_ops.TensorStridedSliceUpdate(
+      input=tensor, begin=begin, end=begin + update_shape,
+      strides=tf.ones([rank], tf.int32), value=update)
+
+
+# Number of largest logits (from `tf.math.top_k`) that nucleus (top-p) sampling
+# first looks into instead of sorting the full vocab, see `top_logits`.
+TOP_P_CANDIDATES = 64
+
+
 def top_logits(logits: tf.Tensor,
                k: int = 0,
                p: float = 1.0,
-               mask: float = -1e10) -> tf.Tensor:
+               mask: float = -1e10,
+               num_candidates: Optional[int] = None,
+               exact: bool = True,
+               xla: bool = False) -> tf.Tensor:
   """Remove low probability logits via masking.
 
   Args:
-    logits: class logits in shape of (batch size, total_classes).
+    logits: class logits in shape of (..., total_classes).
     k: specifying top k largest logits to keep.
     p: specifying a probability for finding a minimum set of largest
       logits to keep, where their cumulative probability is no less than p
@@ -280,24 +392,150 @@ def top_logits(logits: tf.Tensor,
       the largest but no more than p").
     mask: an value that's used to replace logits that don't satisfy the
       keep conditions.
+    num_candidates: `int` number of largest logits to find the top-p set in,
+      instead of sorting all logits. 0 for always sorting all logits. Default
+      to `TOP_P_CANDIDATES` if None.
+    exact: `bool` for falling back to sorting all logits of the rows whose
+      top-p set is not within the candidates, so the result is the same as
+      without candidates. Otherwise at most num_candidates logits are kept.
+    xla: `bool` whether shapes are static for XLA compilation, where all rows
+      are sorted (and selected per row) if the top-p set of any row is not
+      within the candidates, rather than only gathering those rows.
 
   Returns:
     logits where low probability ones are replaced with mask.
   """
-  mask = tf.ones_like(logits) * mask
   if k > 0:
-    min_logits = tf.nn.top_k(logits, k=k)[0][:, -1:]
+    min_logits = tf.nn.top_k(logits, k=k)[0][..., -1:]
     logits = tf.where(logits < min_logits, mask, logits)
   if p < 1.:
-    sorted_logits = tf.sort(logits, direction='DESCENDING', axis=-1)
-    cum_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
-    min_logits = -tf.reduce_max(
-        tf.where(cum_probs <= p, -sorted_logits, mask), -1, keepdims=True)
-    min_logits = tf.minimum(min_logits, sorted_logits[:, :1])
+    def get_min_logits(sorted_logits, cum_probs):
+      min_logits = -tf.reduce_max(
+          tf.where(cum_probs <= p, -sorted_logits, mask), -1, keepdims=True)
+      return tf.minimum(min_logits, sorted_logits[..., :1])
+
+    def sort_all(logits):
+      sorted_logits = tf.sort(logits, direction='DESCENDING', axis=-1)
+      cum_probs = tf.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1)
+      return get_min_logits(sorted_logits, cum_probs)
+
+    if num_candidates is None:
+      num_candidates = TOP_P_CANDIDATES
+    num_classes = logits.shape[-1]
+    if num_candidates and num_classes and num_candidates < num_classes:
+      sorted_logits = tf.nn.top_k(logits, k=num_candidates)[0]
+      log_probs = sorted_logits - tf.reduce_logsumexp(
+          logits, -1, keepdims=True)
+      cum_probs = tf.cumsum(tf.exp(log_probs), axis=-1)
+      min_logits = get_min_logits(sorted_logits, cum_probs)
+      if exact:
+        # The top-p set is within candidates if they add up to more than p,
+        # otherwise the row is sorted in full.
+        missed = tf.less_equal(cum_probs[..., -1], p)
+        if xla:
+          min_logits = tf.cond(
+              tf.reduce_any(missed),
+              lambda: tf.where(missed[..., tf.newaxis], sort_all(logits),
+                               min_logits),
+              lambda: min_logits)
+        else:
+          missed_rows = tf.where(missed)
+          min_logits = tf.tensor_scatter_nd_update(
+              min_logits, missed_rows,
+              sort_all(tf.gather_nd(logits, missed_rows)))
+    else:
+      min_logits = sort_all(logits)
     logits = tf.where(logits < min_logits, mask, logits)
   return logits
 
 
+def token_mask_to_bias(token_mask, mask: float = -1e10) -> tf.Tensor:
+  """Returns additive logits bias for an allowed-token schedule.
+
+  Args:
+    token_mask: `bool` allowed tokens in shape of (period, total_classes), or
+      an additive `float` bias of the same shape (returned as is).
+    mask: an value that's added to logits of disallowed tokens.
+
+  Returns:
+    `float` bias in shape of (period, total_classes), 0 for allowed tokens.
+  """
+  token_mask = tf.convert_to_tensor(token_mask)
+  if token_mask.dtype != tf.bool:
+    return tf.cast(token_mask, tf.float32)
+  return tf.where(token_mask, 0., mask)
+
+
+def mask_disallowed_tokens(logits: tf.Tensor,
+                           token_bias: tf.Tensor,
+                           pos) -> tf.Tensor:
+  """Mask logits of tokens that are not allowed at the given position.
+
+  Args:
+    logits: class logits in shape of (batch size, total_classes).
+    token_bias: additive `float` bias in shape of (period, total_classes) from
+      `token_mask_to_bias`, where position pos uses token_bias[pos % period].
+    pos: `int` scalar position (of generated tokens).
+
+  Returns:
+    logits with the bias of the given position added.
+  """
+  return logits + tf.gather(token_bias, pos % tf.shape(token_bias)[0])[
+      tf.newaxis]
+
+
+def kept_logits_spec(logits_mode, out_len, vocab_size):
+  """Returns how to keep part of the logits of generated positions.
+
+  Args:
+    logits_mode: what to keep of the logits at each generated position, see
+      `AutoregressiveDecoder.infer`.
+    out_len: `int` number of generated positions.
+    vocab_size: `int` vocab size.
+
+  Returns:
+    num_kept: `int` number of kept positions (slots).
+    kept_shape: `list` of the shape kept for each position.
+    init_value: `float` initial value for positions that are not generated.
+    get_logits_update: a `function` that takes generated position(s) `pos` (a
+      scalar, or in (bsz,)), logits in (bsz, vocab_size) and sampled tokens in
+      (bsz,), and returns the slot(s) of pos (num_kept if not kept) and the kept
+      part of logits in (bsz,) + kept_shape.
+  """
+  uniform_log_prob = -math.log(vocab_size)
+  if logits_mode == 'full':
+    return out_len, [vocab_size], 0., lambda pos, logits, _: (pos, logits)
+  if logits_mode == 'token':
+    def get_token_log_prob(pos, logits, token):
+      log_probs = tf.nn.log_softmax(logits)
+      return pos, tf.gather(log_probs, token, batch_dims=1)
+    return out_len, [], uniform_log_prob, get_token_log_prob
+  if not isinstance(logits_mode, dict):
+    raise ValueError('Unknown logits_mode %s' % logits_mode)
+  period = logits_mode.get('period', 1)
+  offsets = list(logits_mode.get('offsets', range(period)))
+  vocab_start, vocab_end = logits_mode.get('vocab_range', (0, vocab_size))
+  num_kept = out_len // period * len(offsets)
+  # Slot offset of each position within a period, or -1 if not kept.
+  slot_table = [offsets.index(i) if i in offsets else -1
+                for i in range(period)]
+  def get_kept_log_probs(pos, logits, token):
+    del token
+    log_probs = tf.nn.log_softmax(logits)
+    slot_offset = tf.gather(slot_table, pos % period)
+    keep = tf.logical_and(tf.less(pos, out_len // period * period),
+                          tf.greater_equal(slot_offset, 0))
+    slot = tf.where(keep, pos // period * len(offsets) + slot_offset, num_kept)
+    return slot, log_probs[:, vocab_start:vocab_end]
+  return (num_kept, [vocab_end - vocab_start], uniform_log_prob,
+          get_kept_log_probs)
+
+
+def length_penalty_factor(length, alpha):
+  """Length normalization factor ((5 + length) / 6)^alpha as in GNMT."""
+  return tf.pow((5. + tf.cast(length, tf.float32)) / 6., alpha)
+
+
 def sample_categorical(logits, num_classes, temperature, top_k, top_p):
   """logits in (..., num_classes), and return (...)."""
   out_shape = tf.shape(logits)[:-1]
@@ -349,7 +587,7 @@ class DropPath(tf.keras.layers.Layer):
     keep_rate = 1. - self._drop_rate
     xshape = tf.shape(x)
     drop_mask_shape = [xshape[0]] + [1] * (len(xshape) - 1)
-    drop_mask = keep_rate + tf.random.uniform(drop_mask_shape, dtype=x.dtype)
+    drop_mask = keep_rate + remat.random_uniform(drop_mask_shape, x.dtype)
     drop_mask = tf.math.divide(tf.floor(drop_mask), keep_rate)
 
     return x * drop_mask
@@ -367,7 +605,7 @@ class FeedForwardLayer(tf.keras.layers.Layer):  # pylint: disable=missing-docstr
     super(FeedForwardLayer, self).__init__(**kwargs)
     self.dense1 = tf.keras.layers.Dense(
         dim_mlp, activation=tf.nn.gelu, name='dense1')
-    self.dropout = tf.keras.layers.Dropout(drop_units)
+    self.dropout = remat.Dropout(drop_units)
     self.dense2 = tf.keras.layers.Dense(dim_att, name='dense2')
     if use_ln:
       self.ln = tf.keras.layers.LayerNormalization(
@@ -466,9 +704,11 @@ class TransformerEncoder(tf.keras.layers.Layer):  # pylint: disable=missing-docs
                drop_att=0.,
                use_ffn_ln=False,
                ln_scale_shift=True,
+               remat_policy='none',
                **kwargs):
     super(TransformerEncoder, self).__init__(**kwargs)
     self.num_layers = num_layers
+    self.remat_groups = get_remat_groups(num_layers, remat_policy, drop_att)
     self.enc_layers = [
         TransformerEncoderLayer(  # pylint: disable=g-complex-comprehension
             dim, mlp_ratio, num_heads, drop_path, drop_units, drop_att,
@@ -478,10 +718,15 @@ class TransformerEncoder(tf.keras.layers.Layer):  # pylint: disable=missing-docs
     ]
 
   def call(self, x, mask, training, ret_list=False):
-    x_list = [x]
-    for i in range(self.num_layers):
+    def layer_fn(i, x):
       x = self.enc_layers[i](x, mask, training)
-      x_list.append(x)
+      return x, x
+
+    x_list = [x]
+    remat_groups = self.remat_groups if training and all(
+        l.built for l in self.enc_layers) else None
+    x, outputs = remat.call_layers(layer_fn, self.num_layers, remat_groups, x)
+    x_list.extend(outputs)
     return (x, x_list) if ret_list else x
 
 
@@ -503,6 +748,7 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):  # pylint: disable=missing
                ln_scale_shift=True,
                **kwargs):
     super(TransformerDecoderLayer, self).__init__(**kwargs)
+    self.dim = dim
     self.self_attention = self_attention
     self.cross_attention = cross_attention
     self.use_mlp = use_mlp
@@ -557,6 +803,93 @@ class TransformerDecoderLayer(tf.keras.layers.Layer):  # pylint: disable=missing
       x = self.mlp(x, training)
     return x, x_for_cache
 
+  def _attend(self, mha, x, key, value, mask):
+    """Multi-head attention of x over given projected key / value.
+
+    This mirrors `tf.keras.layers.MultiHeadAttention.call` in inference mode,
+    but takes key / value that are already projected (e.g. from a cache) in
+    (bsz', seq', heads, head_dim). x is in (bsz, seq, d) where bsz is a multiple
+    of bsz', and each consecutive group of bsz // bsz' rows of x attends to the
+    same key / value (e.g. multiple instances / samples of the same image).
+    """
+    bsz, seq_len, dim = get_shape(x)
+    x = tf.reshape(x, [tf.shape(key)[0], -1, dim])
+    # pylint: disable=protected-access
+    query = mha._query_dense(x)
+    outputs, _ = mha._compute_attention(query, key, value, mask, False)
+    outputs = mha._output_dense(outputs)
+    # pylint: enable=protected-access
+    return tf.reshape(outputs, [bsz, seq_len, -1])
+
+  def project_cross_kv(self, enc):
+    """Projects enc in (bsz, seq', d) into cross-attention (key, value).
+
+    The projections only depend on the encoded representations, so they can be
+    computed once per image and reused for every decoding step (and for
+    multiple sequences of the same image).
+
+    Returns:
+      a tuple of (key, value) each in (bsz, seq', heads, head_dim), or an empty
+      tuple if there is no cross attention.
+    """
+    if not self.cross_attention:
+      return ()
+    enc = self.enc_ln(enc)
+    if not self.cross_mha._built_from_signature:  # pylint: disable=protected-access
+      self.cross_mha._build_from_signature(  # pylint: disable=protected-access
+          query=tf.TensorShape([None, None, self.dim]), value=enc)
+    key = self.cross_mha._key_dense(enc)  # pylint: disable=protected-access
+    value = self.cross_mha._value_dense(enc)  # pylint: disable=protected-access
+    return (key, value)
+
+  def infer(self, x, cross_kv, kv_cache, mask_self, cache_mask=None):
+    """Incremental (non-training) forward pass with projected kv caching.
+
+    Args:
+      x: `float` inputs of the current step(s) in (bsz, seq, d).
+      cross_kv: a tuple of projected cross-attention (key, value) from
+        `project_cross_kv`, each in (bsz', seq', heads, head_dim), where bsz is
+        a multiple of bsz' (see `_attend`).
+      kv_cache: None or a tuple of cached (key, value) of previous steps, each
+        in (bsz, cache_size, heads, head_dim).
+      mask_self: self-attention mask of (1, 1, seq, seq) among the inputs.
+      cache_mask: optional mask of (bsz, 1, seq, cache_size) for attending to
+        the cache, e.g. for sequences at different steps. Default to attending
+        to the whole cache.
+
+    Returns:
+      x: `float` outputs in (bsz, seq, d).
+      kv: a tuple of projected (key, value) of the current step(s), each in
+        (bsz, seq, heads, head_dim), to be appended to the cache.
+    """
+    kv = ()
+    if self.self_attention:
+      x_ln = self.self_ln(x)
+      if not self.self_mha._built_from_signature:  # pylint: disable=protected-access
+        self.self_mha._build_from_signature(query=x_ln, value=x_ln)  # pylint: disable=protected-access
+      key = self.self_mha._key_dense(x_ln)  # pylint: disable=protected-access
+      value = self.self_mha._value_dense(x_ln)  # pylint: disable=protected-access
+      kv = (key, value)
+      if kv_cache is not None:
+        q_size, k_size = tf.shape(x)[1], tf.shape(kv_cache[0])[1]
+        if cache_mask is None:
+          cache_mask = tf.ones([1, 1, q_size, k_size], mask_self.dtype)
+        else:
+          mask_self = tf.broadcast_to(mask_self, tf.concat(
+              [tf.shape(cache_mask)[:-1], tf.shape(mask_self)[-1:]], 0))
+        mask_self = tf.concat([cache_mask, mask_self], -1)
+        key = tf.concat([kv_cache[0], key], axis=1)
+        value = tf.concat([kv_cache[1], value], axis=1)
+      x_res = self._attend(self.self_mha, x_ln, key, value, mask_self)
+      x = x + x_res
+    if self.cross_attention:
+      x_ln = self.cross_ln(x)
+      x = x + self._attend(
+          self.cross_mha, x_ln, cross_kv[0], cross_kv[1], None)
+    if self.use_mlp:
+      x = self.mlp(x, training=False)
+    return x, kv
+
 
 class TransformerDecoder(tf.keras.layers.Layer):  # pylint: disable=missing-docstring
 
@@ -575,9 +908,11 @@ class TransformerDecoder(tf.keras.layers.Layer):  # pylint: disable=missing-docs
                use_enc_ln=False,
                use_ffn_ln=False,
                ln_scale_shift=True,
+               remat_policy='none',
                **kwargs):
     super(TransformerDecoder, self).__init__(**kwargs)
     self.num_layers = num_layers
+    self.remat_groups = get_remat_groups(num_layers, remat_policy, drop_att)
     self.dec_layers = [
         TransformerDecoderLayer(  # pylint: disable=g-complex-comprehension
             dim,
@@ -599,15 +934,50 @@ class TransformerDecoder(tf.keras.layers.Layer):  # pylint: disable=missing-docs
 
   def call(self, x, enc, caches, mask_self, mask_cross, training):
     """x in (bsz, seq, d), enc in (bsz, seq', d)."""
-    presents = []
-    for i in range(self.num_layers):
+    def layer_fn(i, x, *enc):
       cache = None if caches is None else caches[i]
-      x, x_for_cache = self.dec_layers[i](
-          x, enc, cache, mask_self, mask_cross, training)
-      presents.append(x_for_cache)
-
+      return self.dec_layers[i](
+          x, enc[0] if enc else None, cache, mask_self, mask_cross, training)
+
+    remat_groups = self.remat_groups if training and caches is None and all(
+        l.built for l in self.dec_layers) else None
+    x, presents = remat.call_layers(
+        layer_fn, self.num_layers, remat_groups, x,
+        *([] if enc is None else [enc]))
     return x, tf.stack(presents)
 
+  def project_cross_kv(self, enc):
+    """Returns a tuple of per-layer projected cross-attention (key, value)."""
+    return tuple(layer.project_cross_kv(enc) for layer in self.dec_layers)
+
+  def infer(self, x, cross_kv, kv_caches, mask_self, cache_mask=None):
+    """Incremental forward pass given projected kv caches of previous steps.
+
+    Args:
+      x: `float` inputs of the current step(s) in (bsz, seq, d).
+      cross_kv: per-layer projected cross-attention (key, value) returned by
+        `project_cross_kv`.
+      kv_caches: None or a tuple of (key, value) caches, each in
+        (num_layers, bsz, cache_size, heads, head_dim).
+      mask_self: self-attention mask of (1, 1, seq, seq) among the inputs.
+      cache_mask: optional mask of (bsz, 1, seq, cache_size) for attending to
+        the caches, see `TransformerDecoderLayer.infer`.
+
+    Returns:
+      x: `float` outputs in (bsz, seq, d).
+      kv: a tuple of projected (key, value) of the current step(s), each in
+        (num_layers, bsz, seq, heads, head_dim).
+    """
+    keys, values = [], []
+    for i in range(self.num_layers):
+      kv_cache = None if kv_caches is None else (
+          kv_caches[0][i], kv_caches[1][i])
+      x, (key, value) = self.dec_layers[i].infer(
+          x, cross_kv[i], kv_cache, mask_self, cache_mask)
+      keys.append(key)
+      values.append(value)
+    return x, (tf.stack(keys), tf.stack(values))
+
 
 class VisionTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docstring
 
@@ -624,6 +994,7 @@ class VisionTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
                drop_att=0.,
                pos_encoding='learned',
                use_cls_token=True,
+               remat_policy='none',
                **kwargs):
     super(VisionTransformer, self).__init__(**kwargs)
     self.use_cls_token = use_cls_token
@@ -639,10 +1010,14 @@ class VisionTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
     add_vis_pos_emb(self, pos_encoding, self.n_rows, self.n_cols, dim)
     self.transformer_encoder = TransformerEncoder(
         num_layers, dim, mlp_ratio, num_heads, drop_path, drop_units, drop_att,
-        name='transformer_encoder')
+        remat_policy=remat_policy, name='transformer_encoder')
     self.output_ln = tf.keras.layers.LayerNormalization(
         epsilon=1e-6, name='ouput_ln')
 
+  def get_grid_size(self, height, width):
+    """Returns rows and columns of encoded images of (height, width)."""
+    return height // self.patch_size, width // self.patch_size
+
   def call(self, images, training, ret_list=False):
     """Input images of (bsz, h, w, c)."""
     tokens = self.stem_conv(images)
@@ -651,7 +1026,10 @@ class VisionTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
     # tf.print('tokens', tokens.shape)
     # tf.print('images', images.shape)
 
-    tokens = tokens + tf.expand_dims(self.vis_pos_emb, 0)
+    vis_pos_emb = interpolate_vis_pos_emb(
+        self.vis_pos_emb, self.n_rows, self.n_cols, h, w)
+    tokens = tokens + tf.expand_dims(
+        tf.cast(vis_pos_emb, self.compute_dtype), 0)
     if self.use_cls_token:
       cls_token = tf.tile(tf.expand_dims(self.cls_token_emb, 0), [bsz, 1, 1])
       tokens = tf.concat([cls_token, tokens], 1)
@@ -680,6 +1058,7 @@ class ResNetTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
                drop_att=0.,
                pos_encoding='learned',
                use_cls_token=True,
+               remat_policy='none',
                **kwargs):
     super(ResNetTransformer, self).__init__(**kwargs)
     self.use_cls_token = use_cls_token
@@ -687,7 +1066,8 @@ class ResNetTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
         resnet_depth=resnet_depth,
         width_multiplier=resnet_width_multiplier,
         sk_ratio=resnet_sk_ratio,
-        variant=resnet_variant)
+        variant=resnet_variant,
+        remat_policy=remat_policy)
     self.dropout = tf.keras.layers.Dropout(drop_units)
     self.stem_projection = tf.keras.layers.Dense(dim, name='stem_projection')
     self.stem_ln = tf.keras.layers.LayerNormalization(
@@ -703,12 +1083,17 @@ class ResNetTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
     self.n_rows = math.ceil(image_height / factor)
     self.n_cols = math.ceil(image_width / factor)
     add_vis_pos_emb(self, pos_encoding, self.n_rows, self.n_cols, dim)
+    self.stride = int(factor)
     self.transformer_encoder = TransformerEncoder(
         num_layers, dim, mlp_ratio, num_heads, drop_path, drop_units, drop_att,
-        name='transformer_encoder')
+        remat_policy=remat_policy, name='transformer_encoder')
     self.output_ln = tf.keras.layers.LayerNormalization(
         epsilon=1e-6, name='ouput_ln')
 
+  def get_grid_size(self, height, width):
+    """Returns rows and columns of encoded images of (height, width)."""
+    return -(-height // self.stride), -(-width // self.stride)
+
   def call(self, images, training, ret_list=False):
     """Input images of (bsz, h, w, c)."""
     hidden_stack, _ = self.resnet(images, training)
@@ -717,7 +1102,10 @@ class ResNetTransformer(tf.keras.layers.Layer):  # pylint: disable=missing-docst
     tokens = tf.reshape(tokens, [bsz, h * w, num_channels])
     tokens = self.stem_ln(self.stem_projection(self.dropout(tokens, training)))
 
-    tokens = tokens + tf.expand_dims(self.vis_pos_emb, 0)
+    vis_pos_emb = interpolate_vis_pos_emb(
+        self.vis_pos_emb, self.n_rows, self.n_cols, h, w)
+    tokens = tokens + tf.expand_dims(
+        tf.cast(vis_pos_emb, self.compute_dtype), 0)
     if self.use_cls_token:
       cls_token = tf.tile(tf.expand_dims(self.cls_token_emb, 0), [bsz, 1, 1])
       tokens = tf.concat([cls_token, tokens], 1)
@@ -743,23 +1131,39 @@ class AutoregressiveDecoder(tf.keras.layers.Layer):  # pylint: disable=missing-d
                pos_encoding='learned',
                shared_embedding=True,
                output_bias=True,
+               attention_window=0,
+               attention_window_period=1,
+               window_prompt_len=1,
+               remat_policy='none',
                **kwargs):
     super(AutoregressiveDecoder, self).__init__(**kwargs)
     self.vocab_size = vocab_size
     self.max_seq_len = max_seq_len
     self.num_layers = num_layers
     self.dim = dim
+    self.num_heads = num_heads
     self.shared_embedding = shared_embedding
     self.output_bias = output_bias
+    # If attention_window > 0, tokens after the prompt (of window_prompt_len
+    # tokens in training) only attend to the prompt and a sliding window of
+    # previous tokens, see `get_self_mask`.
+    self.attention_window = attention_window
+    self.attention_window_period = attention_window_period
+    self.window_prompt_len = window_prompt_len
+    # Whether decoding keeps static shapes for XLA compilation, by attending to
+    # whole (masked) caches rather than to their filled part.
+    self.static_shapes = False
     add_seq_pos_emb(self, pos_encoding, max_seq_len, dim)
     add_vocab_token_emb(self, vocab_size, dim, shared_embedding, output_bias)
     self.decoder = TransformerDecoder(
         num_layers, dim, mlp_ratio, num_heads,
-        drop_path, drop_units, drop_att, name='transformer_decoder')
+        drop_path, drop_units, drop_att, remat_policy=remat_policy,
+        name='transformer_decoder')
     self.output_ln = tf.keras.layers.LayerNormalization(
         epsilon=1e-6, name='ouput_ln')
 
-  def call(self, tokens, encoded, training):
+  def call(self, tokens, encoded, training, segment_ids=None, positions=None,
+           mask_cross=None, project=True):
     """Teacher-forced prediction.
 
     Args:
@@ -767,41 +1171,230 @@ class AutoregressiveDecoder(tf.keras.layers.Layer):  # pylint: disable=missing-d
       encoded: `float` encoded representations for conditioning with shape of
         (bsz, size, dim). This can be optional in case of pure decoder.
       training: `boolean` indicator for training vs test mode.
+      segment_ids: optional `int` of (bsz, seqlen) for rows of multiple
+        sequences (see `model_utils.pack_sequences`), where tokens only attend
+        to previous tokens of the same segment.
+      positions: optional `int` positions of tokens of (bsz, seqlen) for their
+        positional embeddings. Default to range(seqlen).
+      mask_cross: optional cross-attention mask of (bsz, 1, seqlen, size).
+      project: `bool`, whether to project outputs to logits. If False, the
+        (normalized) outputs are returned to be projected by the caller (see
+        `get_output_projection`).
 
     Returns:
-      logits of `float` with shape of (bsz, seqlen, vocab_size)
+      logits of `float` with shape of (bsz, seqlen, vocab_size), or outputs of
+      (bsz, seqlen, dim) if not project.
     """
     _, seqlen = get_shape(tokens)
-    seq_pos_emb = tf.expand_dims(self.seq_pos_emb[:seqlen], 0)
+    seq_pos_emb = tf.cast(self.seq_pos_emb, self.compute_dtype)
+    if positions is None:
+      seq_pos_emb = tf.expand_dims(seq_pos_emb[:seqlen], 0)
+    else:
+      seq_pos_emb = tf.gather(seq_pos_emb, positions)
+    inp_embedding = read_weight(
+        self.token_embedding if self.shared_embedding else
+        self.inp_token_embedding, self.compute_dtype)
+    token_emb = tf.gather(inp_embedding, tokens) + seq_pos_emb
+    if segment_ids is None:
+      mask_self = self.get_self_mask(
+          seqlen, self.window_prompt_len, token_emb.dtype)
+    else:
+      self._check_full_attention('segment_ids')
+      # Block-diagonal causal mask of the segments.
+      same_segment = tf.equal(
+          segment_ids[:, tf.newaxis, :, tf.newaxis],
+          segment_ids[:, tf.newaxis, tf.newaxis, :])
+      mask_self = (1. - get_ar_mask(seqlen, token_emb.dtype)) * tf.cast(
+          same_segment, token_emb.dtype)
+    outputs, _ = self.decoder(
+        token_emb, encoded, None, mask_self, mask_cross, training)
+    outputs = self.output_ln(outputs)
+    if not project:
+      return outputs
+    outp_embedding, outp_bias = self.get_output_projection()
+    logits = tf.matmul(outputs, outp_embedding, transpose_b=True)
+    if outp_bias is not None:
+      logits = tf.nn.bias_add(logits, outp_bias)
+    return tf.cast(logits, tf.float32)
+
+  def get_output_projection(self):
+    """Returns output token embedding and bias (or None) in compute dtype."""
+    outp_embedding = read_weight(
+        self.token_embedding if self.shared_embedding else
+        self.outp_token_embedding, self.compute_dtype)
+    outp_bias = None
+    if self.output_bias:
+      outp_bias = tf.cast(self.outp_bias, self.compute_dtype)
+    return outp_embedding, outp_bias
+
+  def get_self_mask(self, seq_len, prompt_len, dtype):
+    """Returns the self-attention mask of (1, 1, seq_len, seq_len).
+
+    The mask is causal. With `attention_window`, the prompt (the first
+    prompt_len tokens) is attended to by all positions, while the following
+    positions only attend to a sliding window of each other (see
+    `get_sliding_ar_mask`), e.g. to the last attention_window // period objects
+    for attention_window_period of the object length.
+
+    Args:
+      seq_len: `int` sequence length.
+      prompt_len: `int` prompt length.
+      dtype: tf data type for the return tensor.
+
+    Returns:
+      tensor with ones for locations to be attended to.
+    """
+    if not self.attention_window:
+      return 1. - get_ar_mask(seq_len, dtype)
+    return 1. - merge_masks(
+        get_ar_mask(prompt_len, dtype),
+        get_sliding_ar_mask(seq_len - prompt_len, self.attention_window,
+                            self.attention_window_period, dtype))
+
+  def _read_caches(self, k_caches, v_caches, step, seq_len=1):
+    """Returns caches for attending to positions [0, step) and their mask.
+
+    Args:
+      k_caches: key caches in (num_layers, bsz, cache_size, heads, head_dim).
+      v_caches: value caches of the same shape.
+      step: `int` scalar tensor.
+      seq_len: `int` number of positions decoded at step.
+
+    Returns:
+      caches[:, :, :step] and None, or with `static_shapes`, whole caches and a
+      cache_mask of (1, 1, seq_len, cache_size) (see `TransformerDecoder.infer`).
+    """
+    if not self.static_shapes:
+      return (k_caches[:, :, :step], v_caches[:, :, :step]), None
+    cache_size = get_shape(k_caches)[2]
+    cache_mask = tf.sequence_mask(step, cache_size, self.compute_dtype)
+    cache_mask = tf.tile(cache_mask[tf.newaxis, tf.newaxis, tf.newaxis],
+                         [1, 1, seq_len, 1])
+    return (k_caches, v_caches), cache_mask
+
+  def _check_full_attention(self, method):
+    if self.attention_window:
+      raise ValueError('%s does not support attention_window.' % method)
+
+  def project_cross_kv(self, encoded):
+    """Projects encoded into per-layer cross-attention keys / values.
+
+    Args:
+      encoded: `float` encoded representations with shape of (bsz, size, dim).
+
+    Returns:
+      a tuple of per-layer (key, value), each in (bsz, size, heads, head_dim),
+      which can be passed to `infer` as `cross_kv` for any number of decoding
+      calls on the same encoded representations.
+    """
+    return self.decoder.project_cross_kv(encoded)
+
+  def _get_embeddings(self):
+    """Returns (input token, output token, positional) embeddings to decode.
+
+    Input token and positional embeddings are in the compute dtype of the
+    decoder, while output token embeddings are in float32 so that logits (and
+    thus softmax and sampling) are computed in float32.
+    """
     if self.shared_embedding:
       inp_embedding = outp_embedding = self.token_embedding
     else:
       inp_embedding = self.inp_token_embedding
       outp_embedding = self.outp_token_embedding
+    return (read_weight(inp_embedding, self.compute_dtype),
+            read_weight(outp_embedding, tf.float32),
+            tf.cast(self.seq_pos_emb, self.compute_dtype))
 
-    token_emb = tf.gather(inp_embedding, tokens) + seq_pos_emb
-    mask_self = 1. - get_ar_mask(seqlen, token_emb.dtype)
-    outputs, _ = self.decoder(
-        token_emb, encoded, None, mask_self, None, training)
-    outputs = self.output_ln(outputs)
+  def _next_logits(self, x, cross_kv, kv_caches, mask_self, last_only=True,
+                   cache_mask=None):
+    """Decodes x of (bsz, seq, d) and returns logits of the last position.
+
+    Logits of all positions in (bsz, seq, vocab_size) are returned instead if
+    not `last_only`.
+    """
+    _, outp_embedding, _ = self._get_embeddings()
+    outputs, kv = self.decoder.infer(
+        x, cross_kv, kv_caches, mask_self, cache_mask)
+    outputs = tf.cast(self.output_ln(outputs), tf.float32)
+    next_logits = tf.matmul(outputs, outp_embedding, transpose_b=True)
+    if last_only:  # only take the last for sampling next token.
+      next_logits = next_logits[:, -1]
+    if self.output_bias:
+      next_logits = tf.nn.bias_add(next_logits, self.outp_bias)
+    return next_logits, kv
+
+  def _score(self, prompt, tokens, cross_kv, logits_mode):
+    """Returns logits of the given generated tokens as in `infer`.
+
+    This runs a single teacher-forced pass over the prompt and the generated
+    tokens, e.g. to get logits of the selected hypotheses from beam search.
+    Logits after the padding / ending token (0) are zero, as in `infer`.
+
+    Args:
+      prompt: `int` tokens with shape of (bsz, prompt_len).
+      tokens: `int` generated tokens with shape of (bsz, out_len).
+      cross_kv: per-layer projected cross-attention (key, value).
+      logits_mode: what to keep of the logits, see `infer`.
+
+    Returns:
+      logits of tokens, in the shape given by `logits_mode`.
+    """
+    _, prompt_len = get_shape(prompt)
+    _, out_len = get_shape(tokens)
+    inp_embedding, outp_embedding, seq_pos_emb = self._get_embeddings()
+    seq = tf.concat([prompt, tokens[:, :-1]], 1)
+    seq_len = prompt_len + out_len - 1
+    x = tf.gather(inp_embedding, seq) + seq_pos_emb[tf.newaxis, :seq_len]
+    mask_self = self.get_self_mask(seq_len, prompt_len, x.dtype)
+    outputs, _ = self.decoder.infer(x, cross_kv, None, mask_self)
+    outputs = tf.cast(self.output_ln(outputs), tf.float32)
+    outputs = outputs[:, prompt_len - 1:]  # (bsz, out_len, d)
+    # Positions after the (first) padding / ending token are not generated.
+    ended = tf.cumsum(
+        tf.cast(tf.equal(tokens, 0), tf.int32), axis=1, exclusive=True) > 0
+    if isinstance(logits_mode, dict):
+      period = logits_mode.get('period', 1)
+      offsets = list(logits_mode.get('offsets', range(period)))
+      num_periods = out_len // period
+      def select(t):  # Keep positions p with p % period in offsets.
+        t = t[:, :num_periods * period]
+        t = tf.reshape(t, [-1, num_periods, period] + get_shape(t)[2:])
+        t = tf.gather(t, offsets, axis=2)
+        return tf.reshape(t, [-1, num_periods * len(offsets)] + get_shape(t)[3:])
+      outputs, ended = select(outputs), select(ended)
     logits = tf.matmul(outputs, outp_embedding, transpose_b=True)
     if self.output_bias:
       logits = tf.nn.bias_add(logits, self.outp_bias)
-    return logits
+    logits = tf.where(ended[..., tf.newaxis], tf.zeros_like(logits), logits)
+    if logits_mode == 'full':
+      return logits
+    log_probs = tf.nn.log_softmax(logits)
+    if logits_mode == 'token':
+      return tf.gather(log_probs, tokens, batch_dims=2)
+    vocab_start, vocab_end = logits_mode.get(
+        'vocab_range', (0, self.vocab_size))
+    return log_probs[..., vocab_start:vocab_end]
 
   def infer(self, prompt, encoded, max_seq_len=None,
-            temperature=1.0, top_k=1, top_p=1.0, sampling_callback=None):
+            temperature=1.0, top_k=1, top_p=1.0, sampling_callback=None,
+            cross_kv=None, early_stop=None, logits_mode='full',
+            token_mask=None, cross_kv_index=None, top_p_candidates=None):
     """Autoregressive (without teacher-forcing) prediction.
 
-    Note: the autoregressive sampling/inference time can be further optimized by
-    caching *transformed* key / value inside multi-head attention for the
-    `encoded` and previously generated tokens, but this may make the code less
-    readable.
+    Note: the *transformed* (projected) keys / values of self-attention are
+    cached for previously generated tokens, so each step only projects the
+    newly generated token. Cross-attention keys / values are projected once
+    before decoding (or given by `cross_kv`). With `attention_window`, caches of
+    generated tokens are ring buffers of the window, so that their size (and
+    the cost per step) does not depend on max_seq_len.
 
     Args:
       prompt: `int` tokens with shape of (bsz, prompt_len).
       encoded: `float` encoded representations for conditioning with shape of
-        (bsz, size, dim). This can be optional in case of pure decoder.
+        (bsz', size, dim), where bsz is a multiple of bsz' and each consecutive
+        group of bsz // bsz' prompts shares the same encoded representations
+        (unless `cross_kv_index` is given). This can be optional in case of
+        pure decoder or if `cross_kv` is given.
       max_seq_len: `int` of max generated sequence length (including prompt).
       temperature: `float` scalar for scaling the logits before sampling.
       top_k: `int` scalar for truncating top-k tokens according to logits before
@@ -811,95 +1404,554 @@ class AutoregressiveDecoder(tf.keras.layers.Layer):  # pylint: disable=missing-d
       sampling_callback: a callbak `function` that take `next_logits`, and
         return `next_token`. This is used when users need a specific logic
         for sampling. Default to `None` with standard free-form sampling.
+        Note that with `early_stop='compact'`, `next_logits` only covers the
+        remaining active sequences.
+      cross_kv: optional projected cross-attention keys / values of `encoded`
+        from `project_cross_kv`, which skips the projection of `encoded`.
+      early_stop: `None`, 'stop' or 'compact'. If not `None`, a sequence is
+        finished once it generates the padding / ending token (0), after which
+        it only gets padding tokens and zero logits, and decoding stops when all
+        sequences are finished. With 'compact', the batch is also shrunk (in
+        halves, so shapes stay static) as sequences finish, so finished
+        sequences are no longer fed through the decoder. Compaction requires
+        static batch sizes, and falls back to 'stop' otherwise.
+      logits_mode: what to keep of the logits at each generated position, one
+        of 'full' for the logits, 'token' for the log-probability of the sampled
+        token, or a `dict` for log-probabilities (normalized over the full
+        vocab) with optional keys `period` and `offsets` (only keep positions p
+        with p % period in offsets, for complete periods), and `vocab_range`
+        (a (start, end) tuple for only keeping tokens in [start, end)).
+      token_mask: optional `bool` allowed tokens of (period, vocab_size), where
+        generated position p can only sample tokens allowed in
+        token_mask[p % period] (returned logits are not masked), or the
+        equivalent additive `float` bias (e.g. from a `SequenceGrammar`).
+        Sequences are finished (and padded) once generating the padding /
+        ending token (0).
+      cross_kv_index: optional `int` of (bsz,), the row of `encoded` (or
+        `cross_kv`) that each prompt is conditioned on, for any bsz and bsz'.
+        This shares encoded representations among prompts by index rather than
+        by consecutive groups, e.g. for a subset of instances of a batch of
+        images. Projected cross-attention keys / values are gathered by index
+        once before decoding (and once per compaction with early_stop), not at
+        every step.
+      top_p_candidates: `int` number of largest logits to find the top-p set
+        in (0 for sorting all logits), see `top_logits`.
 
     Returns:
       sampled tokens with shape of (bsz, max_seq_len-prompt_len).
       logits (temperature-scaled) associated with sampled token, in shape of
-        (bsz, max_seq_len-prompt_len, vocab_size).
+        (bsz, max_seq_len-prompt_len, vocab_size) for `logits_mode='full'`,
+        (bsz, max_seq_len-prompt_len) for 'token', or
+        (bsz, kept_positions, kept_vocab_size) for a `dict` logits_mode.
     """
+    if early_stop not in [None, 'stop', 'compact']:
+      raise ValueError('Unknown early_stop %s' % early_stop)
     bsz, prompt_len = get_shape(prompt)
     seq_len = self.max_seq_len if max_seq_len is None else max_seq_len
-    seq_pos_emb = tf.expand_dims(self.seq_pos_emb, 0)
-    if self.shared_embedding:
-      inp_embedding = outp_embedding = self.token_embedding
+    inp_embedding, _, seq_pos_emb = self._get_embeddings()
+    seq_pos_emb = tf.expand_dims(seq_pos_emb, 0)
+    track_finished = early_stop or token_mask is not None
+    if cross_kv is None:
+      cross_kv = self.project_cross_kv(encoded)
+    if token_mask is not None:
+      token_bias = token_mask_to_bias(token_mask)
+    window, period = self.attention_window, self.attention_window_period
+    if window:
+      # Ring buffer of generated tokens that holds the window of any position.
+      ring_size = min(window + period - 1, max(seq_len - prompt_len - 1, 1))
+      cache_size = prompt_len + ring_size
     else:
-      inp_embedding = self.inp_token_embedding
-      outp_embedding = self.outp_token_embedding
+      cache_size = seq_len - 1
+
+    def window_cache_mask(gen_step, dtype):
+      """Mask of (1, 1, 1, cache_size) for generated token gen_step."""
+      # The last generated token (if any) held by each ring slot.
+      slot_steps = gen_step - 1 - tf.math.floormod(
+          gen_step - 1 - tf.range(ring_size), ring_size)
+      valid = tf.greater_equal(
+          slot_steps, tf.maximum(gen_step // period * period - window, 0))
+      return tf.reshape(
+          tf.concat([tf.ones([prompt_len], dtype), tf.cast(valid, dtype)], 0),
+          [1, 1, 1, cache_size])
+
+    # Buffers (indexed by kept slot, see `logits_mode`) for the kept part of
+    # logits. Positions that are not generated (with early_stop) have zero
+    # logits, i.e. uniform log-probs.
+    out_len = seq_len - prompt_len
+    num_kept, kept_shape, init_value, get_logits_update = kept_logits_spec(
+        logits_mode, out_len, self.vocab_size)
+    # The extra last slot collects (and drops) positions that are not kept.
+    logits_var = tf.fill([num_kept + 1, bsz] + kept_shape, init_value)
 
     # Each step reads caches[:step] and tokens[step:next_step] and updates
     # tokens[next_step], logits[next_step] and caches[step:next_step].
     # On the first step, step=0, next_step=prompt_len. On subsequent steps
     # next_step = step + 1.
-    def loop_body(step, caches, tokens, logits, is_prompt=False):
+    # Caches hold projected self-attention keys / values of shape
+    # (num_layers, cur_bsz, cache_size, heads, head_dim) in the compute dtype,
+    # updated in place. The (seq, heads) order matches the layout used by
+    # MultiHeadAttention so the cached path is numerically identical to
+    # recomputing the projections. With attention_window, the prompt is cached
+    # first, followed by the ring buffer of generated tokens.
+    # The current batch holds the sequences `rows` (indices into the full
+    # batch), which is always the full batch unless it is compacted. Tokens and
+    # logits are kept for the full batch.
+    def loop_body(step, rows, finished, k_caches, v_caches, tokens, logits,
+                  cross_kv, is_prompt=False):
       if is_prompt:
         assert step == 0
         x = tf.gather(inp_embedding, tf.transpose(tokens[:prompt_len]))
         x = x + seq_pos_emb[:, :prompt_len]  # (bsz, prompt_len, d)
         mask_self = 1. - get_ar_mask(prompt_len, x.dtype)
-        caches_in = None
+        kv_caches_in = cache_mask = None
+        cache_index = step
       else:
-        x = tf.gather(inp_embedding, tf.transpose(tokens[step]))
-        x = x + seq_pos_emb[:, step]  # (bsz, d)
-        x = tf.expand_dims(x, 1)  # (bsz, 1, d)
-        mask_self = tf.ones([1, 1, 1, 1])
-        caches_in = tf.transpose(caches[:step], [1, 2, 0, 3])
-      outputs, caches_out = self.decoder(
-          x, encoded, caches_in, mask_self, None, training=False)
-      outputs = self.output_ln(outputs)
-      next_logits = tf.matmul(  # only take the last for sampling next token.
-          outputs, outp_embedding, transpose_b=True)[:, -1]
-      if self.output_bias:
-        next_logits = tf.nn.bias_add(next_logits, self.outp_bias)
+        x = tf.gather(inp_embedding, tf.gather(tokens[step], rows))
+        x = x + seq_pos_emb[:, step]  # (cur_bsz, d)
+        x = tf.expand_dims(x, 1)  # (cur_bsz, 1, d)
+        mask_self = tf.ones([1, 1, 1, 1], x.dtype)
+        if window:
+          kv_caches_in = (k_caches, v_caches)
+          cache_mask = window_cache_mask(step - prompt_len, x.dtype)
+          cache_index = prompt_len + tf.math.floormod(
+              step - prompt_len, ring_size)
+        else:
+          kv_caches_in, cache_mask = self._read_caches(
+              k_caches, v_caches, step)
+          cache_index = step
+      next_logits, (k_out, v_out) = self._next_logits(
+          x, cross_kv, kv_caches_in, mask_self, cache_mask=cache_mask)
+      next_step = step + (prompt_len if is_prompt else 1)
 
       # Scale and trunctate logits and sample next token.
+      sampling_logits = next_logits
+      if token_mask is not None:
+        sampling_logits = mask_disallowed_tokens(
+            sampling_logits, token_bias, next_step - prompt_len)
       if sampling_callback:
         next_token = sampling_callback(
-            next_logits, step, temperature, top_k, top_p)
+            sampling_logits, step, temperature, top_k, top_p)
       else:
-        sampling_logits = next_logits / tf.cast(temperature, tf.float32)
-        sampling_logits = top_logits(sampling_logits, k=top_k, p=top_p)
+        sampling_logits = sampling_logits / tf.cast(temperature, tf.float32)
+        sampling_logits = top_logits(
+            sampling_logits, k=top_k, p=top_p,
+            num_candidates=top_p_candidates, xla=self.static_shapes)
         next_token = tf.random.categorical(
             sampling_logits, num_samples=1, dtype=tf.int32)[:, 0]
+      next_token = tf.cast(next_token, tokens.dtype)
+      if track_finished:
+        next_token = tf.where(finished, tf.zeros_like(next_token), next_token)
+        next_logits = tf.where(
+            finished[:, tf.newaxis], tf.zeros_like(next_logits), next_logits)
+        finished = tf.logical_or(finished, tf.equal(next_token, 0))
 
       # Update internal states.
-      next_step = step + (prompt_len if is_prompt else 1)
-      caches_out = tf.transpose(caches_out, [2, 0, 1, 3])
-      # TODO(srbs): We could merge these two branches by using
-      # tf.tensor_scatter_nd_update(caches, tf.range(start, next_ste), ...)
-      # but tf.range is not supported on TPU. If we could directly
-      # use XLA's DynamicUpdateSlice here this wouldn't be a problem but that
-      # is not exposed via TF's API.
+      k_caches = update_slice(
+          k_caches, k_out, cache_index, axis=2, xla=self.static_shapes)
+      v_caches = update_slice(
+          v_caches, v_out, cache_index, axis=2, xla=self.static_shapes)
+      indices = tf.stack([tf.fill(tf.shape(rows), next_step), rows], -1)
+      tokens = tf.tensor_scatter_nd_update(tokens, indices, next_token)
+      logits_index, logits_update = get_logits_update(
+          next_step - prompt_len, next_logits, next_token)
+      indices = tf.stack([tf.fill(tf.shape(rows), logits_index), rows], -1)
+      logits = tf.tensor_scatter_nd_update(logits, indices, logits_update)
+      return (next_step, rows, finished, k_caches, v_caches, tokens, logits)
+
+    def cond(step, rows, finished, k_caches, v_caches, tokens, logits,
+             min_active=0):
+      del rows
+      del k_caches
+      del v_caches
+      del tokens
+      del logits
+      if not early_stop:
+        return tf.less(step, seq_len-1)
+      num_active = tf.reduce_sum(tf.cast(tf.logical_not(finished), tf.int32))
+      return tf.logical_and(tf.less(step, seq_len-1),
+                            tf.greater(num_active, min_active))
+
+    head_dim = self.dim // self.num_heads
+    k_caches_var = tf.zeros(
+        [self.num_layers, bsz, cache_size, self.num_heads, head_dim],
+        self.compute_dtype)
+    v_caches_var = tf.zeros(
+        [self.num_layers, bsz, cache_size, self.num_heads, head_dim],
+        self.compute_dtype)
+    tokens_var = tf.concat([
+        tf.cast(tf.transpose(prompt, [1, 0]), tf.int64),
+        tf.zeros([seq_len - prompt_len, bsz], dtype=tf.int64)], 0)
+    rows = tf.range(bsz)
+    finished = tf.zeros([bsz], tf.bool)
+
+    # With cross_kv_index, the rows of cross_kv that prompts attend to are
+    # gathered before (rather than in) the decoding loops.
+    step_cross_kv = cross_kv
+    if cross_kv_index is not None:
+      step_cross_kv = tf.nest.map_structure(
+          functools.partial(tf.gather, indices=cross_kv_index), cross_kv)
+    state = loop_body(
+        0, rows, finished, k_caches_var, v_caches_var, tokens_var, logits_var,
+        step_cross_kv, is_prompt=True)
+    if seq_len > prompt_len:
+      # Batch sizes of the successive decoding loops. Each loop runs until the
+      # number of active sequences fits into the next batch size. For grouped
+      # sequences sharing cross_kv, only compact below the number of groups so
+      # that the gathered cross_kv are no larger than the original ones. With
+      # cross_kv_index, cross_kv are gathered by the index of active rows.
+      kv_bsz = get_shape(tf.nest.flatten(cross_kv)[0])[0]
+      if cross_kv_index is not None:
+        kv_bsz = bsz
+      bsz_list = [bsz]
+      if (early_stop == 'compact' and isinstance(bsz, int) and
+          isinstance(kv_bsz, int)):
+        group_size = bsz // kv_bsz
+        cur_bsz = min(bsz // 2, kv_bsz)
+        while cur_bsz >= 1:
+          bsz_list.append(cur_bsz)
+          cur_bsz //= 2
+      for i, cur_bsz in enumerate(bsz_list):
+        if i > 0:
+          # Keep active sequences first (argsort is stable), then fill with
+          # finished ones.
+          _, rows, finished, k_caches_var, v_caches_var, _, _ = state
+          slots = tf.argsort(tf.cast(finished, tf.int32), stable=True)
+          slots = slots[:cur_bsz]
+          rows = tf.gather(rows, slots)
+          kv_rows = (rows // group_size if cross_kv_index is None
+                     else tf.gather(cross_kv_index, rows))
+          cur_cross_kv = tf.nest.map_structure(
+              functools.partial(tf.gather, indices=kv_rows), cross_kv)
+          state = (state[0], rows, tf.gather(finished, slots),
+                   tf.gather(k_caches_var, slots, axis=1),
+                   tf.gather(v_caches_var, slots, axis=1),
+                   state[5], state[6])
+        else:
+          cur_cross_kv = step_cross_kv
+        min_active = bsz_list[i + 1] if i + 1 < len(bsz_list) else 0
+        state = tf.while_loop(
+            cond=functools.partial(cond, min_active=min_active),
+            body=functools.partial(loop_body, cross_kv=cur_cross_kv),
+            loop_vars=state)
+    tokens_var, logits_var = state[5], state[6]
+
+    sampled_tokens = tf.transpose(tokens_var[prompt_len:], [1, 0])
+    sampled_tokens_logits = tf.transpose(
+        logits_var[:num_kept], [1, 0] + list(range(2, 2 + len(kept_shape))))
+    return sampled_tokens, sampled_tokens_logits
+
+  def beam_search(self, prompt, encoded, max_seq_len=None, beam_size=4,
+                  length_penalty=0., cross_kv=None, logits_mode='full',
+                  token_mask=None):
+    """Autoregressive prediction with beam search.
+
+    Hypotheses are finished once they generate the padding / ending token (0),
+    after which they are only extended with padding tokens at no cost. Beams are
+    ranked by log-likelihood normalized with `length_penalty_factor` of the
+    hypothesis length (including the ending token). The projected
+    self-attention caches are reordered along with the beams.
+
+    Args:
+      prompt: `int` tokens with shape of (bsz, prompt_len).
+      encoded: `float` encoded representations for conditioning, see `infer`.
+      max_seq_len: `int` of max generated sequence length (including prompt).
+      beam_size: `int` number of hypotheses kept for each prompt.
+      length_penalty: `float` alpha of the length normalization. 0 for ranking
+        by log-likelihood only.
+      cross_kv: optional projected cross-attention keys / values of `encoded`
+        from `project_cross_kv`, which skips the projection of `encoded`.
+      logits_mode: what to keep of the logits, see `infer`.
+      token_mask: optional `bool` allowed tokens of (period, vocab_size) or the
+        equivalent additive bias, see `infer`.
+
+    Returns:
+      tokens of the best hypotheses with shape of (bsz, max_seq_len-prompt_len).
+      logits associated with the tokens, in the shape given by `logits_mode`.
+    """
+    self._check_full_attention('beam_search')
+    bsz, prompt_len = get_shape(prompt)
+    seq_len = self.max_seq_len if max_seq_len is None else max_seq_len
+    inp_embedding, _, seq_pos_emb = self._get_embeddings()
+    seq_pos_emb = tf.expand_dims(seq_pos_emb, 0)
+    if cross_kv is None:
+      cross_kv = self.project_cross_kv(encoded)
+    if token_mask is not None:
+      token_bias = token_mask_to_bias(token_mask)
+    # Beams of the same prompt are consecutive, so they share cross_kv groups.
+    beam_prompt = tf.repeat(prompt, beam_size, axis=0)
+    vocab_size = self.vocab_size
+    # Finished hypotheses can only be extended with padding at no cost.
+    pad_log_probs = tf.where(
+        tf.equal(tf.range(vocab_size), 0), 0., -1e10)[tf.newaxis]
+
+    # Same caching as `infer` for the (bsz * beam_size) hypotheses. Scores and
+    # lengths are in (bsz, beam_size).
+    def loop_body(step, k_caches, v_caches, tokens, scores, lengths, finished,
+                  is_prompt=False):
       if is_prompt:
-        caches = tf.tensor_scatter_nd_update(
-            caches,
-            tf.constant(list(range(prompt_len)))[:, tf.newaxis], caches_out)
+        x = tf.gather(inp_embedding, beam_prompt)
+        x = x + seq_pos_emb[:, :prompt_len]
+        mask_self = 1. - get_ar_mask(prompt_len, x.dtype)
+        kv_caches_in = cache_mask = None
       else:
-        caches = tf.tensor_scatter_nd_update(caches, [[step]], caches_out)
+        x = tf.gather(inp_embedding, tokens[step])
+        x = tf.expand_dims(x + seq_pos_emb[:, step], 1)
+        mask_self = tf.ones([1, 1, 1, 1], x.dtype)
+        kv_caches_in, cache_mask = self._read_caches(k_caches, v_caches, step)
+      next_logits, (k_out, v_out) = self._next_logits(
+          x, cross_kv, kv_caches_in, mask_self, cache_mask=cache_mask)
+      next_step = step + (prompt_len if is_prompt else 1)
+      log_probs = tf.nn.log_softmax(next_logits)
+      if token_mask is not None:
+        log_probs = mask_disallowed_tokens(
+            log_probs, token_bias, next_step - prompt_len)
+      log_probs = tf.where(finished[:, tf.newaxis], pad_log_probs, log_probs)
+
+      # Select the top hypotheses among all extensions of all beams.
+      candidates = scores[:, :, tf.newaxis] + tf.reshape(
+          log_probs, [bsz, beam_size, vocab_size])
+      candidate_lengths = lengths + tf.cast(
+          tf.logical_not(tf.reshape(finished, [bsz, beam_size])), tf.int32)
+      normalized = candidates / length_penalty_factor(
+          candidate_lengths, length_penalty)[:, :, tf.newaxis]
+      _, top_indices = tf.nn.top_k(
+          tf.reshape(normalized, [bsz, beam_size * vocab_size]), k=beam_size)
+      beam_indices = top_indices // vocab_size
+      next_token = tf.cast(top_indices % vocab_size, tokens.dtype)
+      scores = tf.gather(
+          tf.reshape(candidates, [bsz, beam_size * vocab_size]), top_indices,
+          batch_dims=1)
+      lengths = tf.gather(candidate_lengths, beam_indices, batch_dims=1)
+
+      # Reorder states by the source beams of the selected hypotheses.
+      src = tf.reshape(
+          tf.range(bsz)[:, tf.newaxis] * beam_size + beam_indices, [-1])
+      k_caches = tf.gather(
+          update_slice(k_caches, k_out, step, axis=2, xla=self.static_shapes),
+          src, axis=1)
+      v_caches = tf.gather(
+          update_slice(v_caches, v_out, step, axis=2, xla=self.static_shapes),
+          src, axis=1)
+      tokens = tf.gather(tokens, src, axis=1)
+      next_token = tf.reshape(next_token, [-1])
+      finished = tf.logical_or(
+          tf.gather(finished, src), tf.equal(next_token, 0))
       tokens = tf.tensor_scatter_nd_update(tokens, [[next_step]], [next_token])
-      logits = tf.tensor_scatter_nd_update(logits, [[next_step]], [next_logits])
-      return (next_step, caches, tokens, logits)
+      return (next_step, k_caches, v_caches, tokens, scores, lengths, finished)
 
-    def cond(step, caches, tokens, logits):
-      del caches
+    def cond(step, k_caches, v_caches, tokens, scores, lengths, finished):
+      del k_caches
+      del v_caches
       del tokens
-      del logits
-      return tf.less(step, seq_len-1)
-
-    caches_var = tf.zeros([seq_len-1, self.num_layers, bsz, self.dim])
-    tokens_var = tf.zeros([seq_len, bsz], dtype=tf.int64)
-    logits_var = tf.zeros([seq_len, bsz, self.vocab_size], dtype=tf.float32)
-    indices = tf.expand_dims(tf.range(prompt_len), -1)
-    tokens_var = tf.tensor_scatter_nd_update(
-        tokens_var, indices, tf.transpose(prompt, [1, 0]))
-
-    step = 0
-    step, caches_var, tokens_var, logits_var = loop_body(
-        step, caches_var, tokens_var, logits_var, is_prompt=True)
+      del scores
+      del lengths
+      return tf.logical_and(tf.less(step, seq_len-1),
+                            tf.logical_not(tf.reduce_all(finished)))
+
+    head_dim = self.dim // self.num_heads
+    k_caches_var = tf.zeros([self.num_layers, bsz * beam_size, seq_len-1,
+                             self.num_heads, head_dim], self.compute_dtype)
+    v_caches_var = tf.zeros([self.num_layers, bsz * beam_size, seq_len-1,
+                             self.num_heads, head_dim], self.compute_dtype)
+    tokens_var = tf.concat([
+        tf.cast(tf.transpose(beam_prompt), tf.int64),
+        tf.zeros([seq_len - prompt_len, bsz * beam_size], dtype=tf.int64)], 0)
+    # Only the first beam is alive initially, so that beams are distinct.
+    scores = tf.tile(
+        tf.constant([[0.] + [-1e10] * (beam_size - 1)]), [bsz, 1])
+    lengths = tf.zeros([bsz, beam_size], tf.int32)
+    finished = tf.zeros([bsz * beam_size], tf.bool)
+
+    state = loop_body(0, k_caches_var, v_caches_var, tokens_var, scores,
+                      lengths, finished, is_prompt=True)
     if seq_len > prompt_len:
-      step, caches_var, tokens_var, logits_var = tf.while_loop(
-          cond=cond, body=loop_body,
-          loop_vars=[step, caches_var, tokens_var, logits_var])
+      state = tf.while_loop(cond=cond, body=loop_body, loop_vars=state)
+    tokens_var = state[3]
+
+    # Beams are sorted by normalized score, so the first is the best.
+    best = tf.range(bsz) * beam_size
+    tokens = tf.transpose(tf.gather(tokens_var[prompt_len:], best, axis=1))
+    logits = self._score(prompt, tokens, cross_kv, logits_mode)
+    return tokens, logits
+
+  def parallel_infer(self, prompt, encoded, max_seq_len=None,
+                     num_draft_tokens=4, cross_kv=None, early_stop=None,
+                     logits_mode='full', token_mask=None):
+    """Greedy prediction that drafts and verifies several tokens per step.
+
+    Each step feeds the last decided token followed by `num_draft_tokens`
+    drafted ones through the decoder at once (with the causal mask among them
+    and the projected self-attention caches of decided tokens), and accepts the
+    longest drafted prefix that agrees with the greedy predictions, plus the
+    prediction following it. Drafts are the model's own predictions beyond the
+    accepted prefix from the previous step (i.e. Jacobi iterations), so no
+    draft model is needed. The output is the same as `infer` with `top_k=1`,
+    while the number of sequential decoder calls is reduced by the number of
+    accepted drafts. All sequences of the batch advance by the smallest number
+    of accepted tokens.
 
-    sampled_tokens = tf.transpose(tokens_var[prompt_len:], [1, 0])
-    sampled_tokens_logits = tf.transpose(logits_var[prompt_len:], [1, 0, 2])
-    return sampled_tokens, sampled_tokens_logits
+    Args:
+      prompt: `int` tokens with shape of (bsz, prompt_len).
+      encoded: `float` encoded representations for conditioning, see `infer`.
+      max_seq_len: `int` of max generated sequence length (including prompt).
+      num_draft_tokens: `int` number of drafted tokens verified at each step.
+      cross_kv: optional projected cross-attention keys / values of `encoded`
+        from `project_cross_kv`, which skips the projection of `encoded`.
+      early_stop: if not `None`, decoding stops once all sequences generate the
+        padding / ending token (0), after which sequences are padded.
+      logits_mode: what to keep of the logits, see `infer`. Logits are computed
+        by a single teacher-forced pass over the decoded tokens, and are zero
+        after the padding / ending token (0).
+      token_mask: optional `bool` allowed tokens of (period, vocab_size) or the
+        equivalent additive bias, see `infer`.
+
+    Returns:
+      greedy tokens with shape of (bsz, max_seq_len-prompt_len).
+      logits associated with the tokens, in the shape given by `logits_mode`.
+      `int` number of sequential decoder calls (including the prompt).
+    """
+    self._check_full_attention('parallel_infer')
+    bsz, prompt_len = get_shape(prompt)
+    seq_len = self.max_seq_len if max_seq_len is None else max_seq_len
+    inp_embedding, _, seq_pos_emb = self._get_embeddings()
+    track_finished = early_stop or token_mask is not None
+    if cross_kv is None:
+      cross_kv = self.project_cross_kv(encoded)
+    if token_mask is not None:
+      token_bias = token_mask_to_bias(token_mask)
+    num_draft = num_draft_tokens
+    block_size = num_draft + 1
+    mask_self = 1. - get_ar_mask(block_size, inp_embedding.dtype)
+
+    def greedy(logits, pos):
+      """Greedy tokens of logits (bsz, n, vocab) at generated positions pos."""
+      if token_mask is not None:
+        logits += tf.gather(token_bias, pos % tf.shape(token_bias)[0])
+      return tf.argmax(logits, -1)
+
+    def loop_body(step, finished, draft, k_caches, v_caches, tokens,
+                  num_steps):
+      # Positions beyond max_seq_len (only possibly in drafts) are clipped.
+      positions = step + tf.range(block_size)
+      x = tf.gather(inp_embedding, tf.concat(
+          [tokens[:, step:step + 1], draft], 1))
+      x += tf.gather(seq_pos_emb,
+                     tf.minimum(positions, self.max_seq_len - 1))[tf.newaxis]
+      kv_caches_in, cache_mask = self._read_caches(
+          k_caches, v_caches, step, block_size)
+      logits, (k_out, v_out) = self._next_logits(
+          x, cross_kv, kv_caches_in, mask_self, last_only=False,
+          cache_mask=cache_mask)
+      pred = greedy(logits, positions + 1 - prompt_len)  # (bsz, block_size)
+
+      # Number of leading drafts that agree with the predictions.
+      agree = tf.cast(tf.equal(draft, pred[:, :-1]), tf.int32)
+      num_agree = tf.reduce_sum(tf.math.cumprod(agree, axis=1), 1)
+      if track_finished:
+        num_agree = tf.where(finished, num_draft, num_agree)
+      num_accepted = tf.minimum(tf.reduce_min(num_agree), seq_len - 2 - step)
+      accepted = tf.range(block_size) <= num_accepted
+      if track_finished:
+        finished = tf.logical_or(finished, tf.reduce_any(
+            tf.logical_and(accepted, tf.equal(pred, 0)), 1))
+
+      # Drafts and caches beyond the accepted ones are overwritten later.
+      tokens = update_slice(
+          tokens, pred, step + 1, axis=1, xla=self.static_shapes)
+      k_caches = update_slice(
+          k_caches, k_out, step, axis=2, xla=self.static_shapes)
+      v_caches = update_slice(
+          v_caches, v_out, step, axis=2, xla=self.static_shapes)
+      draft = tf.gather(pred, tf.minimum(
+          num_accepted + 1 + tf.range(num_draft), num_draft), axis=1)
+      return (step + num_accepted + 1, finished, draft, k_caches, v_caches,
+              tokens, num_steps + 1)
+
+    def cond(step, finished, draft, k_caches, v_caches, tokens, num_steps):
+      del draft, k_caches, v_caches, tokens, num_steps
+      if not track_finished:
+        return tf.less(step, seq_len - 1)
+      return tf.logical_and(tf.less(step, seq_len - 1),
+                            tf.logical_not(tf.reduce_all(finished)))
+
+    # Decode the prompt, where caches and tokens have room for the drafts.
+    x = tf.gather(inp_embedding, prompt) + seq_pos_emb[:prompt_len]
+    next_logits, (k_out, v_out) = self._next_logits(
+        x, cross_kv, None, 1. - get_ar_mask(prompt_len, x.dtype))
+    first = greedy(next_logits[:, tf.newaxis], tf.zeros([1], tf.int32))
+    head_dim = self.dim // self.num_heads
+    cache_shape = [self.num_layers, bsz, seq_len - 1 + num_draft,
+                   self.num_heads, head_dim]
+    k_caches = update_slice(
+        tf.zeros(cache_shape, self.compute_dtype), k_out, 0, axis=2)
+    v_caches = update_slice(
+        tf.zeros(cache_shape, self.compute_dtype), v_out, 0, axis=2)
+    tokens = tf.concat([
+        tf.cast(prompt, tf.int64), first,
+        tf.zeros([bsz, seq_len - prompt_len - 1 + num_draft], tf.int64)], 1)
+    finished = tf.equal(first[:, 0], 0)
+    draft = tf.tile(first, [1, num_draft])
+    state = (prompt_len, finished, draft, k_caches, v_caches, tokens, 1)
+    if seq_len > prompt_len + 1:
+      state = tf.while_loop(cond=cond, body=loop_body, loop_vars=state)
+    tokens, num_steps = state[5][:, prompt_len:seq_len], state[6]
+
+    if track_finished:  # Pad after the (first) padding / ending token.
+      ended = tf.cumsum(
+          tf.cast(tf.equal(tokens, 0), tf.int32), axis=1, exclusive=True) > 0
+      tokens = tf.where(ended, tf.zeros_like(tokens), tokens)
+    logits = self._score(prompt, tokens, cross_kv, logits_mode)
+    return tokens, logits, num_steps
+
+  def decode_prompt(self, prompt, cross_kv):
+    """Decodes prompts, e.g. of sequences newly admitted to decoding slots.
+
+    Args:
+      prompt: `int` tokens with shape of (bsz, prompt_len).
+      cross_kv: per-layer projected cross-attention (key, value) from
+        `project_cross_kv`.
+
+    Returns:
+      logits of the next token in (bsz, vocab_size).
+      projected self-attention (key, value) of the prompt, each in
+        (num_layers, bsz, prompt_len, heads, head_dim).
+    """
+    self._check_full_attention('decode_prompt')
+    _, prompt_len = get_shape(prompt)
+    inp_embedding, _, seq_pos_emb = self._get_embeddings()
+    x = tf.gather(inp_embedding, prompt) + seq_pos_emb[:prompt_len]
+    return self._next_logits(
+        x, cross_kv, None, 1. - get_ar_mask(prompt_len, x.dtype))
+
+  def decode_slots(self, tokens, positions, cross_kv, kv_caches):
+    """Decodes one token for each slot of sequences at different steps.
+
+    Slot i attends to its cached keys / values of positions [0, positions[i]),
+    and the keys / values of its token are written to the caches at
+    positions[i].
+
+    Args:
+      tokens: `int` current token of each slot in (slots,).
+      positions: `int` position of each token in (slots,).
+      cross_kv: per-layer projected cross-attention (key, value) of each slot,
+        each in (slots, seq', heads, head_dim).
+      kv_caches: a tuple of (key, value) caches, each in
+        (num_layers, slots, cache_size, heads, head_dim).
+
+    Returns:
+      logits of the next token in (slots, vocab_size).
+      updated kv_caches.
+    """
+    inp_embedding, _, seq_pos_emb = self._get_embeddings()
+    x = tf.gather(inp_embedding, tokens) + tf.gather(seq_pos_emb, positions)
+    cache_size = get_shape(kv_caches[0])[2]
+    cache_mask = tf.sequence_mask(positions, cache_size, x.dtype)
+    next_logits, kv = self._next_logits(
+        x[:, tf.newaxis], cross_kv, kv_caches, tf.ones([1, 1, 1, 1], x.dtype),
+        cache_mask=cache_mask[:, tf.newaxis, tf.newaxis])
+    is_written = tf.one_hot(positions, cache_size, on_value=True,
+                            off_value=False)[tf.newaxis, :, :, tf.newaxis,
+                                             tf.newaxis]
+    kv_caches = tuple(tf.where(is_written, new, cache)
+                      for new, cache in zip(kv, kv_caches))
+    return next_logits, kv_caches
@@ -0,0 +1,109 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Benchmark continuous batching against fixed batches of `Model.infer`.
+
+Uses a small random-weight model on CPU, where the logit of the ending token
+is raised so that sampled sequence lengths vary among images as in detection.
+
+PYTHONPATH=. python benchmarks/continuous_batching.py --num_images=256
+"""
+
+import time
+
+from absl import app
+from absl import flags
+import ml_collections
+import numpy as np
+from models import ar_model
+from models.continuous_batching import ContinuousBatchingScheduler
+import tensorflow as tf
+
+flags.DEFINE_integer('num_images', 128, 'Number of images to decode.')
+flags.DEFINE_integer('batch_size', 16, 'Batch size / number of slots.')
+flags.DEFINE_integer('admit_size', 4, 'Images encoded per admission.')
+flags.DEFINE_integer('steps_per_sync', 4, 'Decoding steps per sync.')
+flags.DEFINE_integer('max_seq_len', 101, 'Max sequence length (with prompt).')
+flags.DEFINE_float('end_token_logit', 4.5,
+                   'Bias added to the logit of the ending token.')
+flags.DEFINE_integer('seed', 0, 'Random seed of weights and inputs.')
+
+FLAGS = flags.FLAGS
+
+
+def get_model():
+  config = ml_collections.ConfigDict(dict(model=dict(
+      resnet_variant='c1', image_size=(64, 64), patch_size=8,
+      num_encoder_layers=2, dim_att=128, dim_mlp=512, num_heads=4,
+      drop_path=0., drop_units=0., drop_att=0., pos_encoding='learned',
+      use_cls_token=False, dim_att_dec=128, dim_mlp_dec=512,
+      dec_proj_mode='mlp', vocab_size=1200, max_seq_len=FLAGS.max_seq_len,
+      num_decoder_layers=2, num_heads_dec=4, pos_encoding_dec='learned',
+      shared_decoder_embedding=True, decoder_output_bias=True)))
+  model = ar_model.Model(config)
+  model(tf.zeros([1, 64, 64, 3]), tf.zeros([1, 2], tf.int64), training=False)
+  bias = model.decoder.outp_bias.numpy()
+  bias[0] += FLAGS.end_token_logit
+  model.decoder.outp_bias.assign(bias)
+  return model
+
+
+def main(unused_argv):
+  tf.random.set_seed(FLAGS.seed)
+  model = get_model()
+  images = tf.random.normal([FLAGS.num_images, 64, 64, 3])
+  prompt = tf.constant([10], tf.int64)
+
+  # Fixed batches, padded to the batch size.
+  infer_fn = tf.function(lambda images: model.infer(
+      images, tf.tile(prompt[tf.newaxis], [tf.shape(images)[0], 1]),
+      max_seq_len=FLAGS.max_seq_len, top_k=0, early_stop='stop',
+      logits_mode='token')[:2])
+  infer_fn(images[:FLAGS.batch_size])  # Trace.
+  latencies, lengths = [], []
+  start = time.time()
+  for i in range(0, FLAGS.num_images, FLAGS.batch_size):
+    batch_start = time.time()
+    batch = images[i:i + FLAGS.batch_size]
+    num_padding = FLAGS.batch_size - batch.shape[0]
+    batch = tf.pad(batch, [[0, num_padding], [0, 0], [0, 0], [0, 0]])
+    pred_seq, _ = infer_fn(batch)
+    pred_seq = pred_seq.numpy()[:FLAGS.batch_size - num_padding]
+    latencies += [time.time() - batch_start] * pred_seq.shape[0]
+    lengths += list((pred_seq != 0).sum(-1))
+  elapsed = time.time() - start
+  print('fixed batches: %.2f images/sec, latency mean %.3f s, p90 %.3f s, '
+        'mean / max tokens %.1f / %d' % (
+            FLAGS.num_images / elapsed, np.mean(latencies),
+            np.percentile(latencies, 90), np.mean(lengths), np.max(lengths)))
+
+  scheduler = ContinuousBatchingScheduler(
+      model, FLAGS.batch_size, FLAGS.max_seq_len, FLAGS.admit_size, top_k=0,
+      logits_mode='token', steps_per_sync=FLAGS.steps_per_sync)
+  for _ in scheduler.run(
+      (i, images[i], prompt) for i in range(FLAGS.admit_size)):
+    pass  # Trace.
+  results = list(scheduler.run(
+      (i, images[i], prompt) for i in range(FLAGS.num_images)))
+  summary = scheduler.summary()
+  lengths = [(r['pred_seq'] != 0).sum() for r in results]
+  print('continuous batching: %.2f images/sec, latency mean %.3f s, '
+        'p90 %.3f s, mean / max tokens %.1f / %d' % (
+            summary['images_per_sec'], summary['latency_mean'],
+            summary['latency_p90'], np.mean(lengths), np.max(lengths)))
+
+
+if __name__ == '__main__':
+  app.run(main)
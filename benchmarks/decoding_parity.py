@@ -0,0 +1,291 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Checks decoding paths of `AutoregressiveDecoder` against references.
+
+Uses a tiny random-weight decoder on CPU, and checks that:
+  * cached decoding (`infer`, also with static shapes or an attention window)
+    gives the greedy tokens and logits of uncached teacher-forced passes;
+  * `early_stop` ('stop' and 'compact', also with `cross_kv_index`) gives the
+    tokens and logits of decoding to the end, up to the end of each sequence;
+  * grammar token masks only let allowed tokens be generated, and greedy
+    tokens are those of the masked teacher-forced logits;
+  * `beam_search` with beams for all hypotheses finds the best sequence of an
+    exhaustive search (with or without length penalty and token masks);
+  * `parallel_infer` gives the tokens and logits of greedy `infer`.
+Prints a line per check, and exits with 1 if any check fails.
+
+PYTHONPATH=. python benchmarks/decoding_parity.py
+"""
+
+import itertools
+
+from absl import app
+from absl import flags
+import numpy as np
+from architectures.transformers import AutoregressiveDecoder
+from tasks import task_utils
+import tensorflow as tf
+
+flags.DEFINE_integer('batch_size', 8, 'Number of sequences.')
+flags.DEFINE_integer('vocab_size', 16, 'Vocab size.')
+flags.DEFINE_integer('max_seq_len', 14, 'Max sequence length (with prompt).')
+flags.DEFINE_integer('beam_seq_len', 3,
+                     'Generated length for the exhaustive beam search.')
+flags.DEFINE_float('atol', 1e-4, 'Tolerance of logits differences.')
+flags.DEFINE_integer('seed', 0, 'Random seed of weights and inputs.')
+
+FLAGS = flags.FLAGS
+
+_PROMPT_LEN = 2
+_DIM = 32
+_NUM_ENCODED = 10
+
+
+class Checks:
+  """Records and prints pass / fail of checks."""
+
+  def __init__(self):
+    self.failed = []
+
+  def check(self, name, passed, detail=''):
+    print('%s: %s%s' % (name, 'PASS' if passed else 'FAIL',
+                        ' (%s)' % detail if detail else ''))
+    if not passed:
+      self.failed.append(name)
+
+  def check_close(self, name, tokens, logits, ref_tokens, ref_logits, valid):
+    """Checks tokens and logits at valid (bsz, out_len) positions."""
+    same_tokens = np.array_equal(tokens[valid], ref_tokens[valid])
+    max_diff = np.abs(logits[valid] - ref_logits[valid]).max()
+    self.check(name, same_tokens and max_diff < FLAGS.atol,
+               'same tokens %s, max logits difference %.2g' % (
+                   same_tokens, max_diff))
+
+
+def get_decoder(**kwargs):
+  decoder = AutoregressiveDecoder(
+      FLAGS.vocab_size, FLAGS.max_seq_len, num_layers=2, dim=_DIM,
+      mlp_ratio=4, num_heads=4, drop_path=0., drop_units=0., drop_att=0.,
+      **kwargs)
+  decoder(tf.zeros([1, _PROMPT_LEN + 1], tf.int64),
+          tf.zeros([1, _NUM_ENCODED, _DIM]),
+          False)  # Build weights.
+  return decoder
+
+
+def get_valid(tokens):
+  """Returns `bool` positions up to and including the first ending token."""
+  ended = np.cumsum(tokens == 0, axis=1) - (tokens == 0) > 0
+  return np.logical_not(ended)
+
+
+def greedy(next_logits, *unused_args):
+  return tf.argmax(next_logits, -1)
+
+
+def teacher_forced_logits(decoder, prompt, tokens, encoded):
+  """Returns uncached logits of (bsz, out_len, vocab_size) for tokens."""
+  seq = tf.concat([prompt, tf.cast(tokens[:, :-1], prompt.dtype)], 1)
+  logits = decoder(seq, encoded, False)
+  return logits[:, prompt.shape[1] - 1:].numpy()
+
+
+def get_grammar():
+  """Returns a `SequenceGrammar` of period 3 for the tiny vocab."""
+  split = FLAGS.vocab_size // 2
+  grammar = task_utils.SequenceGrammar(3, FLAGS.vocab_size)
+  grammar.allow([0], 0)
+  grammar.allow([0], 4, split)
+  grammar.allow([1, 2], split, FLAGS.vocab_size)
+  return grammar
+
+
+def check_kv_cache(checks, prompt, encoded):
+  """Cached greedy decoding against uncached teacher-forced passes."""
+  variants = {
+      'full': ({}, False),
+      'static_shapes': ({}, True),
+      'attention_window': (
+          dict(attention_window=3, window_prompt_len=_PROMPT_LEN), False),
+  }
+  for name, (kwargs, static_shapes) in variants.items():
+    decoder = get_decoder(**kwargs)
+    decoder.static_shapes = static_shapes
+    tokens, logits = tf.function(lambda d=decoder: d.infer(
+        prompt, encoded, sampling_callback=greedy))()
+    ref_logits = teacher_forced_logits(decoder, prompt, tokens, encoded)
+    ref_tokens = np.argmax(ref_logits, -1)
+    valid = np.ones_like(ref_tokens, bool)
+    checks.check_close('kv_cache/%s' % name, tokens.numpy(), logits.numpy(),
+                       ref_tokens, ref_logits, valid)
+
+
+def check_early_stop(checks, decoder, prompt, encoded):
+  """Early stopping against decoding to the end."""
+  def end_pseudo_randomly(next_logits, *unused_args):
+    """Greedy, but ends sequences at a pseudo-random subset of steps."""
+    next_token = tf.argmax(next_logits, -1)
+    u = tf.math.floormod(tf.reduce_sum(next_logits, -1) * 10., 1.)
+    return tf.where(u < 0.15, tf.zeros_like(next_token), next_token)
+
+  # Each prompt is conditioned on an encoded row by index.
+  num_rows = encoded.shape[0] // 2
+  index = tf.random.uniform(
+      [prompt.shape[0]], maxval=num_rows, dtype=tf.int32)
+  indexed = encoded[:num_rows]
+  ref_tokens, ref_logits = [t.numpy() for t in decoder.infer(
+      prompt, encoded, sampling_callback=end_pseudo_randomly)]
+  ref_indexed = [t.numpy() for t in decoder.infer(
+      prompt, tf.gather(indexed, index),
+      sampling_callback=end_pseudo_randomly)]
+  valid = get_valid(ref_tokens)
+  checks.check('early_stop/ends', not valid.all(),
+               'mean length %.1f of %d' % (valid.sum(1).mean(),
+                                           valid.shape[1]))
+  for early_stop in ['stop', 'compact']:
+    tokens, logits = tf.function(lambda e=early_stop: decoder.infer(
+        prompt, encoded, early_stop=e,
+        sampling_callback=end_pseudo_randomly))()
+    checks.check_close('early_stop/%s' % early_stop, tokens.numpy(),
+                       logits.numpy(), ref_tokens, ref_logits, valid)
+    tokens, logits = tf.function(lambda e=early_stop: decoder.infer(
+        prompt, indexed, early_stop=e, cross_kv_index=index,
+        sampling_callback=end_pseudo_randomly))()
+    checks.check_close(
+        'early_stop/%s_cross_kv_index' % early_stop, tokens.numpy(),
+        logits.numpy(), ref_indexed[0], ref_indexed[1],
+        get_valid(ref_indexed[0]))
+
+
+def check_grammar(checks, decoder, prompt, encoded):
+  """Greedy decoding with token masks against masked teacher-forced logits."""
+  grammar = get_grammar()
+  token_mask = grammar.token_mask().numpy()
+  tokens, logits = tf.function(lambda: decoder.infer(
+      prompt, encoded, sampling_callback=greedy,
+      token_mask=grammar.logits_mask()))()
+  tokens, logits = tokens.numpy(), logits.numpy()
+  valid = get_valid(tokens)
+  period = token_mask.shape[0]
+  allowed = token_mask[np.arange(tokens.shape[1]) % period]  # (len, vocab)
+  is_allowed = np.take_along_axis(allowed[np.newaxis], tokens[..., None], 2)
+  checks.check('grammar/allowed_tokens', is_allowed[..., 0][valid].all(),
+               'mean length %.1f of %d' % (valid.sum(1).mean(),
+                                           valid.shape[1]))
+  checks.check('grammar/padded', (tokens[~valid] == 0).all())
+  ref_logits = teacher_forced_logits(decoder, prompt, tokens, encoded)
+  ref_tokens = np.argmax(np.where(allowed, ref_logits, -np.inf), -1)
+  checks.check_close('grammar/greedy', tokens, logits, ref_tokens,
+                     ref_logits, valid)
+
+
+def exhaustive_best(decoder, prompt, encoded, out_len, length_penalty,
+                    token_mask=None):
+  """Returns the best normalized score of all sequences of each prompt."""
+  vocab_size = FLAGS.vocab_size
+  seqs = np.array(list(itertools.product(range(vocab_size), repeat=out_len)))
+  valid = get_valid(seqs)
+  seqs = np.unique(np.where(valid, seqs, 0), axis=0)  # Padded after ending.
+  valid = get_valid(seqs)
+  if token_mask is not None:
+    allowed = token_mask[np.arange(out_len) % token_mask.shape[0]]
+    ok = np.take_along_axis(allowed[np.newaxis], seqs[..., None], 2)[..., 0]
+    seqs = seqs[(ok | ~valid).all(1)]
+    valid = get_valid(seqs)
+  lengths = valid.sum(1)
+  best = []
+  for i in range(prompt.shape[0]):
+    n = seqs.shape[0]
+    logits = teacher_forced_logits(
+        decoder, tf.repeat(prompt[i:i + 1], n, 0), tf.constant(seqs),
+        tf.repeat(encoded[i:i + 1], n, 0))
+    log_probs = tf.nn.log_softmax(logits).numpy()
+    token_log_probs = np.take_along_axis(log_probs, seqs[..., None], 2)
+    scores = np.where(valid, token_log_probs[..., 0], 0.).sum(1)
+    best.append((scores / ((5. + lengths) / 6.)**length_penalty).max())
+  return np.array(best)
+
+
+def check_beam_search(checks, decoder, prompt, encoded):
+  """Beam search with a beam per hypothesis against an exhaustive search."""
+  out_len = FLAGS.beam_seq_len
+  max_seq_len = _PROMPT_LEN + out_len
+  # Beams for all hypotheses of out_len - 1 tokens, whose extensions are all
+  # hypotheses of out_len tokens.
+  beam_size = FLAGS.vocab_size**(out_len - 1)
+  grammar = get_grammar()
+  for name, length_penalty, token_mask in [
+      ('beam_search/exhaustive', 0., None),
+      ('beam_search/length_penalty', 0.6, None),
+      ('beam_search/grammar', 0., grammar.token_mask().numpy())]:
+    tokens, _ = tf.function(lambda a=length_penalty, m=token_mask: (
+        decoder.beam_search(prompt, encoded, max_seq_len, beam_size=beam_size,
+                            length_penalty=a, token_mask=m)))()
+    tokens = tokens.numpy()
+    valid = get_valid(tokens)
+    # Score of the selected hypotheses.
+    logits = teacher_forced_logits(decoder, prompt, tokens, encoded)
+    log_probs = tf.nn.log_softmax(logits).numpy()
+    scores = np.where(valid, np.take_along_axis(
+        log_probs, tokens[..., None], 2)[..., 0], 0.).sum(1)
+    scores /= ((5. + valid.sum(1)) / 6.)**length_penalty
+    best = exhaustive_best(
+        decoder, prompt, encoded, out_len, length_penalty, token_mask)
+    max_diff = np.abs(scores - best).max()
+    checks.check(name, max_diff < FLAGS.atol,
+                 'max score difference to exhaustive search %.2g' % max_diff)
+
+
+def check_parallel_infer(checks, decoder, prompt, encoded):
+  """Parallel (drafted) greedy decoding against greedy `infer`."""
+  grammar = get_grammar()
+  for name, early_stop, token_mask in [
+      ('parallel_infer/greedy', None, None),
+      ('parallel_infer/early_stop', 'stop', None),
+      ('parallel_infer/grammar', None, grammar.logits_mask())]:
+    ref_tokens, ref_logits = [t.numpy() for t in decoder.infer(
+        prompt, encoded, sampling_callback=greedy, early_stop=early_stop,
+        token_mask=token_mask)]
+    tokens, logits, num_steps = tf.function(
+        lambda e=early_stop, m=token_mask: decoder.parallel_infer(
+            prompt, encoded, num_draft_tokens=3, early_stop=e,
+            token_mask=m))()
+    checks.check_close(
+        name + ' (%d decoder calls)' % num_steps, tokens.numpy(),
+        logits.numpy(), ref_tokens, ref_logits, get_valid(ref_tokens))
+
+
+def main(unused_argv):
+  tf.random.set_seed(FLAGS.seed)
+  prompt = tf.random.uniform([FLAGS.batch_size, _PROMPT_LEN], 1,
+                             FLAGS.vocab_size, dtype=tf.int64)
+  encoded = tf.random.normal([FLAGS.batch_size, _NUM_ENCODED, _DIM])
+  checks = Checks()
+  check_kv_cache(checks, prompt, encoded)
+  decoder = get_decoder()
+  check_early_stop(checks, decoder, prompt, encoded)
+  check_grammar(checks, decoder, prompt, encoded)
+  check_beam_search(checks, decoder, prompt[:2], encoded[:2])
+  check_parallel_infer(checks, decoder, prompt, encoded)
+  if checks.failed:
+    print('Failed: %s' % ', '.join(checks.failed))
+    return 1
+  print('All checks passed.')
+  return 0
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,106 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Benchmark early stopping of greedy decoding against decoding to the end.
+
+Uses a small random-weight decoder on CPU, whose greedy sequences are ended
+(with the padding / ending token 0) at pseudo-random lengths, and reports the
+time of `infer` with each `early_stop` mode, and whether its tokens and token
+log-probabilities up to the end of each sequence are the same as without early
+stopping.
+
+PYTHONPATH=. python benchmarks/early_stop_decoding.py --batch_size=32
+"""
+
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+from architectures.transformers import AutoregressiveDecoder
+import tensorflow as tf
+
+flags.DEFINE_integer('batch_size', 32, 'Number of sequences.')
+flags.DEFINE_integer('max_seq_len', 201, 'Max sequence length (with prompt).')
+flags.DEFINE_integer('vocab_size', 1200, 'Vocab size.')
+flags.DEFINE_float('end_prob', 0.02,
+                   'Probability of a sequence to end at each step.')
+flags.DEFINE_integer('num_layers', 2, 'Number of decoder layers.')
+flags.DEFINE_integer('dim', 256, 'Decoder dimension.')
+flags.DEFINE_integer('num_heads', 8, 'Number of attention heads.')
+flags.DEFINE_integer('num_encoded', 196, 'Number of encoded visual tokens.')
+flags.DEFINE_integer('num_iters', 5, 'Number of timed runs.')
+flags.DEFINE_integer('seed', 0, 'Random seed of weights and inputs.')
+
+FLAGS = flags.FLAGS
+
+
+def benchmark(fn, num_iters):
+  """Returns outputs of fn and its median wall time in seconds."""
+  outputs = fn()  # Trace and warm up.
+  times = []
+  for _ in range(num_iters):
+    start = time.perf_counter()
+    outputs = fn()
+    tf.nest.map_structure(lambda t: t.numpy(), outputs)
+    times.append(time.perf_counter() - start)
+  return tf.nest.map_structure(lambda t: t.numpy(), outputs), np.median(times)
+
+
+def get_lengths(tokens):
+  """Returns lengths of sequences, up to and including the ending token."""
+  ended = tokens == 0
+  return np.where(ended.any(1), ended.argmax(1) + 1, tokens.shape[1])
+
+
+def main(unused_argv):
+  tf.random.set_seed(FLAGS.seed)
+  decoder = AutoregressiveDecoder(
+      FLAGS.vocab_size, FLAGS.max_seq_len, FLAGS.num_layers, FLAGS.dim,
+      mlp_ratio=4, num_heads=FLAGS.num_heads, drop_path=0., drop_units=0.,
+      drop_att=0.)
+  encoded = tf.random.normal([FLAGS.batch_size, FLAGS.num_encoded, FLAGS.dim])
+  prompt = tf.fill([FLAGS.batch_size, 1], tf.constant(10, tf.int64))
+  decoder(prompt, encoded, False)  # Build weights.
+
+  def sampling_callback(next_logits, *unused_args):
+    """Greedy, but ends a sequence at steps of a pseudo-random subset."""
+    next_token = tf.argmax(next_logits, -1)
+    u = tf.math.floormod(tf.reduce_sum(next_logits, -1) * 10., 1.)
+    return tf.where(u < FLAGS.end_prob, tf.zeros_like(next_token), next_token)
+
+  results = {}
+  for early_stop in [None, 'stop', 'compact']:
+    fn = tf.function(lambda e=early_stop: decoder.infer(
+        prompt, encoded, FLAGS.max_seq_len, early_stop=e,
+        logits_mode='token', sampling_callback=sampling_callback))
+    results[early_stop] = benchmark(fn, FLAGS.num_iters)
+
+  (base_tokens, base_logits), base_time = results[None]
+  lengths = get_lengths(base_tokens)
+  valid = np.arange(base_tokens.shape[1])[np.newaxis, :] < lengths[:, None]
+  print('Sequence lengths: mean %.1f, max %d of %d' % (
+      lengths.mean(), lengths.max(), base_tokens.shape[1]))
+  for early_stop, ((tokens, logits), elapsed) in results.items():
+    same_tokens = np.array_equal(tokens[valid], base_tokens[valid])
+    max_diff = np.abs(logits[valid] - base_logits[valid]).max()
+    print('early_stop=%s: %.1f ms, speedup %.2fx, same tokens %s, max '
+          'log-probability difference %.2g' % (
+              early_stop, elapsed * 1e3, base_time / elapsed, same_tokens,
+              max_diff))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,123 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Benchmark decoding with int8 weights against float weights.
+
+Uses a small random-weight model on CPU, and reports the time of greedy
+`Model.infer` (per call and per decoding step) with float weights, and after
+`quantization.quantize_model` with int8 weights, which are dequantized once per
+`infer` call. For reference, it also times decoding where quantized layers
+dequantize their weights at every step, and an int8 x int8 matmul against a
+float one of the size of the decoder MLP.
+
+PYTHONPATH=. python benchmarks/int8_decoding.py --batch_size=32
+"""
+
+import time
+
+from absl import app
+from absl import flags
+import ml_collections
+import numpy as np
+from models import ar_model
+from models import quantization
+import tensorflow as tf
+
+flags.DEFINE_integer('batch_size', 32, 'Number of images.')
+flags.DEFINE_integer('max_seq_len', 101, 'Max sequence length (with prompt).')
+flags.DEFINE_integer('dim', 256, 'Encoder and decoder dimension.')
+flags.DEFINE_integer('num_layers', 2, 'Number of encoder / decoder layers.')
+flags.DEFINE_integer('num_iters', 5, 'Number of timed runs.')
+flags.DEFINE_integer('seed', 0, 'Random seed of weights and inputs.')
+
+FLAGS = flags.FLAGS
+
+
+def get_model():
+  config = ml_collections.ConfigDict(dict(model=dict(
+      resnet_variant='c1', image_size=(64, 64), patch_size=8,
+      num_encoder_layers=FLAGS.num_layers, dim_att=FLAGS.dim,
+      dim_mlp=FLAGS.dim * 4, num_heads=4, drop_path=0., drop_units=0.,
+      drop_att=0., pos_encoding='learned', use_cls_token=False,
+      dim_att_dec=FLAGS.dim, dim_mlp_dec=FLAGS.dim * 4, dec_proj_mode='mlp',
+      vocab_size=1200, max_seq_len=FLAGS.max_seq_len,
+      num_decoder_layers=FLAGS.num_layers, num_heads_dec=4,
+      pos_encoding_dec='learned', shared_decoder_embedding=True,
+      decoder_output_bias=True)))
+  model = ar_model.Model(config)
+  model(tf.zeros([1, 64, 64, 3]), tf.zeros([1, 2], tf.int64), training=False)
+  return model
+
+
+def benchmark(fn, num_iters):
+  """Returns outputs of fn and its median wall time in seconds."""
+  outputs = fn()  # Trace and warm up.
+  times = []
+  for _ in range(num_iters):
+    start = time.perf_counter()
+    outputs = fn()
+    tf.nest.map_structure(lambda t: t.numpy(), outputs)
+    times.append(time.perf_counter() - start)
+  return tf.nest.map_structure(lambda t: t.numpy(), outputs), np.median(times)
+
+
+def main(unused_argv):
+  tf.random.set_seed(FLAGS.seed)
+  model = get_model()
+  images = tf.random.normal([FLAGS.batch_size, 64, 64, 3])
+  prompt = tf.fill([FLAGS.batch_size, 1], tf.constant(10, tf.int64))
+  num_steps = FLAGS.max_seq_len - 1
+
+  def infer():
+    return model.infer(images, prompt, max_seq_len=FLAGS.max_seq_len,
+                       logits_mode='token')[:2]
+
+  def infer_per_step_dequantize():
+    # Bypasses `quantization.dequantized` of `Model.infer`.
+    return model.decoder.infer(
+        prompt, model.encode(images)['encoded'], FLAGS.max_seq_len,
+        logits_mode='token')
+
+  results = {'float': benchmark(tf.function(infer), FLAGS.num_iters)}
+  float_bytes = quantization.weight_bytes(model)
+  quantization.quantize_model(model)
+  int8_bytes = quantization.weight_bytes(model)
+  results['int8'] = benchmark(tf.function(infer), FLAGS.num_iters)
+  results['int8_per_step_dequantize'] = benchmark(
+      tf.function(infer_per_step_dequantize), FLAGS.num_iters)
+
+  (base_tokens, base_logits), base_time = results['float']
+  print('Weights: float %d bytes, int8 %d bytes' % (float_bytes, int8_bytes))
+  for name, ((tokens, logits), elapsed) in results.items():
+    print('%s: %.1f ms per call, %.3f ms per step, %.2fx of float time, '
+          'same tokens as float %.1f%%, max log-probability difference %.2g' % (
+              name, elapsed * 1e3, elapsed * 1e3 / num_steps,
+              elapsed / base_time, 100 * np.mean(tokens == base_tokens),
+              np.abs(logits - base_logits).max()))
+
+  # Integer matmul of the decoder MLP size, one row per sequence.
+  x = tf.random.normal([FLAGS.batch_size, FLAGS.dim])
+  w = tf.random.normal([FLAGS.dim, FLAGS.dim * 4])
+  xq, wq = tf.cast(x * 30., tf.int8), tf.cast(w * 30., tf.int8)
+  _, float_time = benchmark(tf.function(lambda: tf.matmul(x, w)), 100)
+  _, int8_time = benchmark(tf.function(lambda: tf.linalg.matmul(
+      xq, wq, output_type=tf.int32)), 100)
+  print('matmul (%d, %d) x (%d, %d): float %.3f ms, int8 %.3f ms' % (
+      FLAGS.batch_size, FLAGS.dim, FLAGS.dim, FLAGS.dim * 4, float_time * 1e3,
+      int8_time * 1e3))
+
+
+if __name__ == '__main__':
+  app.run(main)
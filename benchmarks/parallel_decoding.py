@@ -0,0 +1,92 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Benchmark parallel (draft-and-verify) greedy decoding against `infer`.
+
+Uses a small random-weight decoder on CPU, and reports decoder calls,
+acceptance rate of drafted tokens and speedup over sequential greedy decoding.
+
+PYTHONPATH=. python benchmarks/parallel_decoding.py --num_draft_tokens=2,4,8
+"""
+
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+from architectures.transformers import AutoregressiveDecoder
+import tensorflow as tf
+
+flags.DEFINE_integer('batch_size', 1, 'Number of images.')
+flags.DEFINE_integer('max_seq_len', 101, 'Max sequence length (with prompt).')
+flags.DEFINE_integer('vocab_size', 1200, 'Vocab size.')
+flags.DEFINE_integer('num_layers', 2, 'Number of decoder layers.')
+flags.DEFINE_integer('dim', 256, 'Decoder dimension.')
+flags.DEFINE_integer('num_heads', 8, 'Number of attention heads.')
+flags.DEFINE_integer('num_encoded', 196, 'Number of encoded visual tokens.')
+flags.DEFINE_list('num_draft_tokens', ['1', '2', '4', '8'],
+                  'Numbers of drafted tokens per decoder call to benchmark.')
+flags.DEFINE_integer('num_iters', 5, 'Number of timed runs.')
+flags.DEFINE_integer('seed', 0, 'Random seed of weights and inputs.')
+
+FLAGS = flags.FLAGS
+
+
+def benchmark(fn, num_iters):
+  """Returns outputs of fn and its median wall time in seconds."""
+  outputs = fn()  # Trace and warm up.
+  times = []
+  for _ in range(num_iters):
+    start = time.perf_counter()
+    outputs = fn()
+    tf.nest.map_structure(lambda t: t.numpy(), outputs)
+    times.append(time.perf_counter() - start)
+  return outputs, np.median(times)
+
+
+def main(unused_argv):
+  tf.random.set_seed(FLAGS.seed)
+  decoder = AutoregressiveDecoder(
+      FLAGS.vocab_size, FLAGS.max_seq_len, FLAGS.num_layers, FLAGS.dim,
+      mlp_ratio=4, num_heads=FLAGS.num_heads, drop_path=0., drop_units=0.,
+      drop_att=0.)
+  encoded = tf.random.normal([FLAGS.batch_size, FLAGS.num_encoded, FLAGS.dim])
+  prompt = tf.fill([FLAGS.batch_size, 1], tf.constant(10, tf.int64))
+  decoder(prompt, encoded, False)  # Build weights.
+  out_len = FLAGS.max_seq_len - 1
+
+  greedy_fn = tf.function(lambda: decoder.infer(
+      prompt, encoded, FLAGS.max_seq_len, top_k=1, logits_mode='token'))
+  (greedy_tokens, _), greedy_time = benchmark(greedy_fn, FLAGS.num_iters)
+  print('greedy: %d decoder calls, %.1f ms' % (out_len, greedy_time * 1e3))
+
+  for num_draft in [int(n) for n in FLAGS.num_draft_tokens]:
+    parallel_fn = tf.function(
+        lambda k=num_draft: decoder.parallel_infer(
+            prompt, encoded, FLAGS.max_seq_len, k, logits_mode='token'))
+    (tokens, _, num_steps), parallel_time = benchmark(
+        parallel_fn, FLAGS.num_iters)
+    num_steps = int(num_steps)
+    # Each call after the prompt accepts 1 token plus the agreeing drafts.
+    acceptance = (out_len - num_steps) / max(num_steps - 1, 1) / num_draft
+    print('num_draft_tokens=%d: %d decoder calls, acceptance rate %.2f, '
+          '%.1f ms, speedup %.2fx, same tokens %s' % (
+              num_draft, num_steps, acceptance, parallel_time * 1e3,
+              greedy_time / parallel_time,
+              np.array_equal(tokens.numpy(), greedy_tokens.numpy())))
+
+
+if __name__ == '__main__':
+  app.run(main)
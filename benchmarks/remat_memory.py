@@ -0,0 +1,116 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Benchmark peak memory and step time of training with remat policies.
+
+Runs training steps (forward and backward) of a small model with each
+`model.remat_policy` in a separate process on CPU, and reports the peak
+resident memory growth over the built model and the mean step time.
+
+PYTHONPATH=. python benchmarks/remat_memory.py \
+  --remat_policies=none,per_layer,every_k@2
+"""
+
+import multiprocessing
+import resource
+import time
+
+from absl import app
+from absl import flags
+import ml_collections
+
+flags.DEFINE_list('remat_policies', ['none', 'per_layer', 'every_k@2'],
+                  'Remat policies to benchmark.')
+flags.DEFINE_string('resnet_variant', 'c1',
+                    'c1 for ViT, or a ResNet variant (e.g. c4) as encoder.')
+flags.DEFINE_integer('image_size', 384, 'Image size.')
+flags.DEFINE_integer('batch_size', 4, 'Batch size.')
+flags.DEFINE_integer('seq_len', 200, 'Sequence length.')
+flags.DEFINE_integer('num_encoder_layers', 6, 'Number of encoder layers.')
+flags.DEFINE_integer('num_decoder_layers', 4, 'Number of decoder layers.')
+flags.DEFINE_integer('dim', 256, 'Model dim.')
+flags.DEFINE_integer('num_steps', 5, 'Number of timed steps.')
+
+FLAGS = flags.FLAGS
+
+
+def get_config(remat_policy):
+  """Returns config of a small model."""
+  return ml_collections.ConfigDict(dict(model=dict(
+      resnet_variant=FLAGS.resnet_variant, resnet_depth=50,
+      resnet_width_multiplier=1, resnet_sk_ratio=0.,
+      image_size=(FLAGS.image_size, FLAGS.image_size), patch_size=16,
+      num_encoder_layers=FLAGS.num_encoder_layers, dim_att=FLAGS.dim,
+      dim_mlp=FLAGS.dim * 4, num_heads=8, drop_path=0.1, drop_units=0.1,
+      drop_att=0., pos_encoding='sin_cos', use_cls_token=False,
+      dim_att_dec=FLAGS.dim, dim_mlp_dec=FLAGS.dim * 4, dec_proj_mode='mlp',
+      vocab_size=3000, max_seq_len=FLAGS.seq_len,
+      num_decoder_layers=FLAGS.num_decoder_layers, num_heads_dec=8,
+      pos_encoding_dec='learned', shared_decoder_embedding=True,
+      decoder_output_bias=True, remat_policy=remat_policy)))
+
+
+def run(config, batch_size, num_steps):
+  """Returns peak memory growth in bytes and mean step time in seconds."""
+  from models import ar_model  # pylint: disable=g-import-not-at-top
+  import tensorflow as tf  # pylint: disable=g-import-not-at-top
+  model = ar_model.Model(config)
+  config = config.model
+  images = tf.random.normal(
+      [batch_size, config.image_size[0], config.image_size[1], 3])
+  seq = tf.random.uniform([batch_size, config.max_seq_len],
+                          maxval=config.vocab_size, dtype=tf.int64)
+  model(images, seq, training=True)  # Build.
+  optimizer = tf.keras.optimizers.SGD(1e-3)
+
+  @tf.function
+  def train_step():
+    with tf.GradientTape() as tape:
+      logits = model(images, seq, training=True)
+      loss = tf.reduce_mean(
+          tf.nn.sparse_softmax_cross_entropy_with_logits(seq, logits))
+    grads = tape.gradient(loss, model.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model.trainable_variables))
+    return loss
+
+  train_step.get_concrete_function()  # Trace, without running it.
+  base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  train_step().numpy()  # Warm up.
+  start = time.perf_counter()
+  for _ in range(num_steps):
+    loss = train_step()
+  loss.numpy()
+  step_time = (time.perf_counter() - start) / num_steps
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return (peak_rss - base_rss) * 1024, step_time  # ru_maxrss is in KiB.
+
+
+def main(unused_argv):
+  # A fresh process per policy, as ru_maxrss is the peak over the process.
+  ctx = multiprocessing.get_context('spawn')
+  results = {}
+  for policy in FLAGS.remat_policies:
+    with ctx.Pool(1) as pool:
+      results[policy] = pool.apply(
+          run, (get_config(policy), FLAGS.batch_size, FLAGS.num_steps))
+  base_memory, base_time = results[FLAGS.remat_policies[0]]
+  for policy, (memory, step_time) in results.items():
+    print('%s: peak memory +%.1f MiB (%.2fx), step %.3f s (%.2fx)' % (
+        policy, memory / 2**20, memory / max(base_memory, 1), step_time,
+        step_time / base_time))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,90 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Microbenchmark top-p sampling with and without top-k candidates.
+
+Times `top_logits` followed by sampling, as in each decoding step, on random
+logits (scaled by --logit_scale, where larger is peakier), of which a fraction
+of rows (--flat_fraction) are flat (scaled by --flat_logit_scale), so their
+top-p set is not within the candidates and they are sorted in full.
+
+PYTHONPATH=. python benchmarks/top_p_sampling.py --batch_sizes=64,128
+"""
+
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+from architectures import transformers
+import tensorflow as tf
+
+flags.DEFINE_list('batch_sizes', ['64', '128'], 'Batch sizes to benchmark.')
+flags.DEFINE_integer('vocab_size', 3000, 'Vocab size.')
+flags.DEFINE_float('top_p', 0.4, 'Top-p threshold.')
+flags.DEFINE_float('logit_scale', 5., 'Standard deviation of random logits.')
+flags.DEFINE_float('flat_fraction', 0.1, 'Fraction of rows of flat logits.')
+flags.DEFINE_float('flat_logit_scale', 1.,
+                   'Standard deviation of random logits of flat rows.')
+flags.DEFINE_integer('num_candidates', transformers.TOP_P_CANDIDATES,
+                     'Number of top-k candidates for top-p.')
+flags.DEFINE_integer('num_iters', 200, 'Number of timed calls.')
+
+FLAGS = flags.FLAGS
+
+
+def benchmark(fn, logits):
+  """Returns output of fn(logits) and its mean wall time in seconds."""
+  outputs = fn(logits)  # Trace and warm up.
+  start = time.perf_counter()
+  for _ in range(FLAGS.num_iters):
+    outputs = fn(logits)
+  outputs.numpy()
+  return outputs, (time.perf_counter() - start) / FLAGS.num_iters
+
+
+def main(unused_argv):
+  tf.random.set_seed(0)
+  for bsz in [int(b) for b in FLAGS.batch_sizes]:
+    num_flat = int(bsz * FLAGS.flat_fraction)
+    scale = tf.where(tf.range(bsz) < num_flat, FLAGS.flat_logit_scale,
+                     FLAGS.logit_scale)
+    logits = tf.random.normal([bsz, FLAGS.vocab_size]) * scale[:, tf.newaxis]
+    times, kept = {}, {}
+    for name, num_candidates, exact, xla in [
+        ('sort', 0, True, False),
+        ('candidates', FLAGS.num_candidates, True, False),
+        ('candidates_inexact', FLAGS.num_candidates, False, False),
+        ('candidates_xla', FLAGS.num_candidates, True, True)]:
+      fn = tf.function(
+          lambda x, n=num_candidates, e=exact, c=xla: transformers.top_logits(
+              x, p=FLAGS.top_p, num_candidates=n, exact=e, xla=c),
+          jit_compile=xla)
+      outputs, times[name] = benchmark(fn, logits)
+      kept[name] = outputs.numpy() > -1e9
+      sample_fn = tf.function(lambda x: tf.random.categorical(x, 1))
+      _, sample_time = benchmark(sample_fn, outputs)
+      print('batch %d %s: %.3f ms (+ %.3f ms sampling), same kept tokens as '
+            'sort %s' % (bsz, name, times[name] * 1e3, sample_time * 1e3,
+                         np.array_equal(kept[name], kept['sort'])))
+    print('batch %d: speedup %.2fx, %.0f%% rows with top-p set within '
+          '%d candidates' % (
+              bsz, times['sort'] / times['candidates'],
+              100 * np.mean(kept['sort'].sum(-1) <= FLAGS.num_candidates),
+              FLAGS.num_candidates))
+
+
+if __name__ == '__main__':
+  app.run(main)
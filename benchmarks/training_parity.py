@@ -0,0 +1,214 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Checks training paths of the model against references.
+
+Uses a tiny random-weight model on CPU, and checks that:
+  * per-token losses of sequences packed with `model_utils.pack_sequences`
+    (with `pack_factor` 2 and 4) are those of unpacked sequences, and packing
+    into rows that are too short fails rather than dropping tokens;
+  * `model_utils.get_chunked_loss` gives the losses, accuracies and gradients
+    of `model_utils.get_loss` on projected logits;
+  * gradients with each `model.remat_policy` are those without remat.
+Prints a line per check, and exits with 1 if any check fails.
+
+PYTHONPATH=. python benchmarks/training_parity.py
+"""
+
+from absl import app
+from absl import flags
+import ml_collections
+import numpy as np
+from models import ar_model
+from models import model_utils
+import tensorflow as tf
+
+flags.DEFINE_integer('batch_size', 8, 'Number of images.')
+flags.DEFINE_integer('seq_len', 24, 'Sequence length.')
+flags.DEFINE_integer('vocab_size', 64, 'Vocab size.')
+flags.DEFINE_float('rtol', 1e-5, 'Relative tolerance of differences.')
+flags.DEFINE_integer('seed', 0, 'Random seed of weights and inputs.')
+
+FLAGS = flags.FLAGS
+
+_IMAGE_SIZE = 32
+_DIM = 32
+
+
+class Checks:
+  """Records and prints pass / fail of checks."""
+
+  def __init__(self):
+    self.failed = []
+
+  def check(self, name, passed, detail=''):
+    print('%s: %s%s' % (name, 'PASS' if passed else 'FAIL',
+                        ' (%s)' % detail if detail else ''))
+    if not passed:
+      self.failed.append(name)
+
+  def check_close(self, name, values, ref_values):
+    """Checks nested values, relative to the max magnitude of all of them.
+
+    Not relative to each value, as some gradients are zero up to round-off
+    (e.g. of attention key biases, which softmax is invariant to).
+
+    Args:
+      name: `str` name of the check.
+      values: nested tensors or arrays.
+      ref_values: reference values of the same structure.
+    """
+    values = [np.asarray(v) for v in tf.nest.flatten(values)]
+    ref_values = [np.asarray(r) for r in tf.nest.flatten(ref_values)]
+    scale = max(np.abs(r).max() for r in ref_values)
+    max_diff = max(np.abs(v - r).max() for v, r in zip(values, ref_values))
+    self.check(name, max_diff <= FLAGS.rtol * scale,
+               'max difference %.2g of max magnitude %.2g' % (
+                   max_diff, scale))
+
+
+def get_model(remat_policy='none'):
+  config = ml_collections.ConfigDict(dict(model=dict(
+      resnet_variant='c1', image_size=(_IMAGE_SIZE, _IMAGE_SIZE),
+      patch_size=8, num_encoder_layers=3, dim_att=_DIM, dim_mlp=_DIM * 4,
+      num_heads=4, drop_path=0., drop_units=0., drop_att=0.,
+      pos_encoding='learned', use_cls_token=False, dim_att_dec=_DIM,
+      dim_mlp_dec=_DIM * 4, dec_proj_mode='mlp',
+      vocab_size=FLAGS.vocab_size, max_seq_len=FLAGS.seq_len * 4,
+      num_decoder_layers=3, num_heads_dec=4, pos_encoding_dec='learned',
+      shared_decoder_embedding=True, decoder_output_bias=True,
+      remat_policy=remat_policy)))
+  model = ar_model.Model(config)
+  model(tf.zeros([1, _IMAGE_SIZE, _IMAGE_SIZE, 3]),
+        tf.zeros([1, 2], tf.int64), training=False)  # Build weights.
+  return model
+
+
+def get_batch():
+  """Returns images, input and target sequences padded at random lengths."""
+  bsz, seq_len = FLAGS.batch_size, FLAGS.seq_len
+  images = tf.random.normal([bsz, _IMAGE_SIZE, _IMAGE_SIZE, 3])
+  input_seq = tf.random.uniform(
+      [bsz, seq_len], 1, FLAGS.vocab_size, dtype=tf.int64)
+  target_seq = tf.random.uniform(
+      [bsz, seq_len], 1, FLAGS.vocab_size, dtype=tf.int64)
+  lengths = tf.random.uniform([bsz, 1], 1, seq_len + 1, dtype=tf.int64)
+  target_seq = tf.where(
+      tf.range(seq_len, dtype=tf.int64) < lengths, target_seq, 0)
+  return images, input_seq, target_seq
+
+
+def check_pack_sequences(checks, model, images, input_seq, target_seq):
+  """Losses of packed sequences against those of unpacked sequences."""
+  lengths = model_utils.get_seq_lengths(target_seq)
+  logits = model(images, input_seq, training=False)
+  losses = model_utils.get_loss(logits, target_seq, 'xent')
+  for pack_factor in [2, 4]:
+    row_lengths = tf.reduce_sum(tf.reshape(lengths, [-1, pack_factor]), 1)
+    for name, packed_len in [('default', None),
+                             ('tight', int(tf.reduce_max(row_lengths)))]:
+      (packed_input, packed_target), packed = model_utils.pack_sequences(
+          [input_seq, target_seq], lengths, pack_factor, packed_len)
+      packed_logits = model(images, packed_input, training=False,
+                            packed=packed)
+      packed_losses = model_utils.get_loss(
+          packed_logits, packed_target, 'xent')
+      # Unpacked losses, packed alike for comparison.
+      [ref_losses], _ = model_utils.pack_sequences(
+          [losses], lengths, pack_factor, packed_len)
+      is_token = packed['segment_ids'].numpy() > 0
+      checks.check_close(
+          'pack_sequences/factor_%d_%s (%d of %d tokens kept)' % (
+              pack_factor, name, is_token.sum(), is_token.size),
+          packed_losses.numpy()[is_token], ref_losses.numpy()[is_token])
+    try:
+      model_utils.pack_sequences(
+          [input_seq, target_seq], lengths, pack_factor,
+          int(tf.reduce_max(row_lengths)) - 1)
+      raised = False
+    except tf.errors.InvalidArgumentError:
+      raised = True
+    checks.check('pack_sequences/factor_%d_too_short_raises' % pack_factor,
+                 raised)
+
+
+def check_chunked_loss(checks, target_seq):
+  """Chunked loss against the loss of projected logits."""
+  bsz, seq_len = target_seq.shape
+  outputs = tf.random.normal([bsz, seq_len, _DIM])
+  embedding = tf.random.normal([FLAGS.vocab_size, _DIM])
+  bias = tf.random.normal([FLAGS.vocab_size])
+  weights = tf.random.uniform([bsz, seq_len])
+
+  def reference(outputs, embedding, bias, loss_type):
+    logits = tf.nn.bias_add(
+        tf.matmul(outputs, embedding, transpose_b=True), bias)
+    correct = tf.cast(tf.equal(
+        tf.argmax(logits, -1, output_type=target_seq.dtype), target_seq),
+                      tf.float32)
+    return model_utils.get_loss(logits, target_seq, loss_type), correct
+
+  for loss_type in ['xent', 'xent@0.1']:
+    for chunk_size in [7, seq_len]:
+      results = []
+      for fn in [
+          reference,
+          lambda *args, c=chunk_size: model_utils.get_chunked_loss(
+              *args[:3], target_seq, args[3], c)]:
+        variables = [tf.Variable(t) for t in [outputs, embedding, bias]]
+        with tf.GradientTape() as tape:
+          losses, correct = fn(*variables, loss_type)
+          loss = tf.reduce_sum(losses * weights)
+        results.append((losses, correct, tape.gradient(loss, variables)))
+      checks.check_close(
+          'chunked_loss/%s_chunk_%d' % (loss_type, chunk_size),
+          results[1], results[0])
+
+
+def check_remat(checks, images, input_seq, target_seq):
+  """Gradients with remat against those without."""
+  base_model = get_model()
+
+  def get_grads(model):
+    with tf.GradientTape() as tape:
+      logits = model(images, input_seq, training=True)
+      loss = tf.reduce_mean(
+          model_utils.get_loss(logits, target_seq, 'xent'))
+    return loss, tape.gradient(loss, model.trainable_variables)
+
+  base_grads = get_grads(base_model)
+  for remat_policy in ['per_layer', 'every_k@2']:
+    model = get_model(remat_policy)
+    model.set_weights(base_model.get_weights())
+    checks.check_close('remat/%s' % remat_policy,
+                       tf.function(get_grads)(model), base_grads)
+
+
+def main(unused_argv):
+  tf.random.set_seed(FLAGS.seed)
+  images, input_seq, target_seq = get_batch()
+  checks = Checks()
+  check_pack_sequences(checks, get_model(), images, input_seq, target_seq)
+  check_chunked_loss(checks, target_seq)
+  check_remat(checks, images, input_seq, target_seq)
+  if checks.failed:
+    print('Failed: %s' % ', '.join(checks.failed))
+    return 1
+  print('All checks passed.')
+  return 0
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -30,6 +30,9 @@ def get_config(config_str=None):
   task_variant = 'object_detection@coco/2017_object_detection'
   encoder_variant = 'vit-b'                 # Set model architecture.
   image_size = (640, 640)                   # Set image size.
+  # (height, width) sizes to pad smaller images to, instead of image_size.
+  # E.g. [(480, 640), (640, 480)]; multiples of the patch size / stride.
+  image_size_buckets = []
 
   tasks_and_datasets = []
   for task_and_ds in task_variant.split('+'):
@@ -44,6 +47,7 @@ def get_config(config_str=None):
           name='object_detection',
           vocab_id=10,
           image_size=image_size,
+          image_size_buckets=image_size_buckets,
           quantization_bins=1000,
           max_instances_per_image=100,
           max_instances_per_image_test=100,
@@ -60,7 +64,13 @@ def get_config(config_str=None):
           class_label_corruption='rand_n_fake_cls',
           top_k=0,
           top_p=0.4,
+          top_p_candidates=64,              # Top-k candidates to find the top-p set in (0 to sort all logits).
           temperature=1.0,
+          early_stop=None,                  # Stop decoding finished sequences (None, 'stop' or 'compact').
+          beam_size=1,                      # Set to >1 for beam search instead of sampling.
+          length_penalty=0.,                # Length normalization alpha for beam search.
+          constrain_tokens=False,           # Only allow tokens of well-formed yxyxc objects (grammar).
+          num_draft_tokens=0,               # Set to >0 for (experimental) parallel greedy decoding.
           weight=1.0,
       ),
   }
@@ -89,6 +99,18 @@ def get_config(config_str=None):
           use_cls_token=False,
           shared_decoder_embedding=True,
           decoder_output_bias=True,
+          # Set to 'bfloat16' (or 'float16') for reduced-precision inference.
+          compute_dtype='float32',
+          # Set to True for int8 checkpoints from quantize.py.
+          int8_weights=False,
+          # Set > 0 to only attend to the prompt and a sliding window of
+          # previous tokens, e.g. 5 * 50 for the last 50 objects (with a period
+          # of 5 tokens per object), to bound decoding cost of dense scenes.
+          dec_attention_window=0,
+          dec_attention_window_period=5,
+          # Recompute activations of layers in backward to save memory: 'none',
+          # 'per_layer' or 'every_k@<k>' (groups of k layers).
+          remat_policy='none',
           patch_size=16,
           drop_path=0.1,
           drop_units=0.1,
@@ -116,12 +138,17 @@ def get_config(config_str=None):
 
       train=D(
           batch_size=32,
+          grad_accum_steps=1,               # >1 to reach batch_size with smaller micro-batches.
           epochs=40,
           steps=0,                          # set to >0 to override epochs.
           checkpoint_epochs=1,
           checkpoint_steps=0,               # set to >0 to override checkpoint_epochs.
           keep_checkpoint_max=5,
           loss_type='xent',
+          loss_chunk_size=0,                # >0 to compute logits and loss in chunks of tokens.
+          pack_factor=1,                    # >1 to pack sequences of images per decoder row.
+          packed_seq_len=0,                 # length of packed rows (0 for pack_factor * max_seq_len); training fails if sequences do not fit.
+          telemetry_steps=100,              # steps between weight/gradient norm diagnostics.
       ),
 
       eval=D(
@@ -130,6 +157,10 @@ def get_config(config_str=None):
           # checkpoint_dir=get_coco_finetuned_checkpoint(encoder_variant, image_size[0]),
           batch_size=8,                     # needs to be divisible by total eval examples.
           steps=0,                          # 0 means eval over full validation set.
+          # XLA-compile inference, with compiled executables optionally
+          # persisted in a local directory across runs.
+          jit_compile=False,
+          compile_cache_dir='',
       ),
   )
 
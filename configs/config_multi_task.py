@@ -38,6 +38,9 @@ def get_config(config_str=None):
     tasks_and_datasets.append(task_and_ds.split('@'))
 
   image_size = (640, 640)  # Set single image size across the model and tasks
+  # (height, width) sizes to pad smaller images to, instead of image_size.
+  # E.g. [(480, 640), (640, 480)]; multiples of the patch size / stride.
+  image_size_buckets = []
 
   task_config_map = {
       'object_detection':
@@ -45,6 +48,7 @@ def get_config(config_str=None):
               name='object_detection',
               vocab_id=10,
               image_size=image_size,
+              image_size_buckets=image_size_buckets,
               quantization_bins=1000,
               max_instances_per_image=100,
               max_instances_per_image_test=100,
@@ -61,7 +65,17 @@ def get_config(config_str=None):
               class_label_corruption='rand_n_fake_cls',
               top_k=0,
               top_p=0.4,
+              # Top-k candidates to find the top-p set in (0 to sort all logits).
+              top_p_candidates=64,
               temperature=1.0,
+              # Set beam_size > 1 for beam search instead of sampling.
+              beam_size=1,
+              length_penalty=0.,
+              # Only allow tokens of well-formed yxyxc objects (grammar).
+              constrain_tokens=False,
+              # Set num_draft_tokens > 0 for (experimental) parallel greedy
+              # decoding.
+              num_draft_tokens=0,
               weight=1.0,
               # If specified, outputs including boxes, scores etc. are saved to
               # this file.
@@ -88,6 +102,8 @@ def get_config(config_str=None):
               top_p=0.8,
               temperature=1.0,
               use_gt_box_at_test=True,  # for debug only
+              # Only allow well-formed objects when detecting boxes.
+              constrain_tokens=False,
               eos_token_weight=1.0,
               weight=1.0,
               ensemble_num_samples=8,
@@ -95,6 +111,9 @@ def get_config(config_str=None):
               # Min score of a pre-computed bbox to use for inference.
               # Note ground truth boxes have score 1.0
               min_bbox_score=0.0,
+              # Number of instances decoded together after dropping empty and
+              # low-score ones (0 to decode all instances at once).
+              instance_bucket_size=16,
               # Note: max_instances_per_image and max_instances_per_image_test must
               # be set to 1 when using unbatching.
               # Note: unbatch=True can be used alone as well with crop_to_bbox=False
@@ -117,6 +136,9 @@ def get_config(config_str=None):
               max_instances_per_image_test=1,
               max_points_per_object=17,
               min_bbox_score=0.0,
+              # Number of instances decoded together after dropping empty and
+              # low-score ones (0 to decode all instances at once).
+              instance_bucket_size=0,
               color_jitter_strength=0.,
               jitter_scale_min=0.3,
               jitter_scale_max=1.0,
@@ -132,6 +154,8 @@ def get_config(config_str=None):
               crop_to_bbox_pad_scale=0.5,
               points_score_weight=1.0,
               eval_suppress_invisible_token=True,
+              # Only allow well-formed objects and (y, x) keypoints.
+              constrain_tokens=False,
               metric=D(name='coco_keypoint_detection',)),
       'captioning':
           D(name='captioning',
@@ -148,6 +172,9 @@ def get_config(config_str=None):
             top_k=0,
             top_p=1.0,
             temperature=1.0,
+            # Set beam_size > 1 for beam search instead of sampling.
+            beam_size=1,
+            length_penalty=0.6,
             weight=1.,
             metric=D(name='coco_captioning',)),
       'panoptic_segmentation':
@@ -194,6 +221,13 @@ def get_config(config_str=None):
           use_cls_token=False,
           shared_decoder_embedding=True,
           decoder_output_bias=True,
+          # Set to 'bfloat16' (or 'float16') for reduced-precision inference.
+          compute_dtype='float32',
+          # Set to True for int8 checkpoints from quantize.py.
+          int8_weights=False,
+          # Recompute activations of layers in backward to save memory: 'none',
+          # 'per_layer' or 'every_k@<k>' (groups of k layers).
+          remat_policy='none',
           patch_size=16,
           drop_path=0.1,
           drop_units=0.1,
@@ -221,12 +255,26 @@ def get_config(config_str=None):
 
       train=D(
           batch_size=128,
+          # >1 to reach batch_size with grad_accum_steps smaller micro-batches.
+          grad_accum_steps=1,
           epochs=100,
           steps=0,
           checkpoint_epochs=1,
           checkpoint_steps=0,
           keep_checkpoint_max=10,
           loss_type='xent',
+          # >0 to project logits and compute the loss in chunks of tokens,
+          # which lowers peak memory of logits to chunks of loss_chunk_size.
+          loss_chunk_size=0,
+          # >1 to pack sequences of pack_factor images into each decoder row
+          # of packed_seq_len tokens (0 for pack_factor times the sequence
+          # length). This only saves compute for sequences shorter than the
+          # sequence length (e.g. with noise_bbox_weight=0), and training
+          # fails if the sequences of a row do not fit in packed_seq_len.
+          pack_factor=1,
+          packed_seq_len=0,
+          # steps between weight/gradient norm diagnostics.
+          telemetry_steps=100,
       ),
 
       eval=D(
@@ -235,6 +283,10 @@ def get_config(config_str=None):
           # checkpoint_dir=get_multi_task_checkpoint_dir(encoder_variant, image_size),
           batch_size=8,
           steps=0,
+          # XLA-compile inference, with compiled executables optionally
+          # persisted in a local directory across runs.
+          jit_compile=False,
+          compile_cache_dir='',
       ),
 
       tokenizer=D(
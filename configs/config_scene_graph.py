@@ -57,7 +57,10 @@ def get_config(config_str=None):
           class_label_corruption='rand_n_fake_cls',
           top_k=0,
           top_p=0.4,
+          top_p_candidates=64,              # Top-k candidates to find the top-p set in (0 to sort all logits).
           temperature=1.0,
+          early_stop=None,                  # Stop decoding finished sequences (None, 'stop' or 'compact').
+          constrain_tokens=False,           # Only allow tokens of well-formed triplets (grammar).
           weight=1.0,
           metric=D(name='vg_sgg_recall',)
       ),
@@ -87,6 +90,10 @@ def get_config(config_str=None):
           use_cls_token=False,
           shared_decoder_embedding=True,
           decoder_output_bias=True,
+          # Set to 'bfloat16' (or 'float16') for reduced-precision inference.
+          compute_dtype='float32',
+          # Set to True for int8 checkpoints from quantize.py.
+          int8_weights=False,
           patch_size=16,
           drop_path=0.1,
           drop_units=0.1,
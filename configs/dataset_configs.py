@@ -21,6 +21,23 @@ from configs.config_base import D
 _shared_dataset_config = D(
     batch_duplicates=1,
     cache_dataset=True,
+    # TFRecord reading: whether input pipelines read disjoint shards of files,
+    # number of files read concurrently, parallelism of reading them (-1 for
+    # autotuned, 0 for sequential), and read buffer size in bytes (0 for the
+    # default).
+    shard_files=True,
+    cycle_length=32,
+    interleave_parallelism=-1,
+    read_buffer_size=0,
+    # >0 to parse and filter TFRecord examples in batches of this size, which
+    # is cheaper for small records (see benchmarks/parse_throughput.py).
+    parse_batch_size=0,
+    # Whether to decode only the cropped region of training JPEGs, for tasks
+    # cropping in data_utils.preprocess_train (e.g. object detection).
+    fused_decode_crop=False,
+    # Directory to cache preprocessed eval batches in, reused across evals.
+    # The first eval writes the whole eval split before its first step.
+    eval_cache_dir='',
 )
 
 # Generate tfrecords for the dataset using data/scripts/create_coco_tfrecord.py
@@ -25,6 +25,7 @@ which are not in the person category are dropped.
 import numpy as np
 import utils
 import vocab
+from data import data_utils
 from data import dataset as dataset_lib
 from data import decode_utils
 import tensorflow as tf
@@ -62,6 +63,12 @@ class CocoObjectDetectionTFRecordDataset(dataset_lib.TFRecordDataset):
     else:
       return True
 
+  def filter_examples(self, examples, training):
+    if training:
+      return examples['image/object/bbox/xmin'].row_lengths() > 0
+    else:
+      return tf.ones_like(examples['image/source_id'], tf.bool)
+
   def extract(self, example, training):
     """Extracts needed features & annotations into a flat dictionary.
 
@@ -77,13 +84,13 @@ class CocoObjectDetectionTFRecordDataset(dataset_lib.TFRecordDataset):
     Returns:
       example: `dict` of relevant features and labels.
     """
-    features = {
-        'image': decode_utils.decode_image(example),
-        'image/id': tf.strings.to_number(example['image/source_id'], tf.int64),
-    }
+    features = decode_utils.decode_image_or_size(
+        example, training and self.config.get('fused_decode_crop', False))
+    features['image/id'] = tf.strings.to_number(
+        example['image/source_id'], tf.int64)
 
     bbox = decode_utils.decode_boxes(example)
-    scale = 1. / utils.tf_float32(tf.shape(features['image'])[:2])
+    scale = 1. / utils.tf_float32(data_utils.get_image_size(features))
     bbox = utils.scale_points(bbox, scale)
 
     labels = {
@@ -113,6 +120,9 @@ class CocoInstanceSegmentationTFRecordDataset(dataset_lib.TFRecordDataset):
     # at least one element.`
     return tf.shape(example['image/object/bbox/xmin'])[0] > 0
 
+  def filter_examples(self, examples, training):
+    return examples['image/object/bbox/xmin'].row_lengths() > 0
+
   def extract(self, example, training):
     """Extracts needed features & annotations into a flat dictionary.
 
@@ -186,6 +196,12 @@ class CocoKeypointDetectionTFRecordDataset(dataset_lib.TFRecordDataset):
     else:
       return tf.shape(example['image/object/bbox/xmin'])[0] > 0
 
+  def filter_examples(self, examples, training):
+    if training:
+      return tf.reduce_sum(examples['image/object/num_keypoints'], axis=1) > 0
+    else:
+      return examples['image/object/bbox/xmin'].row_lengths() > 0
+
   def set_invisible_points(self, keypoints):
     segs = []
     num_points = np.shape(keypoints)[1] // 3
@@ -281,6 +297,12 @@ class CocoCaptioningTFRecordDataset(dataset_lib.TFRecordDataset):
     else:
       return True
 
+  def filter_examples(self, examples, training):
+    if training:
+      return examples['image/caption'].row_lengths() > 0
+    else:
+      return tf.ones_like(examples['image/source_id'], tf.bool)
+
   def extract(self, example, training):
     """Extracts needed features & annotations into a flat dictionary.
 
@@ -296,10 +318,10 @@ class CocoCaptioningTFRecordDataset(dataset_lib.TFRecordDataset):
     Returns:
       example: `dict` of relevant features and labels.
     """
-    features = {
-        'image': decode_utils.decode_image(example),
-        'image/id': tf.strings.to_number(example['image/source_id'], tf.int64),
-    }
+    features = decode_utils.decode_image_or_size(
+        example, training and self.config.get('fused_decode_crop', False))
+    features['image/id'] = tf.strings.to_number(
+        example['image/source_id'], tf.int64)
 
     labels = {
         'captions':
@@ -22,6 +22,7 @@ from absl import logging
 import ml_collections
 import utils
 import vocab
+from data import decode_utils
 import tensorflow as tf
 
 
@@ -524,6 +525,64 @@ def fixed_size_crop(features, labels, target_height, target_width,
   return crop(features, labels, region, object_coordinate_keys)
 
 
+def decode_and_fixed_size_crop(features, labels, min_scale, max_scale,
+                               target_height, target_width,
+                               object_coordinate_keys):
+  """Fused decoding, `scale_jitter` and `fixed_size_crop` of encoded image.
+
+  The crop of target size is sampled in the scaled image as by `scale_jitter`
+  and `fixed_size_crop`. Only the region of the encoded image covering it is
+  decoded (see `decode_utils.decode_image_or_size`), and is resized to the
+  crop size. Points of labels are adjusted to the decoded region.
+
+  Args:
+    features: `dict` containing `image/encoded` and its `image/size`.
+    labels: `dict` containing label tensors such as `bbox`.
+    min_scale: minimum scale of target size.
+    max_scale: maximum scale of target size.
+    target_height: `int` height of the crop.
+    target_width: `int` width of the crop.
+    object_coordinate_keys: a tuple of name keys for coordinate labels.
+
+  Returns:
+    features with the cropped `image`, and labels.
+  """
+  image_size = features['image/size']
+  input_size = tf.cast(image_size, tf.float32)
+  output_size = tf.constant([target_height, target_width], tf.float32)
+  random_scale = tf.random.uniform([], min_scale, max_scale)
+  scale = tf.reduce_min(output_size * random_scale / input_size)
+  scaled_size = tf.cast(input_size * scale, tf.int32)
+
+  max_offset = tf.cast(
+      tf.maximum(scaled_size - tf.cast(output_size, tf.int32), 0), tf.float32)
+  offset = tf.cast(max_offset * tf.random.uniform([], 0.0, 1.0), tf.int32)
+  crop_size = tf.minimum(tf.cast(output_size, tf.int32), scaled_size - offset)
+
+  # Smallest region of the encoded image covering the crop.
+  start = tf.cast(tf.cast(offset, tf.float32) / scale, tf.int32)
+  end = tf.cast(tf.math.ceil(tf.cast(offset + crop_size, tf.float32) / scale),
+                tf.int32)
+  end = tf.maximum(tf.minimum(end, image_size), start + 1)
+  region = tf.concat([start, end - start], 0)
+
+  image = decode_utils.decode_and_crop_image(features['image/encoded'], region)
+  features = {k: v for k, v in features.items()
+              if k not in ('image/encoded', 'image/size')}
+  features['image'] = tf.image.resize(image, crop_size)
+  labels = crop_points(labels, tf.unstack(region), image_size,
+                       object_coordinate_keys)
+  features['crop_offset'] = tf.unstack(offset)
+  return features, labels
+
+
+def get_image_size(features):
+  """Returns (h, w) of the decoded or encoded image (see `preprocess_train`)."""
+  if 'image' in features:
+    return tf.shape(features['image'])[:2]
+  return features['image/size']
+
+
 def random_crop(features, labels, scale, ratio, object_coordinate_keys):
   """Crops image to random aspect ratio.
 
@@ -571,19 +630,11 @@ def handle_out_of_frame_points(points, key):
                     points)
 
 
-def crop(features, labels, region,
-         object_coordinate_keys=('bbox', 'polygon', 'keypoints')):
-  """Crop image to region and adjust (normalized) bbox."""
-  image = features['image']
-  h_offset, w_offset, h, w = region
-  h_ori, w_ori, _ = tf.unstack(tf.shape(image))
-
-  features['image'] = image[h_offset:h_offset + h, w_offset:w_offset + w, :]
-
-  h_offset = tf.cast(h_offset, tf.float32)
-  w_offset = tf.cast(w_offset, tf.float32)
-  h, w = tf.cast(h, tf.float32), tf.cast(w, tf.float32)
-  h_ori, w_ori = tf.cast(h_ori, tf.float32), tf.cast(w_ori, tf.float32)
+def crop_points(labels, region, image_size,
+                object_coordinate_keys=('bbox', 'polygon', 'keypoints')):
+  """Adjust (normalized) points of labels to crop region of image_size."""
+  h_offset, w_offset, h, w = [tf.cast(x, tf.float32) for x in region]
+  h_ori, w_ori = tf.unstack(tf.cast(image_size, tf.float32))
 
   scale = tf.stack([h_ori / h, w_ori / w])
   offset = tf.stack([h_offset / h_ori, w_offset / w_ori])
@@ -594,6 +645,18 @@ def crop(features, labels, region,
       points = (points - offset) * scale
       points = handle_out_of_frame_points(points, key)
       labels[key] = flatten_points(points)
+  return labels
+
+
+def crop(features, labels, region,
+         object_coordinate_keys=('bbox', 'polygon', 'keypoints')):
+  """Crop image to region and adjust (normalized) bbox."""
+  image = features['image']
+  h_offset, w_offset, h, w = region
+
+  features['image'] = image[h_offset:h_offset + h, w_offset:w_offset + w, :]
+  labels = crop_points(labels, region, tf.shape(image)[:2],
+                       object_coordinate_keys)
 
   if 'crop_offset' not in features:
     # Cropping the first time.
@@ -612,7 +675,8 @@ def pad_image_to_max_size(features,
                           labels,
                           max_image_size,
                           object_coordinate_keys,
-                          backgrnd_val=0.3,):  # pylint: disable=g-doc-args
+                          backgrnd_val=0.3,
+                          size_buckets=None):  # pylint: disable=g-doc-args
   """Pad image to the same size (max_image_size, max_image_size, 3).
 
   - Replace labels["image"] with padded image.
@@ -621,19 +685,28 @@ def pad_image_to_max_size(features,
     augmented but unpadded image. This can be used to scale the bbox for
     visualization on the processed image.
 
-  Padding gets added on bottom and right.
+  Padding gets added on bottom and right. With size_buckets (a list of (height,
+  width)), the image is instead padded to the smallest bucket (by area) that
+  fits it, or max_image_size if none does.
 
   Returns:
     features, labels
   """
   unpadded_image = features['image']
   features['unpadded_image_size'] = tf.shape(unpadded_image)[:2]
+  height = tf.shape(unpadded_image)[0]
+  width = tf.shape(unpadded_image)[1]
+
+  if size_buckets:
+    buckets = sorted([tuple(b) for b in size_buckets] + [tuple(max_image_size)],
+                     key=lambda b: b[0] * b[1])
+    buckets = tf.constant(buckets, tf.int32)
+    fits = tf.reduce_all(buckets >= tf.stack([height, width]), axis=1)
+    max_image_size = tf.unstack(buckets[tf.argmax(tf.cast(fits, tf.int32))])
 
   features['image'] = backgrnd_val + tf.image.pad_to_bounding_box(
       unpadded_image - backgrnd_val, 0, 0, max_image_size[0], max_image_size[1])
 
-  height = tf.shape(unpadded_image)[0]
-  width = tf.shape(unpadded_image)[1]
   hratio = tf.cast(height, tf.float32) / tf.cast(max_image_size[0], tf.float32)
   wratio = tf.cast(width, tf.float32) / tf.cast(max_image_size[1], tf.float32)
   scale = tf.stack([hratio, wratio])
@@ -678,17 +751,28 @@ def preprocess_train(features,
                      color_jitter_strength=0.,
                      filter_invalid_labels=True,
                      object_coordinate_keys=('bbox', 'polygon', 'keypoints'),
-                     object_coordinate_labels=('labels')):
-  """Preprocessing for training input pipeline (scale jittering-based)."""
-  if features['image'].dtype != tf.float32:
-    features['image'] = tf.image.convert_image_dtype(
-        features['image'], tf.float32)
-  features['image'] = scale_jitter(
-      features['image'], jitter_scale[0], jitter_scale[1],
-      max_image_size[0], max_image_size[1])
-  features, labels = fixed_size_crop(
-      features, labels, max_image_size[0], max_image_size[1],
-      object_coordinate_keys)
+                     object_coordinate_labels=('labels'),
+                     size_buckets=None):
+  """Preprocessing for training input pipeline (scale jittering-based).
+
+  The image of features is either decoded (`image`), or encoded (`image/encoded`
+  and `image/size`) in which case only its cropped region is decoded. With
+  size_buckets, it is padded to a bucket size (see `pad_image_to_max_size`).
+  """
+  if 'image' not in features:
+    features, labels = decode_and_fixed_size_crop(
+        features, labels, jitter_scale[0], jitter_scale[1],
+        max_image_size[0], max_image_size[1], object_coordinate_keys)
+  else:
+    if features['image'].dtype != tf.float32:
+      features['image'] = tf.image.convert_image_dtype(
+          features['image'], tf.float32)
+    features['image'] = scale_jitter(
+        features['image'], jitter_scale[0], jitter_scale[1],
+        max_image_size[0], max_image_size[1])
+    features, labels = fixed_size_crop(
+        features, labels, max_image_size[0], max_image_size[1],
+        object_coordinate_keys)
   if random_flip:
     features, labels = random_horizontal_flip(features, labels)
   if color_jitter_strength > 0:
@@ -702,7 +786,8 @@ def preprocess_train(features,
   if inject_noise_instances:  # for detection.
     labels = inject_noise_bbox(labels, max_instances_per_image, object_coordinate_keys=object_coordinate_keys, object_coordinate_labels=object_coordinate_labels)
   features, labels = pad_image_to_max_size(
-      features, labels, max_image_size, object_coordinate_keys)
+      features, labels, max_image_size, object_coordinate_keys,
+      size_buckets=size_buckets)
   if max_instances_per_image > 0:
     labels = truncate_or_pad_to_max_instances(labels, max_instances_per_image)
   return features, labels
@@ -712,13 +797,15 @@ def preprocess_eval(features,
                     labels,
                     max_image_size,
                     max_instances_per_image,
-                    object_coordinate_keys=('bbox', 'polygon', 'keypoints')):
+                    object_coordinate_keys=('bbox', 'polygon', 'keypoints'),
+                    size_buckets=None):
   """Preprocessing for eval input pipeline."""
   features['image'] = tf.image.resize(
       features['image'], max_image_size, method=tf.image.ResizeMethod.BILINEAR,
       antialias=True, preserve_aspect_ratio=True)
   features, labels = pad_image_to_max_size(
-      features, labels, max_image_size, object_coordinate_keys)
+      features, labels, max_image_size, object_coordinate_keys,
+      size_buckets=size_buckets)
   if max_instances_per_image > 0:
     labels = truncate_or_pad_to_max_instances(labels, max_instances_per_image)
   return features, labels
@@ -18,8 +18,12 @@
 import abc
 import code
 import functools
+import hashlib
+import json
 import operator
+import os
 from typing import Callable
+from absl import logging
 import ml_collections
 
 import registry
@@ -28,6 +32,18 @@ import tensorflow_datasets as tfds
 
 DatasetRegistry = registry.Registry()
 
+# Config keys that do not change preprocessed eval batches (e.g. of decoding,
+# loss or metrics, or of reading performance), which eval caches ignore.
+_EVAL_CACHE_IGNORED_TASK_KEYS = (
+    'top_k', 'top_p', 'top_p_candidates', 'temperature', 'early_stop',
+    'beam_size', 'length_penalty', 'constrain_tokens', 'num_draft_tokens',
+    'weight', 'eos_token_weight', 'noise_bbox_weight', 'class_label_corruption',
+    'metric', 'eval_outputs_json_path', 'ensemble_num_samples',
+    'ensemble_threshold')
+_EVAL_CACHE_IGNORED_DATASET_KEYS = (
+    'eval_cache_dir', 'parse_batch_size', 'interleave_parallelism',
+    'read_buffer_size', 'cache_dataset', 'buffer_size')
+
 
 class Dataset(abc.ABC):
   """A dataset that handles creating a tf.data.Dataset."""
@@ -60,15 +76,146 @@ class Dataset(abc.ABC):
     print(example.eval())
     return example
 
+  def parse_examples(self, examples):
+    """Parses a batch of serialized examples (see `parse_example`).
+
+    Args:
+      examples: `string` of (bsz,) serialized examples.
+
+    Returns:
+      a dictionary of feature name to batched tensors, which are ragged for
+      features of variable length.
+    """
+    raise NotImplementedError(
+        'Batched parsing (parse_batch_size > 0) is not supported by %s.' %
+        type(self).__name__)
+
   def filter_example(self, unused_example, unused_training):
     return True
 
+  def filter_examples(self, unused_examples, unused_training):
+    """Returns `bool` of (bsz,) whether to keep each of a batch of examples.
+
+    The batch is from `parse_examples`. Datasets that override this (along with
+    `filter_example`) are filtered in batches, see `has_batched_filter`.
+    """
+    raise NotImplementedError(
+        'Batched filtering is not supported by %s.' % type(self).__name__)
+
+  def has_batched_filter(self):
+    """Whether batches of examples can be filtered with `filter_examples`."""
+    return type(self).filter_examples is not Dataset.filter_examples
+
+  def get_source_fingerprint(self, training):
+    """Returns a `str` identifying the source data (e.g. files), or None.
+
+    None disables the eval cache (see `pipeline`) for the dataset.
+    """
+    del training
+    return None
+
+  def _get_eval_cache_path(self, batch_size, input_context):
+    """Returns the eval cache path of the input pipeline, or None."""
+    source = self.get_source_fingerprint(training=False)
+    if source is None:
+      return None
+    dataset_config = {k: v for k, v in self.config.to_dict().items()
+                      if k not in _EVAL_CACHE_IGNORED_DATASET_KEYS}
+    task_config = {k: v for k, v in self.task_config.to_dict().items()
+                   if k not in _EVAL_CACHE_IGNORED_TASK_KEYS}
+    key = json.dumps(
+        {'source': source, 'dataset': dataset_config, 'task': task_config,
+         'batch_size': batch_size},
+        sort_keys=True, default=str)
+    if input_context:
+      shard = '%d_of_%d' % (input_context.input_pipeline_id,
+                            input_context.num_input_pipelines)
+    else:
+      shard = '0_of_1'
+    return os.path.join(self.config.eval_cache_dir,
+                        hashlib.sha256(key.encode()).hexdigest()[:16], shard)
+
+  def _cache_eval_batches(self, dataset, path):
+    """Writes dataset to path once, returns the dataset loaded from it.
+
+    Writing consumes the whole dataset when the pipeline is built, so the first
+    eval preprocesses all of the split (also with `eval.steps`) before its
+    first step, without overlapping it with inference.
+    """
+    if not tf.io.gfile.exists(path):
+      logging.info('Writing eval cache to %s', path)
+      tmp_path = '%s.tmp%d' % (path, os.getpid())
+      # A single shard, to load batches in order.
+      dataset.save(tmp_path, shard_func=lambda *_: tf.constant(0, tf.int64))
+      if tf.io.gfile.exists(path):  # Written by another job meanwhile.
+        tf.io.gfile.rmtree(tmp_path)
+      else:
+        tf.io.gfile.rename(tmp_path, path)
+    logging.info('Reading eval cache from %s', path)
+    return tf.data.Dataset.load(path)
+
+  def parse_and_filter(self, dataset, training):
+    """Parses and filters serialized examples of dataset.
+
+    With `dataset.parse_batch_size` > 0, examples are parsed and filtered in
+    batches (see `parse_examples` and `filter_examples`), as per-example ops
+    have high overhead.
+
+    Args:
+      dataset: tf.data.Dataset of serialized examples.
+      training: `bool` of training vs eval mode.
+
+    Returns:
+      tf.data.Dataset of parsed examples.
+    """
+    parse_batch_size = self.config.get('parse_batch_size', 0)
+    filter_batches = parse_batch_size > 0 and self.has_batched_filter()
+    if parse_batch_size > 0:
+      def parse_and_filter_batch(examples):
+        examples = self.parse_examples(examples)
+        if filter_batches:
+          indices = tf.where(self.filter_examples(examples, training))[:, 0]
+          examples = tf.nest.map_structure(
+              lambda t: tf.gather(t, indices), examples)
+        return examples
+      dataset = dataset.batch(parse_batch_size).map(
+          parse_and_filter_batch,
+          num_parallel_calls=tf.data.experimental.AUTOTUNE
+      ).unbatch()
+    else:
+      dataset = dataset.map(
+          self.parse_example,
+          num_parallel_calls=tf.data.experimental.AUTOTUNE
+      )
+    if not filter_batches:
+      dataset = dataset.filter(lambda x: self.filter_example(x, training))
+    return dataset
+
+  def _get_image_size_key(self, features, unused_labels):
+    """Returns a `tf.int64` key of the (padded) image size of an example."""
+    size = tf.cast(tf.shape(features['image'])[-3:-1], tf.int64)
+    return size[0] * 65536 + size[1]
+
   def pipeline(self,
                process_single_example: Callable[[tf.data.Dataset, int, bool],
                                                 tf.data.Dataset],
                global_batch_size: int, training: bool):
     """Data pipeline from name to preprocessed examples.
 
+    With `task.image_size_buckets`, images are padded to the smallest fitting
+    bucket size instead of `task.image_size` in preprocessing, and batches are
+    grouped of images of the same (bucket) size. The order of examples thus
+    changes. The remainder of each bucket is dropped in training, and batched
+    into a smaller batch in eval, which is then run until the end of data.
+
+    With `dataset.eval_cache_dir`, eval batches are written to the directory
+    the first time, and later pipelines (e.g. of following checkpoints) read
+    them without parsing, decoding or preprocessing. The first write is a full
+    pass over the eval split before the first eval step. Caches are keyed by
+    the source data, the batch size and the `task` and `dataset` configs
+    except for keys that do not affect preprocessing (e.g. of decoding); clear
+    the directory after changing preprocessing code.
+
     Args:
       process_single_example: a function that takes single example dataset and
         returns processed example dataset.
@@ -86,7 +233,7 @@ class Dataset(abc.ABC):
 
       if input_context:
         batch_size = input_context.get_per_replica_batch_size(global_batch_size)
-        # Sharding is not neccesary for TFDS given read_config above.
+        # Sharding is done in load_dataset (by read_config for TFDS).
         # dataset = dataset.shard(input_context.num_input_pipelines,
         #                         input_context.input_pipeline_id)
       else:
@@ -103,13 +250,8 @@ class Dataset(abc.ABC):
         dataset = dataset.shuffle(buffer_size)
         dataset = dataset.repeat()
 
+      dataset = self.parse_and_filter(dataset, training)
       dataset = dataset.map(
-          self.parse_example,
-          num_parallel_calls=tf.data.experimental.AUTOTUNE
-      )
-      dataset = dataset.filter(
-          lambda x: self.filter_example(x, training)
-      ).map(
           lambda x: self.extract(x, training),
           num_parallel_calls=tf.data.experimental.AUTOTUNE
       )
@@ -119,10 +261,23 @@ class Dataset(abc.ABC):
 
       # TODO(b/181662974): Revert this and support non-even batch sizes.
       # dataset = dataset.batch(batch_size, drop_remainder=training)
-      dataset = dataset.padded_batch(batch_size, drop_remainder=True)
+      if self.task_config.get('image_size_buckets'):
+        dataset = dataset.group_by_window(
+            key_func=self._get_image_size_key,
+            # In eval, the last (partial) batch of each bucket is kept, so that
+            # all examples are evaluated.
+            reduce_func=lambda _, ds: ds.padded_batch(  # pylint: disable=g-long-lambda
+                batch_size, drop_remainder=training),
+            window_size=batch_size)
+      else:
+        dataset = dataset.padded_batch(batch_size, drop_remainder=True)
       if config.batch_duplicates > 1 and training:
         dataset = dataset.map(self._flatten_dims,
                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      if not training and config.get('eval_cache_dir'):
+        cache_path = self._get_eval_cache_path(batch_size, input_context)
+        if cache_path:
+          dataset = self._cache_eval_batches(dataset, cache_path)
       dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
       return dataset
 
@@ -190,6 +345,11 @@ class TFDSDataset(Dataset):
           split=split, shuffle_files=True, read_config=read_config)
     return dataset
 
+  def get_source_fingerprint(self, training):
+    split = self.config.train_split if training else self.config.eval_split
+    return '%s:%s:%s' % (self.builder.data_dir, self.builder.info.full_name,
+                         split)
+
   @property
   def num_train_examples(self):
     return self.builder.info.splits[self.config.train_split].num_examples
@@ -204,17 +364,60 @@ class TFDSDataset(Dataset):
 class TFRecordDataset(Dataset):
   """A dataset created from tfrecord files."""
 
-  def load_dataset(self, input_context, training):
-    """Load tf.data.Dataset from TFRecord files."""
+  def _get_file_pattern(self, training):
     if training or self.config.eval_split == 'train':
-      file_pattern = self.config.train_file_pattern
-    else:
-      file_pattern = self.config.val_file_pattern
-    dataset = tf.data.Dataset.list_files(file_pattern, shuffle=training)
+      return self.config.train_file_pattern
+    return self.config.val_file_pattern
+
+  def load_dataset(self, input_context, training):
+    """Load tf.data.Dataset from TFRecord files.
+
+    With multiple input pipelines (of `input_context`), each pipeline reads a
+    shard of the files, or a shard of the records if there are fewer files
+    than pipelines.
+
+    Args:
+      input_context: `tf.distribute.InputContext` or None.
+      training: `bool` of training vs eval mode.
+
+    Returns:
+      tf.data.Dataset of serialized records.
+    """
+    config = self.config
+    file_pattern = self._get_file_pattern(training)
+    files = sorted(tf.io.gfile.glob(file_pattern))
+    if not files:
+      raise ValueError('No files match %s' % file_pattern)
+    num_pipelines = input_context.num_input_pipelines if input_context else 1
+    shard_files = (config.get('shard_files', True) and
+                   len(files) >= num_pipelines)
+    shard_records = num_pipelines > 1 and not shard_files
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if num_pipelines > 1 and shard_files:
+      dataset = dataset.shard(num_pipelines, input_context.input_pipeline_id)
+    if training:
+      # Pipelines sharding records must read them in the same order.
+      dataset = dataset.shuffle(len(files), seed=0 if shard_records else None)
+    read_buffer_size = config.get('read_buffer_size', 0)
     dataset = dataset.interleave(
-        tf.data.TFRecordDataset, cycle_length=32, deterministic=not training)
+        lambda f: tf.data.TFRecordDataset(  # pylint: disable=g-long-lambda
+            f, buffer_size=read_buffer_size or None),
+        cycle_length=config.get('cycle_length', 32),
+        num_parallel_calls=config.get(
+            'interleave_parallelism', tf.data.experimental.AUTOTUNE) or None,
+        deterministic=not training or shard_records)
+    if shard_records:
+      dataset = dataset.shard(num_pipelines, input_context.input_pipeline_id)
     return dataset
 
+  def get_source_fingerprint(self, training):
+    """Returns names, sizes and modification times of the TFRecord files."""
+    files = []
+    for path in sorted(tf.io.gfile.glob(self._get_file_pattern(training))):
+      stat = tf.io.gfile.stat(path)
+      files.append('%s:%d:%d' % (path, stat.length, stat.mtime_nsec))
+    return ','.join(files)
+
   @abc.abstractmethod
   def get_feature_map(self):
     """Returns feature map(s) for parsing the TFExample.
@@ -251,6 +454,27 @@ class TFRecordDataset(Dataset):
           example[k] = tf.sparse.to_dense(example[k], default_value=0)
     return example
 
+  def parse_examples(self, examples):
+    """Parse a batch of serialized examples into a dictionary of tensors.
+
+    Args:
+      examples: `string` of (bsz,) serialized tf.train.Example.
+
+    Returns:
+      a dictionary of feature name to batched tensors, which are ragged for
+      `VarLenFeature` and `RaggedFeature`.
+    """
+    feature_map = self.get_feature_map()
+    if not isinstance(feature_map, dict):
+      raise ValueError('Batched parsing of tf.train.SequenceExample is not '
+                       'supported, set parse_batch_size=0.')
+    # Ragged outputs are cheaper than converting sparse ones.
+    feature_map = {
+        k: tf.io.RaggedFeature(v.dtype, row_splits_dtype=tf.int64)
+        if isinstance(v, tf.io.VarLenFeature) else v
+        for k, v in feature_map.items()}
+    return tf.io.parse_example(examples, feature_map)
+
   @property
   def num_train_examples(self):
     return self.config.train_num_examples
@@ -81,6 +81,58 @@ def decode_image(example):
   return image
 
 
+def decode_image_size(encoded):
+  """Returns (h, w) of an encoded image, from the header for JPEG."""
+  return tf.cond(
+      tf.io.is_jpeg(encoded),
+      lambda: tf.image.extract_jpeg_shape(encoded)[:2],
+      lambda: tf.shape(tf.io.decode_image(  # pylint: disable=g-long-lambda
+          encoded, channels=3, expand_animations=False))[:2])
+
+
+def decode_image_or_size(example, defer_decoding):
+  """Decodes the image, or returns the encoded image and its size.
+
+  Deferred decoding lets `data_utils.preprocess_train` decode only the region
+  of the image it crops.
+
+  Args:
+    example: `dict` of raw features.
+    defer_decoding: `bool` whether to defer decoding.
+
+  Returns:
+    `dict` of features with `image`, or with `image/encoded` and `image/size`
+    if defer_decoding.
+  """
+  if not defer_decoding:
+    return {'image': decode_image(example)}
+  return {'image/encoded': example['image/encoded'],
+          'image/size': decode_image_size(example['image/encoded'])}
+
+
+def decode_and_crop_image(encoded, region):
+  """Decodes region (h_offset, w_offset, h, w) of an encoded image.
+
+  Only the region is decoded for JPEG.
+
+  Args:
+    encoded: `string` encoded image.
+    region: `int32` crop window of (h_offset, w_offset, h, w).
+
+  Returns:
+    `float32` image in [0, 1] of shape (h, w, 3).
+  """
+  def decode_and_crop():
+    image = tf.io.decode_image(encoded, channels=3, expand_animations=False)
+    return tf.slice(image, [region[0], region[1], 0], [region[2], region[3], 3])
+  image = tf.cond(
+      tf.io.is_jpeg(encoded),
+      lambda: tf.image.decode_and_crop_jpeg(encoded, region, channels=3),
+      decode_and_crop)
+  image.set_shape([None, None, 3])
+  return tf.image.convert_image_dtype(image, tf.float32)
+
+
 def decode_boxes(example):
   """Concat box coordinates in the format of [ymin, xmin, ymax, xmax]."""
   xmin = example['image/object/bbox/xmin']
@@ -84,10 +84,9 @@ class Obj365Dataset(dataset_lib.TFRecordDataset):
     Returns:
       example: `dict` of relevant features and labels.
     """
-    features = {
-        'image': decode_utils.decode_image(example),
-        'image/id': self._get_source_id(example),
-    }
+    features = decode_utils.decode_image_or_size(
+        example, training and self.config.get('fused_decode_crop', False))
+    features['image/id'] = self._get_source_id(example)
     bbox = decode_utils.decode_boxes(example)
     labels = {
         'bbox_orig': bbox,
@@ -2,6 +2,7 @@ import sys
 import numpy as np
 import utils
 import vocab
+from data import data_utils
 from data import dataset as dataset_lib
 from data import decode_utils
 import tensorflow as tf
@@ -27,14 +28,19 @@ class VisualGenomeTFRecordDataset(dataset_lib.TFRecordDataset):
             return tf.shape(example['box1'])[0] > 0
         else:
             return True
+
+    def filter_examples(self, examples, training):
+        if training:
+            return examples['box1'].row_lengths() > 0
+        else:
+            return tf.ones_like(examples['image/source_id'], tf.bool)
     
     def extract(self, example, training):
-        features = {
-            'image': decode_utils.decode_image(example),
-            'image/id': tf.strings.to_number(example['image/source_id'], tf.int64),
-        }
+        features = decode_utils.decode_image_or_size(
+            example, training and self.config.get('fused_decode_crop', False))
+        features['image/id'] = tf.strings.to_number(example['image/source_id'], tf.int64)
 
-        scale = 1. / utils.tf_float32(tf.shape(features['image'])[:2])
+        scale = 1. / utils.tf_float32(data_utils.get_image_size(features))
         box1 = utils.scale_points_v2(tf.cast(tf.io.parse_tensor(example['box1'][0], tf.int32), tf.float32), scale)
         box2 = utils.scale_points_v2(tf.cast(tf.io.parse_tensor(example['box2'][0], tf.int32), tf.float32), scale)
         # box1 = tf.io.parse_tensor(example['box1'][0], tf.int32)
@@ -15,16 +15,20 @@
 # ==============================================================================
 """The image encoder and autoregressive decoder model."""
 
+import functools
+
 import ml_collections
 
 import utils
 from architectures.transformers import add_vis_pos_emb
 from architectures.transformers import AutoregressiveDecoder
+from architectures.transformers import interpolate_vis_pos_emb
 from architectures.transformers import MLP
 from architectures.transformers import ResNetTransformer
 from architectures.transformers import VisionTransformer
 from models import model as model_lib
 from models import model_utils
+from models import quantization
 import tensorflow as tf
 
 
@@ -35,18 +39,44 @@ class Model(tf.keras.models.Model):
   def __init__(self, config: ml_collections.ConfigDict, **kwargs):
     # vocab_size and max_seq_len don't include start token, which is only used
     # inside this class.
-    super().__init__(**kwargs)
     config = config.model
+    # Layers run in compute_dtype (e.g. 'bfloat16') with float32 variables,
+    # where Keras keeps layer norms in float32, and the decoder computes logits
+    # in float32.
+    compute_dtype = config.get('compute_dtype', 'float32')
+    policy = tf.keras.mixed_precision.Policy(
+        'float32' if compute_dtype == 'float32' else 'mixed_' + compute_dtype)
+    super().__init__(dtype=policy, **kwargs)
     self.config = config
 
+    # Sublayers take the global policy when created.
+    global_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+      self._build_layers(config)
+    finally:
+      tf.keras.mixed_precision.set_global_policy(global_policy)
+
+  @property
+  def jit_compile(self):
+    """Whether to XLA-compile `infer`, with static shapes in decoding."""
+    return self.decoder.static_shapes
+
+  @jit_compile.setter
+  def jit_compile(self, jit_compile):
+    self.decoder.static_shapes = jit_compile
+
+  def _build_layers(self, config):
+    """Creates the encoder, the projection and the decoder."""
     mlp_ratio = config.dim_mlp // config.dim_att
+    remat_policy = config.get('remat_policy', 'none')
     if config.resnet_variant == 'c1':
       self.encoder = VisionTransformer(
           config.image_size[0], config.image_size[1], config.patch_size,
           config.num_encoder_layers, config.dim_att, mlp_ratio,
           config.num_heads, config.drop_path, config.drop_units,
           config.drop_att, config.pos_encoding, config.use_cls_token,
-          name='vit')
+          remat_policy=remat_policy, name='vit')
     else:
       self.encoder = ResNetTransformer(
           config.image_size[0], config.image_size[1], config.resnet_variant,
@@ -54,7 +84,7 @@ class Model(tf.keras.models.Model):
           config.resnet_sk_ratio, config.num_encoder_layers, config.dim_att,
           mlp_ratio, config.num_heads, config.drop_path, config.drop_units,
           config.drop_att, config.pos_encoding, config.use_cls_token,
-          name='rest')
+          remat_policy=remat_policy, name='rest')
 
     mlp_ratio_dec = config.dim_mlp_dec // config.dim_att_dec
     self.proj = tf.keras.layers.Dense(
@@ -74,7 +104,11 @@ class Model(tf.keras.models.Model):
         config.dim_att_dec, mlp_ratio_dec, config.num_heads_dec,
         config.drop_path, config.drop_units, config.drop_att,
         config.pos_encoding_dec, config.shared_decoder_embedding,
-        config.decoder_output_bias, name='ar_decoder')
+        config.decoder_output_bias,
+        attention_window=config.get('dec_attention_window', 0),
+        attention_window_period=config.get('dec_attention_window_period', 1),
+        window_prompt_len=config.get('dec_window_prompt_len', 1),
+        remat_policy=remat_policy, name='ar_decoder')
 
   def _tile_vis_output(self, vis_output, seq):
     """Tile vis_output per seq.
@@ -101,7 +135,11 @@ class Model(tf.keras.models.Model):
     encoded = self.proj_ln(self.proj(encoded))
     # Add (optional) positional embedding to encoded visual units.
     if config.dec_proj_mode != 'linear':
-      vis_pos_emb = tf.expand_dims(self.vis_pos_emb, 0)
+      # Interpolated for images of another size (e.g. of size buckets).
+      vis_pos_emb = interpolate_vis_pos_emb(
+          self.vis_pos_emb, self.encoder.n_rows, self.encoder.n_cols,
+          *self.encoder.get_grid_size(*utils.shape_as_list(images)[1:3]))
+      vis_pos_emb = tf.expand_dims(tf.cast(vis_pos_emb, encoded.dtype), 0)
       if config.use_cls_token:
         encoded = encoded + tf.concat(
             [tf.zeros_like(vis_pos_emb[:, :1]), vis_pos_emb], 1)
@@ -113,35 +151,77 @@ class Model(tf.keras.models.Model):
         assert config.dec_proj_mode == 'linear_p'
     return encoded
 
-  def call(self, images, seq, training=True):
+  def call(self, images, seq, training=True, packed=None, project=True):
     """Model function call for *training*.
 
     Args:
       images: `float` tensor of (bsz, h, w, c).
       seq: `int` sequence visible to the model of shape (bsz, seqlen),
         or (bsz, instances, seqlen) if there are multiple sequences per image.
+        Or (rows, packed_len) with `packed`.
       training: `bool` indicator.
+      packed: optional `dict` of segment ids, image ids and positions of packed
+        sequences from `model_utils.pack_sequences`, where each row of seq
+        holds sequences of bsz // rows consecutive images.
+      project: `bool`, whether to return logits, or decoder outputs to be
+        projected to logits (see `AutoregressiveDecoder.get_output_projection`).
 
     Returns:
-      logits for each predicted tokens of (bsz * instances, seqlen, vocab_size).
+      logits for each predicted tokens of (bsz * instances, seqlen, vocab_size),
+      or (rows, packed_len, vocab_size) with `packed`. The last dimension is
+      the decoder dim instead of vocab_size if not project.
     """
     with tf.name_scope(''):  # for other functions to have the same name scope.
       encoded = self._encode_images(images, training)
-      encoded, seq = self._tile_vis_output(encoded, seq)
-      logits = self.decoder(seq, encoded, training)
-      return logits
+      if packed is None:
+        encoded, seq = self._tile_vis_output(encoded, seq)
+        return self.decoder(seq, encoded, training, project=project)
+      # Each token attends to the encoded image of its sequence among the
+      # images of its row.
+      bsz, size, dim = utils.shape_as_list(encoded)
+      rows = utils.shape_as_list(seq)[0]
+      encoded = tf.reshape(encoded, [rows, -1, dim])
+      image_ids = tf.repeat(tf.range(1, bsz // rows + 1), size)
+      mask_cross = tf.cast(tf.equal(
+          packed['image_ids'][:, tf.newaxis, :, tf.newaxis],
+          image_ids[tf.newaxis, tf.newaxis, tf.newaxis, :]), encoded.dtype)
+      return self.decoder(
+          seq, encoded, training, segment_ids=packed['segment_ids'],
+          positions=packed['positions'], mask_cross=mask_cross,
+          project=project)
+
+  def encode(self, images):
+    """Encodes images for inference.
+
+    Args:
+      images: `float` tensor of (bsz, h, w, c).
+
+    Returns:
+      cache for encoded images (see `infer`), a `dict` of `encoded` images of
+        (bsz, size, dim) and their per-layer projected cross-attention keys /
+        values `cross_kv`.
+    """
+    encoded = self._encode_images(images, training=False)
+    return {'encoded': encoded,
+            'cross_kv': self.decoder.project_cross_kv(encoded)}
 
   def infer(self, images, prompt_seq, encoded=None, max_seq_len=None,
             temperature=1, top_k=1, top_p=1., num_samples=1,
-            sampling_callback=None):
+            sampling_callback=None, early_stop=None, logits_mode='full',
+            beam_size=1, length_penalty=0., token_mask=None,
+            num_draft_tokens=0, encoded_index=None, top_p_candidates=None):
     """Model function call for inference.
 
+    This is XLA-compiled if `jit_compile` is set, where (non-tensor) arguments
+    such as logits_mode and sampling_callback are fixed for each trace.
+
     Args:
       images: `float` tensor of (bsz, h, w, c).
       prompt_seq: `int` sequence visible to the model of shape (bsz, seqlen),
         or (bsz, instances, seqlen) if there are multiple sequences per image.
-      encoded: cache for encoded images for decoder. Skip image encoding if this
-        is given.
+      encoded: cache for encoded images for decoder (as returned by a previous
+        `infer` call on the same images), or a `float` tensor of encoded images.
+        Skip image encoding if this is given.
       max_seq_len: `int` of max generated sequence length (including prompt).
       temperature: `float` scalar for scaling the logits before sampling.
       top_k: `int` scalar for truncating top-k tokens according to logits before
@@ -152,30 +232,95 @@ class Model(tf.keras.models.Model):
       sampling_callback: a callbak `function` that take `next_logits`, and
         return `next_token`. This is used when users need a specific logic
         for sampling. Default to `None` with standard free-form sampling.
+      early_stop: `None`, 'stop' or 'compact' for stopping decoding early once
+        sequences generate the padding / ending token. See
+        `AutoregressiveDecoder.infer`.
+      logits_mode: what to keep of the logits, 'full', 'token' or a `dict`.
+        See `AutoregressiveDecoder.infer`.
+      beam_size: `int` number of beams. Use beam search instead of sampling
+        (i.e. temperature, top_k, top_p, sampling_callback and early_stop are
+        unused) if this is larger than 1.
+      length_penalty: `float` alpha of length normalization for beam search.
+      token_mask: optional `bool` allowed tokens of (period, vocab_size) for
+        each generated position. See `AutoregressiveDecoder.infer`.
+      num_draft_tokens: `int` number of tokens drafted and verified per decoder
+        call. Use (experimental) parallel greedy decoding instead of sampling
+        (i.e. temperature, top_k, top_p and sampling_callback are unused) if
+        this is larger than 0. See `AutoregressiveDecoder.parallel_infer`.
+      encoded_index: optional `int` of (bsz',) for prompt_seq of (bsz', seqlen)
+        with any bsz', the index of the image (in images / encoded) of each
+        prompt, e.g. for a subset of instances of the images. Only supported
+        for sampling.
+      top_p_candidates: `int` number of largest logits to find the top-p set
+        in (0 for sorting all logits), see `transformers.top_logits`.
 
     Returns:
       pred_seq: `int` prediction sequence of shape
-          (bsz * instances * num_samples, seqlen)
+          (bsz * instances * num_samples, seqlen), or
+          (bsz' * num_samples, seqlen) with encoded_index.
       logits: `float` of shape
-          (bsz * instances * num_samples, seqlen, vocab_size)
-      encoded: `float` tensor of encoded images.
+          (bsz * instances * num_samples, seqlen, vocab_size), or the part of
+          it specified by `logits_mode`.
+      encoded: cache for encoded images, a `dict` of `encoded` images of
+          (bsz, size, dim) and their per-layer projected cross-attention
+          keys / values `cross_kv`.
     """
-    tf.print(prompt_seq[0])
-    if encoded is None:
-      encoded = self._encode_images(images, training=False)
-    encoded, prompt_seq = self._tile_vis_output(encoded, prompt_seq)
-
-    # Tile by num_samples too.
-    encoded = utils.tile_along_batch(encoded, num_samples)
-    prompt_seq = utils.tile_along_batch(prompt_seq, num_samples)
+    infer_fn = self._infer
+    if self.jit_compile:
+      infer_fn = functools.partial(_compiled_infer, self)
+    return infer_fn(images, prompt_seq, encoded, max_seq_len, temperature,
+                    top_k, top_p, num_samples, sampling_callback, early_stop,
+                    logits_mode, beam_size, length_penalty, token_mask,
+                    num_draft_tokens, encoded_index, top_p_candidates)
+
+  def _infer(self, images, prompt_seq, encoded, max_seq_len, temperature,
+             top_k, top_p, num_samples, sampling_callback, early_stop,
+             logits_mode, beam_size, length_penalty, token_mask,
+             num_draft_tokens, encoded_index, top_p_candidates):
+    """See `infer`."""
+    # Quantized weights are dequantized once rather than at every decoding step.
+    with quantization.dequantized(self):
+      if encoded is None:
+        encoded = self.encode(images)
+      elif not isinstance(encoded, dict):
+        encoded = {'encoded': encoded,
+                   'cross_kv': self.decoder.project_cross_kv(encoded)}
+
+      # Instances and samples of the same image are consecutive in the batch, so
+      # the decoder shares per-image cross-attention keys / values among them
+      # instead of tiling the encoded images.
+      prompt_seq = utils.flatten_batch_dims(prompt_seq, out_rank=2)
+      prompt_seq = utils.tile_along_batch(prompt_seq, num_samples)
+      if encoded_index is not None:
+        if num_draft_tokens > 0 or beam_size > 1:
+          raise ValueError('encoded_index is only supported for sampling.')
+        encoded_index = utils.tile_along_batch(encoded_index, num_samples)
+
+      if num_draft_tokens > 0:
+        pred_seq, logits, _ = self.decoder.parallel_infer(
+            prompt_seq, encoded['encoded'], max_seq_len, num_draft_tokens,
+            cross_kv=encoded['cross_kv'], early_stop=early_stop,
+            logits_mode=logits_mode, token_mask=token_mask)
+      elif beam_size > 1:
+        pred_seq, logits = self.decoder.beam_search(
+            prompt_seq, encoded['encoded'], max_seq_len, beam_size,
+            length_penalty, cross_kv=encoded['cross_kv'],
+            logits_mode=logits_mode, token_mask=token_mask)
+      else:
+        pred_seq, logits = self.decoder.infer(
+            prompt_seq, encoded['encoded'], max_seq_len,
+            temperature, top_k, top_p, sampling_callback,
+            cross_kv=encoded['cross_kv'], early_stop=early_stop,
+            logits_mode=logits_mode, token_mask=token_mask,
+            cross_kv_index=encoded_index, top_p_candidates=top_p_candidates)
 
-    pred_seq, logits = self.decoder.infer(
-        prompt_seq, encoded, max_seq_len,
-        temperature, top_k, top_p, sampling_callback)
+      return pred_seq, logits, encoded
 
-    tf.print(pred_seq[0])
 
-    return pred_seq, logits, encoded
+@tf.function(jit_compile=True)
+def _compiled_infer(model, *args):
+  """XLA-compiled `Model.infer`, traced once per model and static arguments."""
+  return model._infer(*args)  # pylint: disable=protected-access
 
 
 @model_lib.TrainerRegistry.register('encoder_ar_decoder')
@@ -194,14 +339,37 @@ class ARTrainer(model_lib.Trainer):
     super().__init__(config, **kwargs)
     self._metrics.update({
         'loss_notpad': tf.keras.metrics.Mean('loss_notpad'),
-        'accuracy_notpad': tf.keras.metrics.SparseCategoricalAccuracy(
-            'accuracy_notpad'),
+        'accuracy_notpad': tf.keras.metrics.Mean('accuracy_notpad'),
+    })
+    self._counters.update({
+        'images': tf.keras.metrics.Sum('images'),
+        'tokens_notpad': tf.keras.metrics.Sum('tokens_notpad'),
     })
 
   def compute_loss(self, preprocess_outputs):
-    """Compute loss based on model outputs and targets."""
+    """Compute loss based on model outputs and targets.
+
+    With `config.train.pack_factor` > 1, the sequences of pack_factor images
+    are packed into one row of `config.train.packed_seq_len` tokens (default
+    to pack_factor times the sequence length, see `model_utils.pack_sequences`),
+    so the decoder runs on fewer rows. Packed sequences end with their first
+    padding (ending) token, i.e. following padding tokens are dropped rather
+    than weighted by `eos_token_weight`. Training fails rather than dropping
+    tokens if sequences do not fit in their row.
+
+    With `config.train.loss_chunk_size` > 0, logits are projected and reduced
+    to the loss in chunks of tokens (see `model_utils.get_chunked_loss`).
+    """
     image, input_seq, target_seq, token_weights = preprocess_outputs
 
+    packed = None
+    pack_factor = self.config.train.get('pack_factor', 1)
+    if pack_factor > 1:
+      lengths = model_utils.get_seq_lengths(target_seq)
+      (input_seq, target_seq, token_weights), packed = (
+          model_utils.pack_sequences(
+              [input_seq, target_seq, token_weights], lengths, pack_factor,
+              self.config.train.get('packed_seq_len', 0) or None))
     target_seq = utils.flatten_batch_dims(target_seq, out_rank=2)
     token_weights = utils.flatten_batch_dims(token_weights, out_rank=2)
     token_weights = utils.tf_float32(token_weights)
@@ -209,9 +377,20 @@ class ARTrainer(model_lib.Trainer):
     token_weights_notpad = tf.where(
         is_padding, tf.zeros_like(token_weights), token_weights)
 
-    logits = self.model(image, input_seq)
-    losses = model_utils.get_loss(
-        logits, target_seq, self.config.train.loss_type)
+    loss_chunk_size = self.config.train.get('loss_chunk_size', 0)
+    if loss_chunk_size:
+      outputs = self.model(image, input_seq, packed=packed, project=False)
+      embedding, bias = self.model.decoder.get_output_projection()
+      losses, correct = model_utils.get_chunked_loss(
+          outputs, embedding, bias, target_seq, self.config.train.loss_type,
+          loss_chunk_size)
+    else:
+      logits = self.model(image, input_seq, packed=packed)
+      losses = model_utils.get_loss(
+          logits, target_seq, self.config.train.loss_type)
+      correct = tf.cast(tf.equal(
+          target_seq, tf.argmax(logits, -1, output_type=target_seq.dtype)),
+          tf.float32)
     loss = tf.reduce_sum(losses * token_weights) / (
         tf.reduce_sum(token_weights) + 1e-9)
     loss_notpad = tf.reduce_sum(losses * token_weights_notpad) / (
@@ -219,8 +398,9 @@ class ARTrainer(model_lib.Trainer):
 
     # update metrics
     self._metrics['loss_notpad'].update_state(loss_notpad)
-    self._metrics['accuracy_notpad'].update_state(
-        tf.boolean_mask(target_seq, tf.greater(token_weights_notpad, 0)),
-        tf.boolean_mask(logits, tf.greater(token_weights_notpad, 0)))
+    is_notpad = tf.cast(tf.greater(token_weights_notpad, 0), tf.float32)
+    self._metrics['accuracy_notpad'].update_state(correct, is_notpad)
+    self._counters['images'].update_state(tf.shape(image)[0])
+    self._counters['tokens_notpad'].update_state(tf.reduce_sum(is_notpad))
 
     return loss
@@ -0,0 +1,294 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Continuous-batching inference over a pool of decoding slots."""
+
+import itertools
+import time
+
+import numpy as np
+from architectures import transformers
+import tensorflow as tf
+
+
+class ContinuousBatchingScheduler(object):
+  """Decodes a stream of images with a fixed pool of decoding slots.
+
+  Unlike `Model.infer` on fixed batches, where a batch takes as long as its
+  longest sequence, each slot holds one image and its sequence, and a slot is
+  refilled with a new image (encoder pass and prompt) as soon as its sequence
+  generates the padding / ending token (0) or reaches `max_seq_len`. The
+  decoder is driven one step at a time for all slots, with caches indexed by
+  slot, so images at different steps are decoded together. Any number of
+  images is supported.
+
+  Sampling follows `Model.infer` with `early_stop` (tokens after the ending
+  token are padding, and logits of positions that are not generated are zero).
+
+  Usage:
+    scheduler = ContinuousBatchingScheduler(model, num_slots=64, ...)
+    for result in scheduler.run(inputs):
+      ...  # result['key'], result['pred_seq'], result['logits'].
+    logging.info(scheduler.summary())
+  """
+
+  def __init__(self, model, num_slots, max_seq_len, admit_size=None,
+               temperature=1., top_k=1, top_p=1., logits_mode='full',
+               token_mask=None, steps_per_sync=4, top_p_candidates=None):
+    """Init the scheduler.
+
+    Args:
+      model: `Model` of `encoder_ar_decoder`.
+      num_slots: `int` number of sequences decoded together.
+      max_seq_len: `int` of max generated sequence length (including prompt).
+      admit_size: `int` number of images encoded together when admitting them
+        into free slots. Default to num_slots // 4.
+      temperature: `float` scalar for scaling the logits before sampling.
+      top_k: `int` scalar for truncating top-k tokens according to logits before
+        token sampling.
+      top_p: `float` scalar specifying the threshold of cumulative probablity
+        for truncating tokens before token sampling.
+      logits_mode: what to keep of the logits, see
+        `AutoregressiveDecoder.infer`.
+      token_mask: optional `bool` allowed tokens of (period, vocab_size) or the
+        equivalent additive bias, see `AutoregressiveDecoder.infer`.
+      steps_per_sync: `int` number of decoding steps between checking for
+        finished sequences (and admitting new images).
+      top_p_candidates: `int` number of largest logits to find the top-p set
+        in (0 for sorting all logits), see `transformers.top_logits`.
+    """
+    self.model = model
+    self.decoder = model.decoder
+    self.num_slots = num_slots
+    self.max_seq_len = max_seq_len
+    self.admit_size = admit_size or max(num_slots // 4, 1)
+    if self.admit_size > num_slots:
+      raise ValueError('admit_size %d is larger than num_slots %d' % (
+          self.admit_size, num_slots))
+    self.temperature = temperature
+    self.top_k = top_k
+    self.top_p = top_p
+    self.top_p_candidates = top_p_candidates
+    self.logits_mode = logits_mode
+    self.token_bias = None
+    if token_mask is not None:
+      self.token_bias = transformers.token_mask_to_bias(token_mask)
+    self.steps_per_sync = steps_per_sync
+    self._admit_fn = tf.function(self._admit)
+    self._decode_fn = tf.function(self._decode)
+    self._state = None
+    self._latencies = []
+    self._elapsed = 0.
+
+  def _sample(self, logits, pos):
+    """Samples next tokens of logits (slots, vocab) at generated positions."""
+    if self.token_bias is not None:
+      period = tf.shape(self.token_bias)[0]
+      logits += tf.gather(self.token_bias, pos % period)
+    logits = logits / tf.cast(self.temperature, tf.float32)
+    logits = transformers.top_logits(
+        logits, k=self.top_k, p=self.top_p,
+        num_candidates=self.top_p_candidates)
+    return tf.random.categorical(logits, num_samples=1, dtype=tf.int64)[:, 0]
+
+  def _init_state(self, cross_kv, prompt_len):
+    """Returns empty slots for cross_kv (of a batch) and prompt_len."""
+    num_kept, kept_shape, init_value, _ = transformers.kept_logits_spec(
+        self.logits_mode, self.max_seq_len - prompt_len,
+        self.decoder.vocab_size)
+    cache_shape = [
+        self.decoder.num_layers, self.num_slots, self.max_seq_len - 1,
+        self.decoder.num_heads, self.decoder.dim // self.decoder.num_heads]
+    return {
+        'cross_kv': tf.nest.map_structure(
+            lambda t: tf.zeros([self.num_slots] + t.shape[1:].as_list(),
+                               t.dtype), cross_kv),
+        'k_caches': tf.zeros(cache_shape, self.decoder.compute_dtype),
+        'v_caches': tf.zeros(cache_shape, self.decoder.compute_dtype),
+        'tokens': tf.zeros([self.num_slots, self.max_seq_len], tf.int64),
+        'positions': tf.zeros([self.num_slots], tf.int32),
+        'done': tf.ones([self.num_slots], tf.bool),
+        'logits': tf.fill([self.num_slots, num_kept + 1] + kept_shape,
+                          init_value),
+    }
+
+  def _admit(self, state, images, prompt, is_admitted, sources):
+    """Admits images into slots.
+
+    Args:
+      state: a `dict` of slots.
+      images: `float` images of (admit_size, h, w, c).
+      prompt: `int` prompts of (admit_size, prompt_len).
+      is_admitted: `bool` of (slots,) for slots to admit images to.
+      sources: `int` of (slots,) for the image of each admitted slot.
+
+    Returns:
+      the updated state.
+    """
+    _, prompt_len = transformers.get_shape(prompt)
+    cross_kv = self.model.encode(images)['cross_kv']
+    next_logits, (k, v) = self.decoder.decode_prompt(prompt, cross_kv)
+    first_token = self._sample(next_logits, tf.zeros([1], tf.int32))
+
+    def admit(new, old, axis=0):
+      new = tf.gather(new, sources, axis=axis)
+      shape = [1] * new.shape.rank
+      shape[axis] = self.num_slots
+      return tf.where(tf.reshape(is_admitted, shape), new, old)
+
+    pad_len = self.max_seq_len - 1 - prompt_len
+    k = tf.pad(k, [[0, 0], [0, 0], [0, pad_len], [0, 0], [0, 0]])
+    v = tf.pad(v, [[0, 0], [0, 0], [0, pad_len], [0, 0], [0, 0]])
+    tokens = tf.concat([
+        tf.cast(prompt, tf.int64), first_token[:, tf.newaxis],
+        tf.zeros([tf.shape(prompt)[0], pad_len], tf.int64)], 1)
+    num_kept, kept_shape, init_value, get_logits_update = (
+        transformers.kept_logits_spec(
+            self.logits_mode, self.max_seq_len - prompt_len,
+            self.decoder.vocab_size))
+    slot, update = get_logits_update(0, next_logits, first_token)
+    logits = tf.fill([tf.shape(prompt)[0], num_kept + 1] + kept_shape,
+                     init_value)
+    logits = transformers.update_slice(
+        logits, update[:, tf.newaxis], slot, axis=1)
+    done = tf.logical_or(tf.equal(first_token, 0),
+                         prompt_len >= self.max_seq_len - 1)
+    return {
+        'cross_kv': tf.nest.map_structure(admit, cross_kv, state['cross_kv']),
+        'k_caches': admit(k, state['k_caches'], axis=1),
+        'v_caches': admit(v, state['v_caches'], axis=1),
+        'tokens': admit(tokens, state['tokens']),
+        'positions': tf.where(is_admitted, prompt_len, state['positions']),
+        'done': admit(done, state['done']),
+        'logits': admit(logits, state['logits']),
+    }
+
+  def _decode(self, state, prompt_len):
+    """Runs `steps_per_sync` decoding steps of all slots that are not done."""
+    _, _, _, get_logits_update = transformers.kept_logits_spec(
+        self.logits_mode, self.max_seq_len - prompt_len,
+        self.decoder.vocab_size)
+    state = dict(state)
+    for _ in range(self.steps_per_sync):
+      positions, done = state['positions'], state['done']
+      tokens = tf.gather(state['tokens'], positions, batch_dims=1)
+      next_logits, (state['k_caches'], state['v_caches']) = (
+          self.decoder.decode_slots(
+              tokens, positions, state['cross_kv'],
+              (state['k_caches'], state['v_caches'])))
+      pos = positions + 1 - prompt_len  # Generated position of next tokens.
+      next_token = self._sample(next_logits, pos)
+      next_token = tf.where(done, tf.zeros_like(next_token), next_token)
+
+      # Slots that are done are left as they are (and write logits to the
+      # extra last slot).
+      next_positions = tf.where(done, positions, positions + 1)
+      is_written = tf.logical_and(
+          tf.logical_not(done)[:, tf.newaxis],
+          tf.one_hot(next_positions, self.max_seq_len, on_value=True,
+                     off_value=False))
+      state['tokens'] = tf.where(
+          is_written, next_token[:, tf.newaxis], state['tokens'])
+      slot, update = get_logits_update(pos, next_logits, next_token)
+      num_kept = transformers.get_shape(state['logits'])[1] - 1
+      slot = tf.where(done, num_kept, slot)
+      state['logits'] = tf.tensor_scatter_nd_update(
+          state['logits'], tf.stack([tf.range(self.num_slots), slot], -1),
+          update)
+      state['positions'] = next_positions
+      state['done'] = tf.logical_or(done, tf.logical_or(
+          tf.equal(next_token, 0), next_positions >= self.max_seq_len - 1))
+    return state
+
+  def run(self, inputs):
+    """Decodes the given images, and yields results as they finish.
+
+    Args:
+      inputs: an iterable of (key, image, prompt) for each image, where image
+        is a `float` tensor of (h, w, c) and prompt is a `int` tensor of
+        (prompt_len,), with the same shapes for all images.
+
+    Yields:
+      a `dict` for each image with the given `key`, `pred_seq` of
+        (max_seq_len - prompt_len,), `logits` in the shape given by
+        `logits_mode` (see `Model.infer` for a single image), and `latency` in
+        seconds from admission to the result.
+    """
+    inputs = iter(inputs)
+    self._latencies = []
+    self._elapsed = 0.
+    keys = [None] * self.num_slots
+    admit_time = np.zeros([self.num_slots])
+    is_active = np.zeros([self.num_slots], bool)
+    start_time = time.time()
+    exhausted = False
+    while True:
+      # Admit new images when there are enough free slots for a full admission
+      # batch, or the remaining images.
+      num_free = self.num_slots - is_active.sum()
+      if not exhausted and num_free >= self.admit_size:
+        batch = list(itertools.islice(inputs, self.admit_size))
+        exhausted = len(batch) < self.admit_size
+        if batch:
+          admitted = np.flatnonzero(~is_active)[:len(batch)]
+          is_admitted = np.zeros([self.num_slots], bool)
+          is_admitted[admitted] = True
+          sources = np.zeros([self.num_slots], np.int32)
+          sources[admitted] = np.arange(len(batch))
+          # Pad to the admission batch size (padding images are not admitted).
+          padded = batch + batch[-1:] * (self.admit_size - len(batch))
+          images = tf.stack([image for _, image, _ in padded])
+          prompt = tf.stack([prompt for _, _, prompt in padded])
+          prompt_len = int(prompt.shape[1])
+          if self._state is None:
+            self._state = self._init_state(
+                self.model.encode(images[:1])['cross_kv'], prompt_len)
+          self._state = self._admit_fn(
+              self._state, images, prompt, tf.constant(is_admitted),
+              tf.constant(sources))
+          for slot, (key, _, _) in zip(admitted, batch):
+            keys[slot] = key
+            admit_time[slot] = time.time()
+            is_active[slot] = True
+      if not is_active.any():
+        break
+
+      self._state = self._decode_fn(self._state, prompt_len)
+      is_finished = np.logical_and(self._state['done'].numpy(), is_active)
+      if is_finished.any():
+        slots = np.flatnonzero(is_finished)
+        tokens = tf.gather(self._state['tokens'], slots).numpy()
+        logits = tf.gather(self._state['logits'], slots).numpy()
+        now = time.time()
+        for i, slot in enumerate(slots):
+          self._latencies.append(now - admit_time[slot])
+          is_active[slot] = False
+          yield {'key': keys[slot], 'pred_seq': tokens[i, prompt_len:],
+                 'logits': logits[i, :-1], 'latency': now - admit_time[slot]}
+    self._elapsed = time.time() - start_time
+
+  def summary(self):
+    """Returns a `dict` of throughput and latency statistics of the last run."""
+    latencies = np.array(self._latencies)
+    if not latencies.size:
+      return {'num_images': 0}
+    return {
+        'num_images': latencies.size,
+        'images_per_sec': latencies.size / self._elapsed,
+        'latency_mean': latencies.mean(),
+        'latency_p50': np.percentile(latencies, 50),
+        'latency_p90': np.percentile(latencies, 90),
+        'latency_max': latencies.max(),
+    }
@@ -79,51 +79,130 @@ class Trainer(abc.ABC):
     self._metrics.update({
         f'loss_{t.name}': tf.keras.metrics.Mean(f'loss_{t.name}')
         for t in config.tasks})
-    self._print_params = True
+    # Counts of processed examples, reported per second (see `counters`).
+    self._counters = {}
+    self._num_params = None
 
   def train_step(self, examples, tasks, strategy):
     """Defines a single training step for model update given examples and tasks.
 
+    Losses of all tasks are combined under a single tape. With
+    `config.train.grad_accum_steps` > 1, gradients of grad_accum_steps
+    micro-batches are averaged for a single update, which approximates an
+    update on a batch of all micro-batches with less memory. Micro-batches
+    after the first are run in a `tf.while_loop`, so that the traced step does
+    not grow with grad_accum_steps.
+
     Args:
       examples: a list of data examples to be fed into the paired task class for
-        preprocessing.
+        preprocessing, or with `config.train.grad_accum_steps` > 1, a list of
+        grad_accum_steps micro-batches of data examples for each task.
       tasks: a list of tasks that provide preprocessing and postprocessing for
         specific task.
       strategy: tensorflow strategy such as `TPUStrategy` or `MirroredStrategy`.
     """
     logging.info('train_step begins...')
-    # for key in examples[0][1]:
-    #   tf.print(key, examples[0][1][key].shape, examples[0][1][key][0])
-    preprocessed_outputs = [
-        t.preprocess_batched(e, training=True) for e, t in zip(examples, tasks)]
-
-    task_loss_metrics = {}
-    loss = 0
-    grads = []
-    for i, (o, task) in enumerate(zip(preprocessed_outputs, tasks)):
+    grad_accum_steps = self._config.train.get('grad_accum_steps', 1)
+
+    def compute_grads(examples):
+      """Returns loss, task losses and grads of a (micro-)batch per task."""
+      preprocessed_outputs = [
+          t.preprocess_batched(e, training=True)
+          for e, t in zip(examples, tasks)]
       with tf.GradientTape() as tape:
-        loss_t = self.compute_loss(o)
-        task_loss_metrics[f'loss_{task.config.task.name}'] = loss_t
-        loss += loss_t * task.config.task.weight
-        trainable_variables = self._model.trainable_variables
-        grads_t = tape.gradient(  # div by num_replicas_in_sync for mean grad.
-            loss_t * task.config.task.weight / strategy.num_replicas_in_sync,
-            trainable_variables)
-        grads = grads_t if i == 0 else [
-            g + gt for g, gt in zip(grads, grads_t)]
+        loss = 0
+        task_losses = []
+        for o, task in zip(preprocessed_outputs, tasks):
+          loss_t = self.compute_loss(o)
+          task_losses.append(loss_t)
+          loss += loss_t * task.config.task.weight
+        # div by num_replicas_in_sync and grad_accum_steps for mean grad.
+        scaled_loss = loss / (
+            strategy.num_replicas_in_sync * grad_accum_steps)
+      # Read after the forward pass, which builds the model at the first step.
+      trainable_variables = self._model.trainable_variables
+      return loss, task_losses, tape.gradient(scaled_loss, trainable_variables)
+
+    def add_grads(grads, grads_step):
+      """Adds gradients, where None is for variables without gradients."""
+      return [g if gs is None else gs if g is None else
+              tf.convert_to_tensor(g) + tf.convert_to_tensor(gs)
+              for g, gs in zip(grads, grads_step)]
+
+    if grad_accum_steps == 1:
+      loss, task_losses, grads = compute_grads(examples)
+    else:
+      get_step = lambda step: [e[step] for e in examples]
+      # The first micro-batch (which also builds any unbuilt layers) finds the
+      # variables with gradients, which are then accumulated (densely) over the
+      # others.
+      loss, task_losses, grads = compute_grads(get_step(0))
+      accum = [i for i, g in enumerate(grads) if g is not None]
+      grads = [None if g is None else tf.convert_to_tensor(g) for g in grads]
+      # With mirrored sync batch norm, its all-reduce (a merge_call) can only
+      # be traced outside of loops, so micro-batches are unrolled.
+      unroll = strategy.num_replicas_in_sync > 1 and not isinstance(
+          strategy, tf.distribute.TPUStrategy) and any(
+              isinstance(l, tf.keras.layers.experimental.SyncBatchNormalization)
+              for l in self._model.submodules)
+      if unroll:
+        for step in range(1, grad_accum_steps):
+          loss_step, task_losses_step, grads_step = compute_grads(
+              get_step(step))
+          loss += loss_step
+          task_losses = [a + b for a, b in zip(task_losses, task_losses_step)]
+          grads = add_grads(grads, grads_step)
+      else:
+        # Stacked micro-batches, and a loop over them so that the graph (and
+        # compile time) does not grow with grad_accum_steps.
+        micro_batches = [
+            tf.nest.map_structure(lambda *t: tf.stack(t), *e)
+            for e in examples]
+
+        def accumulate(step, loss, task_losses, accum_grads):
+          loss_step, task_losses_step, grads_step = compute_grads(
+              [tf.nest.map_structure(lambda t: t[step], e)
+               for e in micro_batches])
+          return (step + 1, loss + loss_step,
+                  [a + b for a, b in zip(task_losses, task_losses_step)],
+                  add_grads(accum_grads, [grads_step[i] for i in accum]))
+
+        _, loss, task_losses, accum_grads = tf.while_loop(
+            lambda step, *_: step < grad_accum_steps, accumulate,
+            (tf.constant(1), loss, task_losses, [grads[i] for i in accum]),
+            parallel_iterations=1)
+        for i, g in zip(accum, accum_grads):
+          grads[i] = g
+      loss /= grad_accum_steps
+      task_losses = [l / grad_accum_steps for l in task_losses]
+    task_loss_metrics = {f'loss_{t.config.task.name}': 0. for t in tasks}
+    for task, loss_t in zip(tasks, task_losses):
+      task_loss_metrics[f'loss_{task.config.task.name}'] += loss_t
+    trainable_variables = self._model.trainable_variables
     self._optimizer.apply_gradients(zip(grads, trainable_variables))
     # Update metrics.
     self._metrics['loss'].update_state(loss)
     for k, v in task_loss_metrics.items():
       self._metrics[k].update_state(v)
-    wmx = [tf.reduce_max(tf.math.abs(m)) for m in trainable_variables]
-    self._metrics['weight_linf_norm'].update_state(tf.reduce_max(wmx))
-    multiplier = strategy.num_replicas_in_sync
-    self._metrics['grad_global_norm'].update_state(tf.linalg.global_norm(
-        [tf.math.scalar_mul(multiplier, g) for g in grads if g is not None]))
-    self._metrics['total_num_params'].update_state(
-        utils.count_params(self._model, verbose=self._print_params))
-    self._print_params = False
+    if self._num_params is None:
+      self._num_params = utils.count_params(self._model)
+
+    # Diagnostics scanning all weights, every `telemetry_steps` steps.
+    def update_diagnostics():
+      wmx = [tf.reduce_max(tf.math.abs(m)) for m in trainable_variables]
+      self._metrics['weight_linf_norm'].update_state(tf.reduce_max(wmx))
+      multiplier = strategy.num_replicas_in_sync
+      self._metrics['grad_global_norm'].update_state(tf.linalg.global_norm(
+          [tf.math.scalar_mul(multiplier, g) for g in grads if g is not None]))
+      self._metrics['total_num_params'].update_state(self._num_params)
+      return tf.constant(True)
+
+    telemetry_steps = self._config.train.get('telemetry_steps', 1)
+    if telemetry_steps == 1:
+      update_diagnostics()
+    else:
+      tf.cond(tf.equal(self._optimizer.iterations % telemetry_steps, 0),
+              update_diagnostics, lambda: tf.constant(False))
     logging.info('train_step ends...')
 
   @abc.abstractmethod
@@ -142,6 +221,8 @@ class Trainer(abc.ABC):
     """Reseting the metrics and/or other state accumulators."""
     for k, _ in self._metrics.items():
       self._metrics[k].reset_states()
+    for k, _ in self._counters.items():
+      self._counters[k].reset_states()
 
   @property
   def model(self):
@@ -153,6 +234,11 @@ class Trainer(abc.ABC):
     """Returns optimizer instance."""
     return self._optimizer
 
+  @property
+  def counters(self):
+    """Returns `dict` of `Sum` metrics of processed examples since reset."""
+    return self._counters
+
   @property
   def learning_rate(self):
     """Returns learning rate scheduling instance."""
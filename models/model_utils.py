@@ -218,6 +218,86 @@ def build_optimizer(config, learning_rate):
     raise ValueError('Unknown optimizer {}'.format(config.optimizer))
 
 
+def _extract_loss_param(loss_type, default='0'):
+  # loss_type is in `loss|loss@param` format where param is loss param.
+  if '@' in loss_type:
+    return loss_type.split('@')[1]
+  return default
+
+
+def get_sparse_xent(logits, label_seq, label_smoothing=0.):
+  """Returns softmax cross entropy with sparse labels and label smoothing.
+
+  This equals `tf.keras.losses.CategoricalCrossentropy` on one-hot labels with
+  label_smoothing, without materializing the (smoothed) one-hot labels.
+
+  Args:
+    logits: `float` tensor of shape (..., vocab_size).
+    label_seq: `int` tensor of shape (...).
+    label_smoothing: `float` in [0, 1], where labels are smoothed towards the
+      uniform distribution over the vocab.
+
+  Returns:
+    per token loss tensor of shape (...).
+  """
+  loss = tf.nn.sparse_softmax_cross_entropy_with_logits(label_seq, logits)
+  if label_smoothing > 0:
+    # Cross entropy with uniform labels is logsumexp(logits) - mean(logits).
+    uniform_loss = tf.reduce_logsumexp(logits, -1) - tf.reduce_mean(logits, -1)
+    loss = (1. - label_smoothing) * loss + label_smoothing * uniform_loss
+  return loss
+
+
+def get_chunked_loss(outputs, embedding, bias, label_seq, loss_type,
+                     chunk_size):
+  """Returns loss of logits projected from decoder outputs in chunks.
+
+  Logits of each chunk of chunk_size tokens are projected, reduced to the loss
+  and recomputed in the backward pass (`tf.recompute_grad`), so that only
+  (bsz, chunk_size, vocab_size) logits are alive at a time instead of
+  (bsz, seqlen, vocab_size) logits and one-hot labels.
+
+  Args:
+    outputs: `float` decoder outputs of shape (bsz, seqlen, dim).
+    embedding: `float` output token embedding of shape (vocab_size, dim).
+    bias: `float` output bias of shape (vocab_size,), or None.
+    label_seq: tensor of shape (bsz, seqlen).
+    loss_type: string of loss type, which only supports `xent` (with label
+      smoothing as `xent@param`).
+    chunk_size: `int` number of tokens per chunk.
+
+  Returns:
+    per token loss tensor of shape (bsz, seqlen).
+    `float` tensor of shape (bsz, seqlen), 1 if the label is the argmax of
+      logits else 0.
+  """
+  if 'xent' not in loss_type:
+    raise ValueError('Chunked loss does not support loss type {}'.format(
+        loss_type))
+  label_smoothing = float(_extract_loss_param(loss_type))
+  if bias is None:
+    bias = tf.zeros([embedding.shape[0]], embedding.dtype)
+
+  @tf.recompute_grad
+  def chunk_loss(outputs, embedding, bias, labels):
+    logits = tf.nn.bias_add(
+        tf.matmul(outputs, embedding, transpose_b=True), bias)
+    logits = tf.cast(logits, tf.float32)
+    correct = tf.cast(tf.equal(
+        tf.argmax(logits, -1, output_type=labels.dtype), labels), tf.float32)
+    return get_sparse_xent(logits, labels, label_smoothing), correct
+
+  seqlen = outputs.shape[1]
+  losses, corrects = [], []
+  for i in range(0, seqlen, chunk_size):
+    loss, correct = chunk_loss(
+        outputs[:, i:i + chunk_size], embedding, bias,
+        label_seq[:, i:i + chunk_size])
+    losses.append(loss)
+    corrects.append(tf.stop_gradient(correct))
+  return tf.concat(losses, 1), tf.concat(corrects, 1)
+
+
 def get_loss(logits, label_seq, loss_type):
   """Returns loss.
 
@@ -229,19 +309,12 @@ def get_loss(logits, label_seq, loss_type):
   Returns:
     per token loss tensor of shape (bsz, seqlen).
   """
-  def _extract_loss_param(loss_type, default='0'):
-    # loss_type is in `loss|loss@param` format where param is loss param.
-    if '@' in loss_type:
-      return loss_type.split('@')[1]
-    return default
-
-  label_hot = tf.cast(tf.one_hot(label_seq, tf.shape(logits)[-1]), logits.dtype)
   if 'xent' in loss_type:
     label_smoothing = float(_extract_loss_param(loss_type))
-    loss = tf.keras.losses.CategoricalCrossentropy(
-        from_logits=True, label_smoothing=label_smoothing,
-        reduction=tf.keras.losses.Reduction.NONE)(label_hot, logits)
-  elif 'logistic' in loss_type:
+    return get_sparse_xent(logits, label_seq, label_smoothing)
+
+  label_hot = tf.cast(tf.one_hot(label_seq, tf.shape(logits)[-1]), logits.dtype)
+  if 'logistic' in loss_type:
     label_smoothing = float(_extract_loss_param(loss_type))
     logits -= tf.math.log(tf.cast(logits.shape[1], tf.float32))
     if label_smoothing > 0:
@@ -261,3 +334,81 @@ def get_loss(logits, label_seq, loss_type):
   return loss
 
 
+def get_seq_lengths(target_seq):
+  """Returns lengths of sequences up to and including the first padding token.
+
+  Args:
+    target_seq: `int` target sequences of shape (..., seqlen), padded with 0
+      which also acts as the ending token.
+
+  Returns:
+    `int32` lengths of shape (...), which are seqlen without padding.
+  """
+  seqlen = tf.shape(target_seq)[-1]
+  is_padding = tf.cast(tf.equal(target_seq, 0), tf.int32)
+  return tf.where(
+      tf.reduce_any(is_padding > 0, -1),
+      tf.argmax(is_padding, -1, output_type=tf.int32) + 1, seqlen)
+
+
+def pack_sequences(seqs, lengths, pack_factor, packed_len=None):
+  """Packs sequences of pack_factor consecutive images into one row each.
+
+  The first lengths[i] tokens of each sequence i are concatenated into rows of
+  packed_len tokens, where the rest of rows is padded with 0. Sequences are
+  never truncated: an `InvalidArgumentError` is raised if those of a row do
+  not fit in packed_len tokens.
+
+  Args:
+    seqs: a `list` of tensors of the same shape (bsz, seqlen) or
+      (bsz, instances, seqlen) (e.g. input / target sequences and weights),
+      which are packed alike.
+    lengths: `int` number of tokens to keep for each sequence, of shape (bsz,)
+      or (bsz, instances).
+    pack_factor: `int` number of images per row, which divides bsz.
+    packed_len: `int` length of rows. Default to pack_factor * seqlen (and
+      instances), which fits any sequences.
+
+  Returns:
+    packed seqs, each of shape (bsz // pack_factor, packed_len).
+    a `dict` of `int32` tensors of shape (bsz // pack_factor, packed_len) with
+      `segment_ids` (the 1-based index of the sequence of each token in its
+      row), `image_ids` (the 1-based index of the image of each token in its
+      row) and `positions` (the position of each token in its sequence). They
+      are 0 for padding.
+  """
+  shape = seqs[0].shape.as_list()
+  bsz, seqlen = shape[0], shape[-1]
+  instances = shape[1] if len(shape) > 2 else 1
+  rows, num_segments = bsz // pack_factor, pack_factor * instances
+  if packed_len is None:
+    packed_len = num_segments * seqlen
+  lengths = tf.reshape(lengths, [rows, num_segments])
+  tf.debugging.assert_less_equal(
+      tf.reduce_sum(lengths, 1), packed_len,
+      message='Packed sequences do not fit in packed_len tokens, which '
+      'would drop them from the loss. Increase packed_len.')
+  offsets = tf.cumsum(lengths, axis=1, exclusive=True)
+  steps = tf.range(seqlen)
+  columns = offsets[..., tf.newaxis] + steps  # (rows, num_segments, seqlen)
+  keep = steps < lengths[..., tf.newaxis]
+  # Padding tokens go to an extra column, which is removed after packing.
+  columns = tf.where(keep, columns, packed_len)
+  indices = tf.stack(
+      [tf.broadcast_to(tf.range(rows)[:, tf.newaxis, tf.newaxis],
+                       [rows, num_segments, seqlen]), columns], -1)
+
+  def pack(seq):
+    seq = tf.reshape(seq, [rows, num_segments, seqlen])
+    seq = tf.where(keep, seq, tf.zeros_like(seq))
+    return tf.scatter_nd(indices, seq, [rows, packed_len + 1])[:, :packed_len]
+
+  segments = tf.range(1, num_segments + 1)[:, tf.newaxis]
+  packed = {
+      'segment_ids': segments,
+      'image_ids': (segments - 1) // instances + 1,
+      'positions': steps[tf.newaxis],
+  }
+  packed = {k: pack(tf.broadcast_to(v, [rows, num_segments, seqlen]))
+            for k, v in packed.items()}
+  return [pack(seq) for seq in seqs], packed
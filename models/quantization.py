@@ -0,0 +1,242 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Post-training int8 weight quantization of the encoder-decoder model.
+
+Kernels of dense layers (e.g. in `MLP`, the `MultiHeadAttention` projections
+and the decoder projection) and the decoder token embeddings are stored as
+symmetric per-channel int8 values with float32 scales. Activations stay in the
+compute dtype, i.e. weights are dequantized on use: within `dequantized` (e.g.
+once per `Model.infer` call rather than at every decoding step), or else at
+every call.
+
+This is weight (checkpoint and stored model) compression, not a compute
+speedup: matmuls still run in the compute dtype, on a float copy of the weights
+during inference. Integer matmuls of stock TensorFlow on CPU are slower than
+float ones, see `benchmarks/int8_decoding.py` for decoding time against float.
+"""
+
+import contextlib
+
+from absl import logging
+import tensorflow as tf
+
+# Equation of `tf.keras.layers.Dense` in terms of `EinsumDense`.
+_DENSE_EQUATION = '...a,ab->...b'
+
+
+def quantize_per_channel(weights, reduce_axes):
+  """Symmetric int8 quantization with a scale per channel.
+
+  Args:
+    weights: `float` tensor.
+    reduce_axes: `list` of axes sharing a scale, all other axes are channels.
+
+  Returns:
+    `int8` values of the same shape as weights, where
+      weights ~= values * scales (with scales broadcast along reduce_axes).
+    `float32` scales of the channel axes of weights.
+  """
+  weights = tf.cast(weights, tf.float32)
+  scales = tf.reduce_max(tf.abs(weights), axis=reduce_axes, keepdims=True)
+  scales = tf.maximum(scales, 1e-8) / 127.
+  values = tf.clip_by_value(tf.round(weights / scales), -127., 127.)
+  return tf.cast(values, tf.int8), tf.squeeze(scales, reduce_axes)
+
+
+def _constant_weight(layer, name, value):
+  return layer.add_weight(
+      name=name, shape=value.shape, dtype=value.dtype, trainable=False,
+      initializer=lambda shape, dtype: value)
+
+
+class QuantizedDense(tf.keras.layers.Layer):
+  """A `Dense` or `EinsumDense` layer with per-output-channel int8 kernel."""
+
+  def __init__(self, layer, **kwargs):
+    """Quantizes the kernel of a built `Dense` or `EinsumDense` layer."""
+    super(QuantizedDense, self).__init__(
+        name=layer.name, dtype=layer.dtype_policy, **kwargs)
+    self.equation = getattr(layer, 'equation', _DENSE_EQUATION)
+    self.activation = layer.activation
+    inputs, outputs = self.equation.split('->')
+    kernel_axes = inputs.split(',')[1]
+    reduce_axes = [i for i, a in enumerate(kernel_axes) if a not in outputs]
+    kernel, kernel_scale = quantize_per_channel(layer.kernel, reduce_axes)
+    self.kernel = _constant_weight(self, 'kernel', kernel)
+    self.kernel_scale = _constant_weight(self, 'kernel_scale', kernel_scale)
+    self.bias = None
+    if layer.bias is not None:
+      self.bias = _constant_weight(
+          self, 'bias', tf.convert_to_tensor(layer.bias))
+    self.cached_kernels = {}  # Dequantized kernels by dtype.
+
+  @staticmethod
+  def supports(layer):
+    """Whether the output channels of layer are the last axes of its outputs.
+
+    This holds for `Dense` and the `EinsumDense` layers of `MultiHeadAttention`
+    so that per-channel scales can be applied to the outputs.
+    """
+    if not layer.built:
+      return False
+    if isinstance(layer, tf.keras.layers.Dense):
+      return True
+    if not isinstance(layer, tf.keras.layers.EinsumDense):
+      return False
+    inputs, outputs = layer.equation.split('->')
+    kernel_axes = inputs.split(',')[1]
+    channel_axes = ''.join(a for a in kernel_axes if a in outputs)
+    return kernel_axes.endswith(channel_axes) and outputs.endswith(channel_axes)
+
+  def dequantize(self, dtype):
+    """Returns the kernel in dtype (cached within `dequantized`)."""
+    if tf.as_dtype(dtype) in self.cached_kernels:
+      return self.cached_kernels[tf.as_dtype(dtype)]
+    # Scales are of the output channel axes, which are the last kernel axes.
+    return tf.cast(self.kernel, dtype) * tf.cast(self.kernel_scale, dtype)
+
+  def call(self, x):
+    kernel = self.dequantize(x.dtype)
+    if self.equation == _DENSE_EQUATION:  # As in `Dense`, faster than einsum.
+      x = tf.tensordot(x, kernel, [[x.shape.rank - 1], [0]])
+    else:
+      x = tf.einsum(self.equation, x, kernel)
+    if self.bias is not None:
+      x += tf.cast(self.bias, x.dtype)
+    if self.activation is not None:
+      x = self.activation(x)
+    return x
+
+
+class QuantizedEmbedding(tf.keras.layers.Layer):
+  """Token embeddings of (vocab_size, dim) with per-token int8 values."""
+
+  def __init__(self, embedding, name, dtype=None, **kwargs):
+    super(QuantizedEmbedding, self).__init__(name=name, dtype=dtype, **kwargs)
+    values, scales = quantize_per_channel(embedding, [1])
+    self.values = _constant_weight(self, 'values', values)
+    self.scales = _constant_weight(self, 'scales', scales)
+    self.cached_kernels = {}  # Dequantized embeddings by dtype.
+
+  def dequantize(self, dtype):
+    """Returns the embeddings in dtype (cached within `dequantized`)."""
+    if tf.as_dtype(dtype) in self.cached_kernels:
+      return self.cached_kernels[tf.as_dtype(dtype)]
+    return tf.cast(self.values, dtype) * tf.cast(
+        self.scales[:, tf.newaxis], dtype)
+
+
+@contextlib.contextmanager
+def dequantized(model):
+  """Dequantizes the quantized weights of model once for calls in the context.
+
+  Quantized layers otherwise dequantize their weights at every call, e.g. at
+  every step of the decoding loop. Weights are dequantized to the compute
+  dtype of model, and token embeddings also to float32 (for the output
+  projection). No-op for models that are not quantized.
+
+  Args:
+    model: `ar_model.Model` instance.
+
+  Yields:
+    None.
+  """
+  dtypes = {QuantizedDense: [model.compute_dtype],
+            QuantizedEmbedding: [model.compute_dtype, tf.float32]}
+  layers = [l for l in model.submodules if type(l) in dtypes]
+  for layer in layers:
+    for dtype in dtypes[type(layer)]:
+      layer.cached_kernels[tf.as_dtype(dtype)] = layer.dequantize(dtype)
+  try:
+    yield
+  finally:
+    for layer in layers:
+      layer.cached_kernels = {}
+
+
+def _replace_sublayers(parent, replace_fn):
+  """Replaces sublayers of parent by replace_fn(sublayer) if it is not None.
+
+  Args:
+    parent: a `tf.keras.layers.Layer`.
+    replace_fn: a function from a sublayer to its replacement or None.
+
+  Returns:
+    number of replaced sublayers, which are attributes of parent or items of
+    its (public) list attributes.
+  """
+  num_replaced = 0
+  for name, value in list(vars(parent).items()):
+    if isinstance(value, tf.keras.layers.Layer):
+      new_value = replace_fn(value)
+      if new_value is not None:
+        delattr(parent, name)  # Also untracks the weights of value.
+        setattr(parent, name, new_value)
+        num_replaced += 1
+    elif isinstance(value, list) and not name.startswith('_'):
+      for i, item in enumerate(value):
+        new_item = (replace_fn(item)
+                    if isinstance(item, tf.keras.layers.Layer) else None)
+        if new_item is not None:
+          value[i] = new_item
+          num_replaced += 1
+  return num_replaced
+
+
+def quantize_model(model):
+  """Quantizes weights of an `ar_model.Model` in place for inference.
+
+  Dense kernels of the encoder, the projection and the decoder, and the
+  decoder token embeddings are quantized. The model is built first if needed.
+  Restore float checkpoints before quantizing, or restore checkpoints of
+  quantized models (see `quantize.py`) after quantizing.
+
+  Args:
+    model: `ar_model.Model` instance.
+
+  Returns:
+    the model.
+  """
+  if not model.built:
+    image_size = model.config.image_size
+    model(tf.zeros([1, image_size[0], image_size[1], 3]),
+          tf.zeros([1, 1], tf.int64), training=False)
+
+  def replace_fn(layer):
+    if QuantizedDense.supports(layer):
+      return QuantizedDense(layer)
+    return None
+
+  parents = [model] + [l for l in model.submodules
+                       if isinstance(l, tf.keras.layers.Layer)]
+  num_replaced = sum(_replace_sublayers(l, replace_fn) for l in parents)
+
+  decoder = model.decoder
+  names = (['token_embedding'] if decoder.shared_embedding else
+           ['inp_token_embedding', 'outp_token_embedding'])
+  for name in names:
+    embedding = getattr(decoder, name)
+    delattr(decoder, name)
+    setattr(decoder, name, QuantizedEmbedding(
+        embedding, name, dtype=decoder.dtype_policy))
+  logging.info('Quantized %d dense layers and %d token embeddings to int8.',
+               num_replaced, len(names))
+  return model
+
+
+def weight_bytes(model):
+  """Returns the total size of model weights in bytes."""
+  return sum(w.shape.num_elements() * w.dtype.size for w in model.weights)
@@ -0,0 +1,173 @@
+# coding=utf-8
+# Copyright 2022 The Pix2Seq Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+r"""Post-training int8 weight quantization script.
+
+Restores the latest checkpoint in --model_dir, quantizes it (see
+`models/quantization.py`) and saves the int8 checkpoint to --output_dir, which
+can be evaluated by run.py with --config.model.int8_weights=True. This
+compresses weights about 4x, but does not speed up inference, as weights are
+dequantized for float matmuls. With --eval_ap, also evaluates the float and the
+int8 models with the task metric (e.g. `CocoObjectDetectionMetric`) and
+reports the AP delta and eval secs per step of both. Use greedy decoding
+(--config.task.top_k=1) for a comparison without sampling noise.
+
+python quantize.py --config=configs/config_det_finetune.py \
+  --model_dir=/tmp/det_ckpt --output_dir=/tmp/det_ckpt_int8 \
+  --config.task.top_k=1 --config.eval.steps=100
+"""
+
+import json
+import os
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+from ml_collections.config_flags import config_flags
+
+import utils
+from data import dataset as dataset_lib
+from data import datasets  # pylint: disable=unused-import
+from metrics import coco_metrics, vg_metrics  # pylint: disable=unused-import
+from models import ar_model  # pylint: disable=unused-import
+from models import model as model_lib
+from models import quantization
+# pylint: disable=unused-import
+from tasks import captioning
+from tasks import instance_segmentation
+from tasks import keypoint_detection
+from tasks import object_detection
+from tasks import scene_graph_generation
+# pylint: enable=unused-import
+from tasks import task as task_lib
+import tensorflow as tf
+
+flags.DEFINE_string('model_dir', None, 'Directory of the float checkpoint.')
+flags.DEFINE_string('output_dir', None,
+                    'Directory to save the int8 checkpoint and results.')
+flags.DEFINE_bool('eval_ap', True,
+                  'Whether to evaluate the float and int8 models.')
+flags.mark_flags_as_required(['model_dir', 'output_dir'])
+
+config_flags.DEFINE_config_file(
+    'config', 'path/to/config/file.py',
+    'The config file.', lock_config=False)
+
+FLAGS = flags.FLAGS
+
+
+def evaluate(config, model, strategy, eval_tag):
+  """Evaluates model on the eval split as in run.py, returns the result."""
+  config.eval.tag = eval_tag
+  task = task_lib.TaskRegistry.lookup(config.task.name)(config)
+  dataset = dataset_lib.DatasetRegistry.lookup(config.dataset.name)(config)
+  eval_steps = utils.get_eval_steps(
+      dataset, config.eval.steps, config.eval.batch_size)
+  summary_writer = tf.summary.create_file_writer(FLAGS.output_dir)
+
+  with strategy.scope():
+    ds = dataset.pipeline(
+        process_single_example=task.preprocess_single,
+        global_batch_size=config.eval.batch_size, training=False)
+
+    def single_step(examples):
+      preprocessed_outputs = task.preprocess_batched(examples, training=False)
+      infer_outputs = task.infer(model, preprocessed_outputs)
+      return task.postprocess_tpu(*infer_outputs)
+
+    @tf.function
+    def run_single_step(iterator):
+      examples = next(iterator)
+      outputs = strategy.run(single_step, (examples,))
+      if outputs is not None:
+        outputs = [strategy.gather(t, axis=0) for t in outputs]
+      return outputs
+
+    iterator = iter(ds)
+    start_time = time.time()
+    cur_step = 0
+    while not eval_steps or cur_step < eval_steps:
+      try:
+        with summary_writer.as_default():
+          task.postprocess_cpu(
+              run_single_step(iterator), train_step=0, eval_step=cur_step,
+              summary_tag=eval_tag)
+      except tf.errors.OutOfRangeError:
+        break
+      cur_step += 1
+  elapsed = time.time() - start_time
+  logging.info('Finished %s eval of %d steps in %.2f mins', eval_tag, cur_step,
+               elapsed / 60.)
+  result = task.evaluate(summary_writer, 0, eval_tag)
+  result['secs_per_step'] = elapsed / max(cur_step, 1)
+  return result
+
+
+def main(unused_argv):
+  config = FLAGS.config
+  config.model_dir = FLAGS.output_dir
+  config.training = False
+  if 'tasks' not in config:
+    config.tasks = [config.task]
+  if 'datasets' not in config:
+    config.datasets = [config.dataset]
+  strategy = utils.build_strategy(False, None)
+  tf.io.gfile.makedirs(FLAGS.output_dir)
+
+  with strategy.scope():
+    model = model_lib.ModelRegistry.lookup(config.model.name)(config)
+    global_step = tf.Variable(0, dtype=tf.int64)
+    latest_ckpt, _, _ = utils.restore_from_checkpoint(
+        FLAGS.model_dir, True, model=model, global_step=global_step)
+    if not latest_ckpt:
+      raise ValueError('No checkpoint found in %s' % FLAGS.model_dir)
+    image_size = config.model.image_size
+    model(tf.zeros([1, image_size[0], image_size[1], 3]),
+          tf.zeros([1, 1], tf.int64), training=False)
+
+  results = {'float_weight_bytes': quantization.weight_bytes(model)}
+  if FLAGS.eval_ap:
+    results['float'] = evaluate(config, model, strategy, 'float')
+
+  with strategy.scope():
+    quantization.quantize_model(model)
+  results['int8_weight_bytes'] = quantization.weight_bytes(model)
+  checkpoint_manager = tf.train.CheckpointManager(
+      tf.train.Checkpoint(model=model, global_step=global_step),
+      FLAGS.output_dir, max_to_keep=1)
+  ckpt_path = checkpoint_manager.save(global_step.numpy())
+  logging.info('Saved int8 checkpoint to %s', ckpt_path)
+
+  if FLAGS.eval_ap:
+    results['int8'] = evaluate(config, model, strategy, 'int8')
+    results['delta'] = {k: results['int8'][k] - results['float'][k]
+                        for k in results['float']}
+    for k in ['AP', 'AP_50', 'AP_75', 'secs_per_step']:
+      if k in results['delta']:
+        logging.info('%s: float %.4f, int8 %.4f, delta %+.4f', k,
+                     results['float'][k], results['int8'][k],
+                     results['delta'][k])
+  logging.info('Weights: float %d bytes, int8 %d bytes',
+               results['float_weight_bytes'], results['int8_weight_bytes'])
+
+  result_json_path = os.path.join(FLAGS.output_dir, 'quantization_result.json')
+  with tf.io.gfile.GFile(result_json_path, 'w') as f:
+    json.dump(results, f, indent=2, default=float)
+
+
+if __name__ == '__main__':
+  tf.config.set_soft_device_placement(True)
+  app.run(main)
@@ -32,6 +32,7 @@ from data import datasets  # pylint: disable=unused-import
 from metrics import coco_metrics, vg_metrics  # pylint: disable=unused-import
 from models import ar_model  # pylint: disable=unused-import
 from models import model as model_lib
+from models import quantization
 # pylint: disable=unused-import
 from tasks import captioning
 from tasks import instance_segmentation
@@ -72,20 +73,19 @@ def get_task_and_dataset(config: ml_collections.ConfigDict):
   return task, dataset
 
 
-def perform_evaluation(config, dataset, task, eval_steps, ckpt, strategy):
-  """Perform evaluation."""
-  eval_tag = config.eval.tag
-  summary_writer = tf.summary.create_file_writer(FLAGS.model_dir)
+def build_evaluation(config, task, strategy):
+  """Returns the model and the step function for evaluation.
 
+  They are shared by the evaluations of all checkpoints, so that the step
+  function is only traced (and with `config.eval.jit_compile`, XLA-compiled)
+  once.
+  """
   with strategy.scope():
-    # Restore model checkpoint.
     model = model_lib.ModelRegistry.lookup(config.model.name)(config)
-    logging.info('Restoring from %s', ckpt)
-    checkpoint = tf.train.Checkpoint(
-        model=model, global_step=tf.Variable(0, dtype=tf.int64))
-    checkpoint.restore(ckpt).expect_partial()  # Not restore optimizer.
-    global_step = checkpoint.global_step
-    logging.info('Performing eval at step %d', global_step.numpy())
+    if config.model.get('int8_weights', False):
+      quantization.quantize_model(model)  # For checkpoints from quantize.py.
+    if config.eval.get('jit_compile', False):
+      model.jit_compile = True
 
   def single_step(examples):
     preprocessed_outputs = task.preprocess_batched(examples, training=False)
@@ -101,6 +101,28 @@ def perform_evaluation(config, dataset, task, eval_steps, ckpt, strategy):
         outputs = [strategy.gather(t, axis=0) for t in outputs]
       return outputs
 
+  return model, run_single_step
+
+
+def perform_evaluation(config, dataset, task, eval_steps, ckpt, strategy,
+                       model, run_single_step):
+  """Perform evaluation.
+
+  The model and run_single_step are from `build_evaluation`.
+  """
+  eval_tag = config.eval.tag
+  summary_writer = tf.summary.create_file_writer(FLAGS.model_dir)
+
+  with strategy.scope():
+    # Restore model checkpoint.
+    logging.info('Restoring from %s', ckpt)
+    checkpoint = tf.train.Checkpoint(
+        model=model, global_step=tf.Variable(0, dtype=tf.int64))
+    checkpoint.restore(ckpt).expect_partial()  # Not restore optimizer.
+    global_step = checkpoint.global_step
+    logging.info('Performing eval at step %d', global_step.numpy())
+
+  with strategy.scope():
     iterator = iter(dataset)
     start_time = timestamp = time.time()
     cur_step = 0
@@ -158,29 +180,62 @@ def perform_training(config, datasets, tasks, train_steps, steps_per_loop,
     data_iterators = [iter(dataset) for dataset in datasets]
     summary_writer = tf.summary.create_file_writer(FLAGS.model_dir)
 
+    grad_accum_steps = config.train.get('grad_accum_steps', 1)
+
+    def next_examples(it):
+      if grad_accum_steps == 1:
+        return next(it)
+      return [next(it) for _ in range(grad_accum_steps)]  # micro-batches.
+
     @tf.function
     def train_multiple_steps(data_iterators, tasks):
+      """Returns total time in secs waiting for the input pipeline."""
       train_step = lambda xs, ts=tasks: trainer.train_step(xs, ts, strategy)
+      input_wait = tf.constant(0., tf.float64)
+      step_done = tf.timestamp()
       for _ in tf.range(steps_per_loop):  # using tf.range prevents unroll.
         with tf.name_scope(''):  # prevent `while_` prefix for variable names.
-          strategy.run(train_step, ([next(it) for it in data_iterators],))
-      print('train_multiple_steps')
+          # The wait is from the previous update until examples are fetched (0
+          # if prefetched). Timestamps are anchored by data dependencies, as
+          # ops are otherwise not run in program order.
+          examples = [next_examples(it) for it in data_iterators]
+          with tf.control_dependencies(
+              tf.nest.flatten(examples, expand_composites=True)):
+            fetch_done = tf.timestamp()
+          with tf.control_dependencies([fetch_done]):
+            examples = tf.nest.map_structure(
+                tf.identity, examples, expand_composites=True)
+          input_wait += tf.maximum(fetch_done - step_done, 0.)
+          strategy.run(train_step, (examples,))
+          with tf.control_dependencies([trainer.optimizer.iterations.value()]):
+            step_done = tf.timestamp()
+      return input_wait
 
     global_step = trainer.optimizer.iterations
     cur_step = global_step.numpy()
     timestamp = time.time()
     while cur_step < train_steps:
       with summary_writer.as_default():
-        train_multiple_steps(data_iterators, tasks)
+        input_wait = train_multiple_steps(data_iterators, tasks).numpy()
+        elapsed = time.time() - timestamp
         trainer.check_checkpoint_restored()
         cur_step = global_step.numpy()
         trainer.checkpoint_manager.save(cur_step)
-        steps_per_sec = steps_per_loop / (time.time() - timestamp)
+        steps_per_sec = steps_per_loop / elapsed
         timestamp = time.time()
         with tf.name_scope('train'):
           for metric_name, metric_val in trainer.metrics.items():
+            if metric_val.count.numpy() == 0:  # e.g. diagnostics not due yet.
+              continue
             tf.summary.scalar(
                 metric_name, metric_val.result().numpy(), global_step)
+          for counter_name, counter_val in trainer.counters.items():
+            tf.summary.scalar(
+                f'{counter_name}_per_sec',
+                counter_val.result().numpy() / elapsed, global_step)
+          tf.summary.scalar(
+              'input_wait_secs_per_step', input_wait / steps_per_loop,
+              global_step)
           tf.summary.scalar(
               'learning_rate',
               trainer.learning_rate(tf.cast(global_step, dtype=tf.float32)),
@@ -203,6 +258,8 @@ def perform_training(config, datasets, tasks, train_steps, steps_per_loop,
 def main(unused_argv):
   if FLAGS.run_eagerly:
     tf.config.run_functions_eagerly(True)
+  if FLAGS.config.eval.get('compile_cache_dir'):
+    utils.set_xla_compile_cache(FLAGS.config.eval.compile_cache_dir)
   strategy = utils.build_strategy(FLAGS.use_tpu, FLAGS.master)
 
 
@@ -217,6 +274,14 @@ def main(unused_argv):
       config.datasets = [config.dataset]
     dses = []
     tasks = []
+    batch_size = config.eval.batch_size
+    if training:
+      # Datasets are of micro-batches with gradient accumulation.
+      grad_accum_steps = config.train.get('grad_accum_steps', 1)
+      if config.train.batch_size % grad_accum_steps:
+        raise ValueError('train.batch_size must be divisible by '
+                         'train.grad_accum_steps.')
+      batch_size = config.train.batch_size // grad_accum_steps
     for c_task, c_dataset in zip(config.tasks, config.datasets):
       task_config = copy.deepcopy(config)
       task_config.task = c_task
@@ -224,8 +289,7 @@ def main(unused_argv):
       task, dataset = get_task_and_dataset(task_config)
       ds = dataset.pipeline(
           process_single_example=task.preprocess_single,
-          global_batch_size=(
-              config.train.batch_size if training else config.eval.batch_size),
+          global_batch_size=batch_size,
           training=training)
       dses.append(ds)
       tasks.append(task)
@@ -248,9 +312,11 @@ def main(unused_argv):
     checkpoint_dir = config.eval.get('checkpoint_dir', None)
     if not checkpoint_dir:
       checkpoint_dir = FLAGS.model_dir
+    model, run_single_step = build_evaluation(config, task, strategy)
     for ckpt in tf.train.checkpoints_iterator(
         checkpoint_dir, min_interval_secs=15):
-      result = perform_evaluation(config, ds, task, eval_steps, ckpt, strategy)
+      result = perform_evaluation(
+          config, ds, task, eval_steps, ckpt, strategy, model, run_single_step)
       if result['global_step'] >= train_steps:
         logging.info('Eval complete. Exiting...')
         break
@@ -86,6 +86,7 @@ class TaskCaptioning(task_lib.Task):
             labels,
             max_instances_per_image=config.max_instances_per_image,
             max_image_size=config.image_size,
+            size_buckets=config.get('image_size_buckets'),
             color_jitter_strength=config.color_jitter_strength,
             jitter_scale=(config.jitter_scale_min, config.jitter_scale_max),
             filter_invalid_labels=False)
@@ -94,6 +95,7 @@ class TaskCaptioning(task_lib.Task):
             features,
             labels,
             max_image_size=config.image_size,
+            size_buckets=config.get('image_size_buckets'),
             max_instances_per_image=0)
 
         # Use the first caption. This  won't be used in eval.
@@ -154,7 +156,11 @@ class TaskCaptioning(task_lib.Task):
         self.task_vocab_id, prompt_shape=(bsz, 1))
     pred_seq, logits, _ = model.infer(
         image, prompt_seq, encoded=None,
-        temperature=config.temperature, top_k=config.top_k, top_p=config.top_p)
+        temperature=config.temperature, top_k=config.top_k, top_p=config.top_p,
+        top_p_candidates=config.get('top_p_candidates'),
+        early_stop=config.get('early_stop'), logits_mode='token',
+        beam_size=config.get('beam_size', 1),
+        length_penalty=config.get('length_penalty', 0.))
     # if True:  # Sanity check by using gt response_seq as pred_seq.
     #   pred_seq = response_seq
     #   logits = tf.one_hot(pred_seq, self.vocab_size)
@@ -170,7 +176,7 @@ class TaskCaptioning(task_lib.Task):
       batched_examples: a tupple of features (`dict`) and labels (`dict`),
         containing images and labels.
       pred_seq: `int` sequence of shape (bsz * instances, seqlen').
-      logits: `float` sequence of shape (bsz * instances, seqlen', vocab_size).
+      logits: `float` log-probs of pred_seq of shape (bsz * instances, seqlen').
       training: `bool` indicating training or inference mode.
 
     Returns:
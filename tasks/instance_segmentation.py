@@ -109,6 +109,7 @@ class TaskInstanceSegmentation(task_lib.Task):
               features,
               labels,
               max_image_size=config.image_size,
+              size_buckets=config.get('image_size_buckets'),
               max_instances_per_image=max_instances_per_image,
               object_order=None,  # No reordering as `preserve_reserved_tokens`
               jitter_scale=(config.jitter_scale_min, config.jitter_scale_max),
@@ -125,6 +126,7 @@ class TaskInstanceSegmentation(task_lib.Task):
             features,
             labels,
             max_image_size=config.image_size,
+            size_buckets=config.get('image_size_buckets'),
             max_instances_per_image=max_instances_per_image,
             object_coordinate_keys=('bbox', 'polygon', 'keypoints'))
       labels['polygon'] = utils.preserve_reserved_tokens(
@@ -200,23 +202,59 @@ class TaskInstanceSegmentation(task_lib.Task):
       bsz = tf.shape(image)[0]
       prompt_seq = task_utils.build_prompt_seq_from_task_id(
           config.object_detection_vocab_id, prompt_shape=(bsz, 1))
+      object_mask = None
+      if config.get('constrain_tokens', False):  # Enforce yxyxc objects.
+        object_mask = task_utils.object_seq_grammar(
+            config.quantization_bins, mconfig.coord_vocab_shift,
+            mconfig.vocab_size).logits_mask()
       pred_seq, logits, encoded = model.infer(
           image, prompt_seq,
           encoded=None,
           max_seq_len=(config.max_instances_per_image_test * 5 + 1),
           temperature=config.temperature,
-          top_k=config.top_k, top_p=config.top_p)
+          top_k=config.top_k, top_p=config.top_p,
+          top_p_candidates=config.get('top_p_candidates'),
+          early_stop=config.get('early_stop'),
+          logits_mode=task_utils.object_seq_logits_mode(
+              mconfig.coord_vocab_shift),
+          token_mask=object_mask)
       pred_classes, pred_bboxes, scores = task_utils.decode_object_seq_to_bbox(
-          logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift)
+          logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift,
+          class_log_probs=True)
     prompt_seq = task_utils.build_instance_prompt_seq(
         self.task_vocab_id, pred_bboxes, pred_classes,
         config.quantization_bins, mconfig.coord_vocab_shift)
 
-    pred_seq, _, _ = model.infer(  # (bsz * instances * num_samples, seqlen)
-        image, prompt_seq,
-        encoded=encoded, max_seq_len=config.max_points_per_object * 2 + 6,
+    infer_kwargs = dict(
+        max_seq_len=config.max_points_per_object * 2 + 6,
         temperature=config.temperature, top_k=config.top_k, top_p=config.top_p,
-        num_samples=config.ensemble_num_samples)
+        top_p_candidates=config.get('top_p_candidates'),
+        num_samples=config.ensemble_num_samples,
+        early_stop=config.get('early_stop'), logits_mode='token')
+    bucket_size = config.get('instance_bucket_size', 0)
+    if bucket_size:
+      # Only decode non-empty instances with high enough scores, in batches of
+      # bucket_size instances. Dropped instances get no prediction.
+      is_valid = tf.logical_and(
+          tf.greater(pred_classes, 0),
+          tf.greater_equal(scores, config.get('min_bbox_score', 0.)))
+      pred_classes = tf.where(is_valid, pred_classes,
+                              tf.zeros_like(pred_classes))
+      scores = tf.where(is_valid, scores, tf.zeros_like(scores))
+      if encoded is None:
+        encoded = model.encode(image)
+      def infer_fn(prompt_seq, encoded_index):
+        pred_seq, _, _ = model.infer(
+            image, prompt_seq, encoded=encoded, encoded_index=encoded_index,
+            **infer_kwargs)
+        return pred_seq
+      # (bsz * instances * num_samples, seqlen)
+      pred_seq = task_utils.infer_valid_instances(
+          infer_fn, prompt_seq, is_valid, bucket_size,
+          config.ensemble_num_samples)
+    else:
+      pred_seq, _, _ = model.infer(  # (bsz * instances * num_samples, seqlen)
+          image, prompt_seq, encoded=encoded, **infer_kwargs)
 
     # if True:  # Sanity check by using gt response_seq as pred_seq.
     #   pred_classes = examples[1]['label']
@@ -275,7 +313,7 @@ class TaskInstanceSegmentation(task_lib.Task):
                                                  tile_factor)
 
     # Compute coordinate scaling from [0., 1.] to actual pixel.
-    image_size = images.shape[1:3].as_list()
+    image_size = tf.shape(images)[1:3]
     if training:
       # scale points to whole image size during train.
       scale = utils.tf_float32(image_size)
@@ -90,6 +90,7 @@ class TaskKeypointDetection(task_lib.Task):
               features,
               labels,
               max_image_size=config.image_size,
+              size_buckets=config.get('image_size_buckets'),
               max_instances_per_image=config.max_instances_per_image,
               object_order=None,  # No reordering per `preserve_reserved_tokens`
               jitter_scale=(config.jitter_scale_min, config.jitter_scale_max),
@@ -106,6 +107,7 @@ class TaskKeypointDetection(task_lib.Task):
             features,
             labels,
             max_image_size=config.image_size,
+            size_buckets=config.get('image_size_buckets'),
             max_instances_per_image=config.max_instances_per_image,
             object_coordinate_keys=('bbox', 'polygon', 'keypoints'))
       labels['keypoints'] = utils.preserve_reserved_tokens(
@@ -197,21 +199,64 @@ class TaskKeypointDetection(task_lib.Task):
       bsz = tf.shape(image)[0]
       prompt_seq = task_utils.build_prompt_seq_from_task_id(
           config.object_detection_vocab_id, prompt_shape=(bsz, 1))
+      object_mask = None
+      if config.get('constrain_tokens', False):  # Enforce yxyxc objects.
+        object_mask = task_utils.object_seq_grammar(
+            config.quantization_bins, mconfig.coord_vocab_shift,
+            mconfig.vocab_size).logits_mask()
       pred_seq, logits, encoded = model.infer(
           image, prompt_seq,
           encoded=None,
           max_seq_len=(config.max_instances_per_image_test * 5 + 1),
           temperature=config.temperature,
-          top_k=config.top_k, top_p=config.top_p)
+          top_k=config.top_k, top_p=config.top_p,
+          top_p_candidates=config.get('top_p_candidates'),
+          early_stop=config.get('early_stop'),
+          logits_mode=task_utils.object_seq_logits_mode(
+              mconfig.coord_vocab_shift),
+          token_mask=object_mask)
       pred_classes, pred_bboxes, scores = task_utils.decode_object_seq_to_bbox(
-          logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift)
+          logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift,
+          class_log_probs=True)
     prompt_seq = task_utils.build_instance_prompt_seq(
         self.task_vocab_id, pred_bboxes, pred_classes,
         config.quantization_bins, mconfig.coord_vocab_shift)
-    pred_seq, logits, _ = model.infer(  # pred_seq (bsz * instances, seqlen)
-        image, prompt_seq,
-        encoded=encoded, max_seq_len=config.max_points_per_object * 2 + 6,
-        temperature=config.temperature, top_k=config.top_k, top_p=config.top_p)
+    point_mask = None
+    if config.get('constrain_tokens', False):  # Enforce (y, x) keypoints.
+      point_mask = task_utils.keypoint_seq_grammar(
+          config.quantization_bins, mconfig.coord_vocab_shift,
+          mconfig.vocab_size).logits_mask()
+    infer_kwargs = dict(
+        max_seq_len=config.max_points_per_object * 2 + 6,
+        temperature=config.temperature, top_k=config.top_k, top_p=config.top_p,
+        top_p_candidates=config.get('top_p_candidates'),
+        early_stop=config.get('early_stop'),
+        # Full logits are only needed for resampling suppressed tokens.
+        logits_mode=(
+            'full' if config.eval_suppress_invisible_token else 'token'),
+        token_mask=point_mask)
+    bucket_size = config.get('instance_bucket_size', 0)
+    if bucket_size:
+      # Only decode non-empty instances with high enough scores, in batches of
+      # bucket_size instances. Dropped instances get no prediction.
+      is_valid = tf.logical_and(
+          tf.greater(pred_classes, 0),
+          tf.greater_equal(scores, config.get('min_bbox_score', 0.)))
+      pred_classes = tf.where(is_valid, pred_classes,
+                              tf.zeros_like(pred_classes))
+      scores = tf.where(is_valid, scores, tf.zeros_like(scores))
+      if encoded is None:
+        encoded = model.encode(image)
+      def infer_fn(prompt_seq, encoded_index):
+        pred_seq, logits, _ = model.infer(
+            image, prompt_seq, encoded=encoded, encoded_index=encoded_index,
+            **infer_kwargs)
+        return pred_seq, logits
+      pred_seq, logits = task_utils.infer_valid_instances(
+          infer_fn, prompt_seq, is_valid, bucket_size)
+    else:
+      pred_seq, logits, _ = model.infer(  # pred_seq (bsz * instances, seqlen)
+          image, prompt_seq, encoded=encoded, **infer_kwargs)
     if config.eval_suppress_invisible_token:
       eval_suppress_tokens = [vocab.INVISIBLE_TOKEN]
       offset = tf.zeros([logits.shape[-1]])
@@ -223,9 +268,12 @@ class TaskKeypointDetection(task_lib.Task):
       logits -= offset
 
       sampling_logits = logits / tf.cast(config.temperature, tf.float32)
-      sampling_logits = transformers.top_logits(
-          sampling_logits, k=config.top_k, p=config.top_p)
       bsz, seq_len, dim = sampling_logits.shape.as_list()
+      if point_mask is not None:
+        sampling_logits += tf.tile(point_mask, [seq_len // 2, 1])[tf.newaxis]
+      sampling_logits = transformers.top_logits(
+          sampling_logits, k=config.top_k, p=config.top_p,
+          num_candidates=config.get('top_p_candidates'))
       sampling_logits = tf.reshape(sampling_logits, [-1, dim])
       pred_seq_no_suppressed = tf.random.categorical(
           sampling_logits, num_samples=1, dtype=tf.int64)[:, 0]
@@ -284,7 +332,7 @@ class TaskKeypointDetection(task_lib.Task):
                                                  tile_factor)
 
     # Compute coordinate scaling from [0., 1.] to actual pixel.
-    image_size = images.shape[1:3].as_list()
+    image_size = tf.shape(images)[1:3]
     if training:
       # scale points to whole image size during train.
       scale = utils.tf_float32(image_size)
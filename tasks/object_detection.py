@@ -73,7 +73,7 @@ class TaskObjectDetection(task_lib.Task):
 
 		def _preprocess_single_example(features, labels):
 			config = self.config.task
-			features['orig_image_size'] = tf.shape(features['image'])[:2]
+			features['orig_image_size'] = data_utils.get_image_size(features)
 
 			if training:
 				features_list, labels_list = [], []
@@ -82,6 +82,7 @@ class TaskObjectDetection(task_lib.Task):
 							features,
 							labels,
 							max_image_size=config.image_size,
+							size_buckets=config.get('image_size_buckets'),
 							max_instances_per_image=config.max_instances_per_image,
 							object_order=config.object_order,
 							inject_noise_instances=config.noise_bbox_weight > 0,
@@ -99,6 +100,7 @@ class TaskObjectDetection(task_lib.Task):
 						features,
 						labels,
 						max_image_size=config.image_size,
+						size_buckets=config.get('image_size_buckets'),
 						max_instances_per_image=config.max_instances_per_image,
 						object_coordinate_keys=('bbox', 'polygon', 'keypoints'))
 
@@ -164,14 +166,28 @@ class TaskObjectDetection(task_lib.Task):
 	def infer(self, model, preprocessed_outputs):
 		"""Perform inference given the model and preprocessed outputs."""
 		config = self.config.task
+		mconfig = self.config.model
 		image, _, examples = preprocessed_outputs  # response_seq unused by default
 		bsz = tf.shape(image)[0]
 		prompt_seq = task_utils.build_prompt_seq_from_task_id(
 				self.task_vocab_id, prompt_shape=(bsz, 1))
+		token_mask = None
+		if config.get('constrain_tokens', False):  # Enforce yxyxc objects.
+			token_mask = task_utils.object_seq_grammar(
+					config.quantization_bins, mconfig.coord_vocab_shift,
+					mconfig.vocab_size).logits_mask()
 		pred_seq, logits, _ = model.infer(
 				image, prompt_seq, encoded=None,
 				max_seq_len=(config.max_instances_per_image_test * 5 + 1),
-				temperature=config.temperature, top_k=config.top_k, top_p=config.top_p)
+				temperature=config.temperature, top_k=config.top_k, top_p=config.top_p,
+				top_p_candidates=config.get('top_p_candidates'),
+				early_stop=config.get('early_stop'),
+				logits_mode=task_utils.object_seq_logits_mode(
+						mconfig.coord_vocab_shift),
+				beam_size=config.get('beam_size', 1),
+				length_penalty=config.get('length_penalty', 0.),
+				token_mask=token_mask,
+				num_draft_tokens=config.get('num_draft_tokens', 0))
 		# if True:  # Sanity check by using gt response_seq as pred_seq.
 		#   pred_seq = preprocessed_outputs[1]
 		#   logits = tf.one_hot(pred_seq, mconfig.vocab_size)
@@ -190,7 +206,8 @@ class TaskObjectDetection(task_lib.Task):
 			batched_examples: a tupple of features (`dict`) and labels (`dict`),
 				containing images and labels.
 			pred_seq: `int` sequence of shape (bsz, seqlen').
-			logits: `float` sequence of shape (bsz, seqlen', vocab_size).
+			logits: `float` class log-probs of shape (bsz, instances, num_classes)
+				from `task_utils.object_seq_logits_mode`.
 			training: `bool` indicating training or inference mode.
 
 		Returns:
@@ -205,10 +222,11 @@ class TaskObjectDetection(task_lib.Task):
 
 		# Decode sequence output.
 		pred_classes, pred_bboxes, scores = task_utils.decode_object_seq_to_bbox(
-				logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift)
+				logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift,
+				class_log_probs=True)
 
 		# Compute coordinate scaling from [0., 1.] to actual pixels in orig image.
-		image_size = images.shape[1:3].as_list()
+		image_size = tf.shape(images)[1:3]
 		if training:
 			# scale points to whole image size during train.
 			scale = utils.tf_float32(image_size)
@@ -70,7 +70,7 @@ class TaskSceneGraphGeneration(task_lib.Task):
 
 		def _preprocess_single_example(features, labels):
 			config = self.config.task
-			features['orig_image_size'] = tf.shape(features['image'])[:2]
+			features['orig_image_size'] = data_utils.get_image_size(features)
 
 			if training:
 				features_list, labels_list = [], []
@@ -79,6 +79,7 @@ class TaskSceneGraphGeneration(task_lib.Task):
 							features,
 							labels,
 							max_image_size=config.image_size,
+							size_buckets=config.get('image_size_buckets'),
 							max_instances_per_image=config.max_instances_per_image,
 							object_order=config.object_order,
 							inject_noise_instances=config.noise_bbox_weight > 0,
@@ -97,6 +98,7 @@ class TaskSceneGraphGeneration(task_lib.Task):
 						features,
 						labels,
 						max_image_size=config.image_size,
+						size_buckets=config.get('image_size_buckets'),
 						max_instances_per_image=config.max_instances_per_image,
 						object_coordinate_keys=('box1', 'box2'))
 
@@ -167,14 +169,25 @@ class TaskSceneGraphGeneration(task_lib.Task):
 	def infer(self, model, preprocessed_outputs):
 		"""Perform inference given the model and preprocessed outputs."""
 		config = self.config.task
+		mconfig = self.config.model
 		image, _, examples = preprocessed_outputs  # response_seq unused by default
 		bsz = tf.shape(image)[0]
 		prompt_seq = task_utils.build_prompt_seq_from_task_id(
 				self.task_vocab_id, prompt_shape=(bsz, 1))
+		token_mask = None
+		if config.get('constrain_tokens', False):  # Enforce well-formed triplets.
+			token_mask = task_utils.triplet_seq_grammar(
+					config.quantization_bins, mconfig.coord_vocab_shift,
+					mconfig.vocab_size, self.config.dataset.num_obj_classes,
+					self.config.dataset.num_rel_classes).logits_mask()
 		pred_seq, logits, _ = model.infer(
 				image, prompt_seq, encoded=None,
 				max_seq_len=(config.max_instances_per_image_test * 15 + 1),
-				temperature=config.temperature, top_k=config.top_k, top_p=config.top_p)
+				temperature=config.temperature, top_k=config.top_k, top_p=config.top_p,
+				top_p_candidates=config.get('top_p_candidates'),
+				early_stop=config.get('early_stop'),
+				logits_mode=task_utils.triplet_seq_logits_mode(),
+				token_mask=token_mask)
 		# if True:  # Sanity check by using gt response_seq as pred_seq.
 		# 	pred_seq = preprocessed_outputs[1]
 		# 	logits = tf.one_hot(pred_seq, self.config.model.vocab_size)
@@ -193,7 +206,8 @@ class TaskSceneGraphGeneration(task_lib.Task):
 			batched_examples: a tupple of features (`dict`) and labels (`dict`),
 				containing images and labels.
 			pred_seq: `int` sequence of shape (bsz, seqlen').
-			logits: `float` sequence of shape (bsz, seqlen', vocab_size).
+			logits: `float` log-probs at class positions of shape
+				(bsz, triplets * 3, vocab_size) from `task_utils.triplet_seq_logits_mode`.
 			training: `bool` indicating training or inference mode.
 
 		Returns:
@@ -209,7 +223,8 @@ class TaskSceneGraphGeneration(task_lib.Task):
 
 		# Decode sequence output.
 		box1_class, rel_class, box2_class, pred_bbox1, pred_bbox2, obj_scores, rel_scores = task_utils.decode_seq_to_triplets(
-				logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift, self.config.dataset.num_obj_classes,  self.config.dataset.num_rel_classes)
+				logits, pred_seq, config.quantization_bins, mconfig.coord_vocab_shift, self.config.dataset.num_obj_classes,  self.config.dataset.num_rel_classes,
+				class_log_probs=True)
 
 		# print(tf.concat([pred_bbox1, pred_bbox2], 0).shape, tf.concat(tf.split(obj_scores, 2, -1), 0).shape)
 		inst_per_batch = obj_scores.shape[1] * 2
@@ -222,7 +237,7 @@ class TaskSceneGraphGeneration(task_lib.Task):
 		pred_bbox, pred_bbox_score = res.nmsed_boxes, res.nmsed_scores
 
 		# Compute coordinate scaling from [0., 1.] to actual pixels in orig image.
-		image_size = images.shape[1:3].as_list()
+		image_size = tf.shape(images)[1:3]
 		if training:
 			# scale points to whole image size during train.
 			scale = utils.tf_float32(image_size)
@@ -135,70 +135,288 @@ def decode_instance_seq_to_points(seq, quantization_bins, coord_vocab_shift):
   return utils.replace_reserved_tokens(points, seq, vocab.TOKEN_TO_FLOAT)
 
 
+def infer_valid_instances(infer_fn, prompt_seq, is_valid, bucket_size,
+                          num_samples=1):
+  """Runs second-stage inference of instances only on the valid ones.
+
+  Valid prompts (e.g. of non-empty boxes with high enough scores) are gathered
+  into batches of `bucket_size` prompts, with the last one padded, so that the
+  decoding work scales with the number of valid instances while shapes stay
+  static. Prompts refer to their images by index (see `encoded_index` of
+  `Model.infer`), so encoded images are only gathered for the bucket_size
+  prompts of each call (once per call, not per decoding step) instead of being
+  tiled for all instances.
+
+  Args:
+    infer_fn: a function of `int` prompts of (bucket_size, seqlen) and their
+      image indices of (bucket_size,), returning a nest of tensors of
+      (bucket_size * num_samples, ...) where samples of a prompt are
+      consecutive, e.g. `pred_seq` and `logits` of `Model.infer`.
+    prompt_seq: `int` prompts of (bsz, instances, seqlen).
+    is_valid: `bool` of (bsz, instances).
+    bucket_size: `int` number of prompts per infer_fn call.
+    num_samples: `int` number of samples per prompt of infer_fn.
+
+  Returns:
+    outputs of infer_fn for all (bsz * instances * num_samples) rows, which are
+    zeros for invalid instances.
+  """
+  bsz, instances = utils.shape_as_list(is_valid)
+  num_prompts = bsz * instances
+  prompt_seq = tf.reshape(prompt_seq, [num_prompts, -1])
+  encoded_index = tf.repeat(tf.range(bsz), instances)
+  # Indices of valid prompts, padded with num_prompts to full buckets.
+  rows = tf.cast(tf.where(tf.reshape(is_valid, [-1]))[:, 0], tf.int32)
+  num_rows = tf.size(rows)
+  num_buckets = tf.maximum((num_rows + bucket_size - 1) // bucket_size, 1)
+  rows = tf.pad(rows, [[0, num_buckets * bucket_size - num_rows]],
+                constant_values=num_prompts)
+
+  def infer_bucket(i, buffers=None):
+    bucket_rows = rows[i * bucket_size:(i + 1) * bucket_size]
+    bucket_rows.set_shape([bucket_size])
+    inputs = tf.minimum(bucket_rows, num_prompts - 1)
+    outputs = infer_fn(tf.gather(prompt_seq, inputs),
+                       tf.gather(encoded_index, inputs))
+    if buffers is None:
+      # The extra last rows collect (and drop) outputs of padding prompts.
+      buffers = tf.nest.map_structure(lambda t: tf.zeros(
+          [(num_prompts + 1) * num_samples] + utils.shape_as_list(t)[1:],
+          t.dtype), outputs)
+    output_rows = bucket_rows[:, tf.newaxis] * num_samples + tf.range(
+        num_samples)[tf.newaxis]
+    output_rows = tf.reshape(output_rows, [-1, 1])
+    return tf.nest.map_structure(
+        lambda b, t: tf.tensor_scatter_nd_update(b, output_rows, t),
+        buffers, outputs)
+
+  # The first bucket is decoded outside of the loop to get output shapes.
+  buffers = infer_bucket(0)
+  _, buffers = tf.while_loop(
+      lambda i, _: tf.less(i, num_buckets),
+      lambda i, buffers: (i + 1, infer_bucket(i, buffers)),
+      (tf.constant(1), buffers))
+  return tf.nest.map_structure(
+      lambda b: b[:num_prompts * num_samples], buffers)
+
+
+def object_seq_logits_mode(coord_vocab_shift):
+  """Returns `logits_mode` for `Model.infer` of `decode_object_seq_to_bbox`.
+
+  Only log-probabilities of class tokens at class positions of yxyxc format are
+    kept, to be decoded with `class_log_probs=True`.
+
+  Args:
+    coord_vocab_shift: `int`, shifting coordinates by a specified integer.
+  """
+  return {'period': 5, 'offsets': [4],
+          'vocab_range': (vocab.BASE_VOCAB_SHIFT, coord_vocab_shift)}
+
+
+class SequenceGrammar:
+  """Allowed tokens at each position of sequences with a periodic structure.
+
+  Generated position p (excluding the prompt) follows the rule at p % period.
+    The grammar is given to `Model.infer` as `token_mask=grammar.logits_mask()`,
+    which is precomputed once and added to the logits at each decoding step.
+  """
+
+  def __init__(self, period: int, vocab_size: int):
+    self.period = period
+    self.vocab_size = vocab_size
+    self._allowed = [[False] * vocab_size for _ in range(period)]
+
+  def allow(self, offsets, start: int, end: Optional[int] = None):
+    """Allows tokens in [start, end) (or only start) at the given offsets."""
+    end = start + 1 if end is None else end
+    for offset in offsets:
+      self._allowed[offset][start:end] = [True] * (end - start)
+    return self
+
+  def token_mask(self, offset: Optional[int] = None, classes_only=False):
+    """Returns `bool` allowed tokens of (period, vocab_size), or (vocab_size,).
+
+    Args:
+      offset: optional `int` offset for only returning its allowed tokens.
+      classes_only: `bool` for only keeping class tokens (not the fake class).
+    """
+    allowed = self._allowed if offset is None else self._allowed[offset]
+    allowed = tf.constant(allowed)
+    if classes_only:
+      allowed = tf.logical_and(
+          allowed, tf.range(self.vocab_size) >= vocab.BASE_VOCAB_SHIFT)
+    return allowed
+
+  def logits_mask(self, mask: float = -1e10):
+    """Returns additive `float` logits mask of (period, vocab_size)."""
+    return tf.where(self.token_mask(), 0., mask)
+
+
+def object_seq_grammar(quantization_bins, coord_vocab_shift, vocab_size):
+  """Returns `SequenceGrammar` of yxyxc object sequences.
+
+  The sequence can end (with padding token) at the start of each object, which
+    is followed by 4 coordinate tokens and 1 class token (or the fake class).
+
+  Args:
+    quantization_bins: `int` for bins.
+    coord_vocab_shift: `int`, shifting coordinates by a specified integer.
+    vocab_size: `int` vocab size.
+  """
+  grammar = SequenceGrammar(5, vocab_size)
+  grammar.allow([0], vocab.PADDING_TOKEN)
+  grammar.allow([0, 1, 2, 3], coord_vocab_shift,
+                coord_vocab_shift + quantization_bins)
+  grammar.allow([4], vocab.BASE_VOCAB_SHIFT, coord_vocab_shift)
+  grammar.allow([4], vocab.FAKE_CLASS_TOKEN)
+  return grammar
+
+
+def triplet_seq_grammar(quantization_bins, coord_vocab_shift, vocab_size,
+                        num_obj_classes, num_rel_classes):
+  """Returns `SequenceGrammar` of scene graph triplet sequences.
+
+  Each triplet has 15 tokens (yxyx, subject class, SUB, relation class, PRED,
+    yxyx, object class, OBJ, TRIPLET), and the sequence can end at the start of
+    each triplet.
+
+  Args:
+    quantization_bins: `int` for bins.
+    coord_vocab_shift: `int`, shifting coordinates by a specified integer.
+    vocab_size: `int` vocab size.
+    num_obj_classes: `int` number of object classes, starting from the first
+      class token.
+    num_rel_classes: `int` number of relation classes, following the object
+      classes.
+  """
+  obj_start = vocab.BASE_VOCAB_SHIFT
+  rel_start = obj_start + num_obj_classes
+  grammar = SequenceGrammar(15, vocab_size)
+  grammar.allow([0], vocab.PADDING_TOKEN)
+  grammar.allow([0, 1, 2, 3, 8, 9, 10, 11], coord_vocab_shift,
+                coord_vocab_shift + quantization_bins)
+  grammar.allow([4, 12], obj_start, rel_start)
+  grammar.allow([4, 12], vocab.FAKE_CLASS_TOKEN)
+  grammar.allow([6], rel_start, rel_start + num_rel_classes)
+  grammar.allow([5], vocab.SUB)
+  grammar.allow([7], vocab.PRED)
+  grammar.allow([13], vocab.OBJ)
+  grammar.allow([14], vocab.TRIPLET)
+  return grammar
+
+
+def keypoint_seq_grammar(quantization_bins, coord_vocab_shift, vocab_size):
+  """Returns `SequenceGrammar` of (y, x) keypoint sequences.
+
+  Each coordinate is a coordinate token or the invisible token, and the
+    sequence can end at the start of each point.
+
+  Args:
+    quantization_bins: `int` for bins.
+    coord_vocab_shift: `int`, shifting coordinates by a specified integer.
+    vocab_size: `int` vocab size.
+  """
+  grammar = SequenceGrammar(2, vocab_size)
+  grammar.allow([0], vocab.PADDING_TOKEN)
+  grammar.allow([0, 1], coord_vocab_shift,
+                coord_vocab_shift + quantization_bins)
+  grammar.allow([0, 1], vocab.INVISIBLE_TOKEN)
+  return grammar
+
+
 def decode_object_seq_to_bbox(logits,
                               pred_seq,
                               quantization_bins,
-                              coord_vocab_shift):
+                              coord_vocab_shift,
+                              class_log_probs=False):
   """Decode objects (label & bbox) for seq from `build_response_seq_from_bbox`.
 
   Assume yxyxc format with truncation at the end for any uneven extra tokens.
     Replace class tokens with argmax instead of sampling.
 
   Args:
-    logits: `float` output logits in shape of (bsz, max_seq_len, vocab_size).
+    logits: `float` output logits in shape of (bsz, max_seq_len, vocab_size),
+      or class log-probs in shape of (bsz, max_instances_per_image,
+      coord_vocab_shift - BASE_VOCAB_SHIFT) if `class_log_probs`.
     pred_seq: `int` pred sequence in shape of (bsz, max_seq_len).
     quantization_bins: `int` for bins.
     coord_vocab_shift: `int`, shifting coordinates by a specified integer.
+    class_log_probs: `bool` indicating logits are from `Model.infer` with
+      `logits_mode=object_seq_logits_mode(coord_vocab_shift)`.
 
   Returns:
     pred_class: `int` of shape (bsz, max_instances_per_image).
     pred_bbox: `float` of shape (bsz, max_instances_per_image, 4).
     pred_score: `float` of shape (bsz, max_instances_per_image).
   """
-  _, seqlen, vocab_size = logits.shape
+  seqlen = pred_seq.shape[-1]
   if seqlen % 5 != 0:  # truncate out the last few tokens.
     pred_seq = pred_seq[..., :-(seqlen % 5)]
-    logits = logits[..., :-(seqlen % 5), :]
-  pred_class_p = tf.nn.softmax(logits)[:, 4::5]  # (bsz, instances, vocab_size)
-  mask_s1 = [0.] * vocab.BASE_VOCAB_SHIFT  # reserved.
-  mask_s2 = [1.] * (coord_vocab_shift - vocab.BASE_VOCAB_SHIFT)  # labels.
-  mask_s3 = [0] * (vocab_size - coord_vocab_shift)  # coordinates and others.
-  mask = tf.constant(mask_s1 + mask_s2 + mask_s3)
-  pred_class = tf.argmax(pred_class_p * mask[tf.newaxis, tf.newaxis, :], -1)
-  pred_score = tf.reduce_sum(
-      pred_class_p * tf.one_hot(pred_class, vocab_size), -1)
-  pred_class = tf.maximum(pred_class - vocab.BASE_VOCAB_SHIFT, 0)
+  if class_log_probs:
+    pred_class_p = tf.exp(logits)  # (bsz, instances, num_classes)
+    pred_class = tf.argmax(pred_class_p, -1)
+    pred_score = tf.reduce_max(pred_class_p, -1)
+  else:
+    vocab_size = logits.shape[-1]
+    if seqlen % 5 != 0:
+      logits = logits[..., :-(seqlen % 5), :]
+    pred_class_p = tf.nn.softmax(logits)[:, 4::5]  # (bsz, instances, vocab)
+    mask = tf.cast(object_seq_grammar(
+        quantization_bins, coord_vocab_shift, vocab_size).token_mask(
+            4, classes_only=True), tf.float32)
+    pred_class = tf.argmax(pred_class_p * mask[tf.newaxis, tf.newaxis, :], -1)
+    pred_score = tf.reduce_sum(
+        pred_class_p * tf.one_hot(pred_class, vocab_size), -1)
+    pred_class = tf.maximum(pred_class - vocab.BASE_VOCAB_SHIFT, 0)
   pred_bbox = seq_to_bbox(pred_seq - coord_vocab_shift, quantization_bins)
   return pred_class, pred_bbox, pred_score
 
 
+def triplet_seq_logits_mode():
+  """Returns `logits_mode` for `Model.infer` of `decode_seq_to_triplets`.
+
+  Only log-probabilities at the object and relation class positions of each
+    triplet are kept, to be decoded with `class_log_probs=True`.
+  """
+  return {'period': 15, 'offsets': [4, 6, 12]}
+
+
 def decode_seq_to_triplets(logits,
                               pred_seq,
                               quantization_bins,
                               coord_vocab_shift,
-                              num_obj_classes, num_rel_classes):
-  _, seqlen, vocab_size = logits.shape
+                              num_obj_classes, num_rel_classes,
+                              class_log_probs=False):
+  """Decode triplets; logits are log-probs of `triplet_seq_logits_mode` if `class_log_probs`."""
+  seqlen = pred_seq.shape[-1]
+  vocab_size = logits.shape[-1]
   triplet_len = 15
   print(pred_seq[0,:15], pred_seq.shape)
   if seqlen % triplet_len != 0:  # truncate out the last few tokens.
     pred_seq = pred_seq[..., :-(seqlen % triplet_len)]
-    logits = logits[..., :-(seqlen % triplet_len), :]
+    if not class_log_probs:
+      logits = logits[..., :-(seqlen % triplet_len), :]
   # Chunk the sequence into triplets (length 12).
   pred_seq = tf.reshape(pred_seq, [-1, pred_seq.shape[-1] // triplet_len, triplet_len])
-  logits = tf.reshape(logits, [-1, logits.shape[-2] // triplet_len, triplet_len, logits.shape[-1]])
-  # print(pred_seq.shape)
-  pred_obj_class_logits = tf.gather(logits, indices=[4, 12], axis=2)
-  pred_rel_class_logits = tf.gather(logits, indices=[6], axis=2)
-  pred_obj_class_p = tf.nn.softmax(pred_obj_class_logits) # (bsz, instances, triplet_len, vocab_size)
-  pred_rel_class_p = tf.nn.softmax(pred_rel_class_logits)
+  if class_log_probs:
+    # Only positions [4, 6, 12] of each triplet are kept.
+    probs = tf.exp(logits)
+    probs = tf.reshape(probs, [-1, probs.shape[-2] // 3, 3, vocab_size])
+    pred_obj_class_p = tf.gather(probs, indices=[0, 2], axis=2)
+    pred_rel_class_p = tf.gather(probs, indices=[1], axis=2)
+  else:
+    logits = tf.reshape(logits, [-1, logits.shape[-2] // triplet_len, triplet_len, logits.shape[-1]])
+    # print(pred_seq.shape)
+    pred_obj_class_logits = tf.gather(logits, indices=[4, 12], axis=2)
+    pred_rel_class_logits = tf.gather(logits, indices=[6], axis=2)
+    pred_obj_class_p = tf.nn.softmax(pred_obj_class_logits) # (bsz, instances, triplet_len, vocab_size)
+    pred_rel_class_p = tf.nn.softmax(pred_rel_class_logits)
   # print(pred_obj_class_p.shape)
   # print(pred_rel_class_p.shape)
-  mask_s1 = [0.] * vocab.BASE_VOCAB_SHIFT  # reserved.
-  mask_s_rel = [0.] * num_obj_classes + [1.] * num_rel_classes + [0.] * (coord_vocab_shift - vocab.BASE_VOCAB_SHIFT - num_obj_classes - num_rel_classes)  # labels.
-  mask_s_obj = [1.] * num_obj_classes + [0.] * num_rel_classes + [0.] * (coord_vocab_shift - vocab.BASE_VOCAB_SHIFT - num_obj_classes - num_rel_classes)
-  mask_s3 = [0] * (vocab_size - coord_vocab_shift)  # coordinates and others.
-  mask_obj = tf.constant(mask_s1 + mask_s_obj + mask_s3)
-  mask_rel = tf.constant(mask_s1 + mask_s_rel + mask_s3)
+  grammar = triplet_seq_grammar(quantization_bins, coord_vocab_shift,
+                                vocab_size, num_obj_classes, num_rel_classes)
+  mask_obj = tf.cast(grammar.token_mask(4, classes_only=True), tf.float32)
+  mask_rel = tf.cast(grammar.token_mask(6, classes_only=True), tf.float32)
   # print(mask.shape)
   pred_obj_class = tf.argmax(pred_obj_class_p * mask_obj[tf.newaxis, tf.newaxis, tf.newaxis, :], -1)
   pred_rel_class = tf.argmax(pred_rel_class_p * mask_rel[tf.newaxis, tf.newaxis, tf.newaxis, :], -1)
@@ -261,11 +479,18 @@ def triplet_seq_to_bbox(seq, quantization_bins, seq_format='yxyx_name'):
 
 def compute_weighted_scores(bbox_scores, pred_seq, logits,
                             points_score_weight):
-  """Computes per instance score as weighted sum of box score and mean pred_seq score."""
-  probs = tf.nn.softmax(logits, axis=-1)
+  """Computes per instance score as weighted sum of box score and mean pred_seq score.
+
+  logits are either full logits of pred_seq tokens, or their log-probs (of the
+  same shape as pred_seq) from `Model.infer` with `logits_mode='token'`.
+  """
   # Set 0 weight for padding tokens.
   token_weight = tf.where(tf.equal(pred_seq, vocab.PADDING_TOKEN), 0.0, 1.0)
-  likelihoods = tf.gather(probs, pred_seq, batch_dims=pred_seq.shape.rank)
+  if logits.shape.rank == pred_seq.shape.rank:
+    likelihoods = tf.exp(logits)
+  else:
+    probs = tf.nn.softmax(logits, axis=-1)
+    likelihoods = tf.gather(probs, pred_seq, batch_dims=pred_seq.shape.rank)
   points_score = (
       tf.reduce_sum(likelihoods * token_weight, axis=-1) /
       tf.reduce_sum(token_weight, axis=-1))
@@ -284,6 +284,24 @@ def check_checkpoint_restored(strict_verifiers, loose_verifiers=()):
   return strict_verifiers_new, loose_verifiers_new
 
 
+def set_xla_compile_cache(cache_dir, device_types='GPU'):
+  """Persists XLA-compiled executables in cache_dir, to be reused across runs.
+
+  This needs to be called before anything is XLA-compiled (e.g. functions with
+  `jit_compile=True`), as XLA flags are only read once.
+
+  Args:
+    cache_dir: `str` of a local directory.
+    device_types: `str` of comma-separated device types to persist executables
+      for. CPU executables cannot be serialized by TF.
+  """
+  tf.io.gfile.makedirs(cache_dir)
+  os.environ['TF_XLA_FLAGS'] = ' '.join([
+      os.environ.get('TF_XLA_FLAGS', ''),
+      '--tf_xla_persistent_cache_directory=' + cache_dir,
+      '--tf_xla_persistent_cache_device_types=' + device_types]).strip()
+
+
 def build_strategy(use_tpu, master):
   """Returns a tf.distribute.Strategy."""
   if use_tpu:
@@ -315,6 +333,9 @@ def get_train_steps(dataset, train_steps, train_epochs, train_batch_size):
 
 def get_eval_steps(dataset, eval_steps, eval_batch_size):
   """Determine the number of eval steps."""
+  if dataset.task_config.get('image_size_buckets'):
+    # Batches per bucket are only known at the end of data.
+    return eval_steps or None
   num_eval_examples = dataset.num_eval_examples
   if not eval_steps and num_eval_examples and num_eval_examples % eval_batch_size != 0:
     raise ValueError('Only divisible eval batch sizes are currently supported.')